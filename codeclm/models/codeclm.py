@@ -3,12 +3,14 @@ Main model for using CodecLM. This will combine all the required components
 and provide easy access to the generation API.
 """
 
+import contextlib
+import threading
 import typing as tp
 import warnings
 
 import torch
 
-from codeclm.tokenizer.audio_tokenizer import AudioTokenizer
+from codeclm.tokenizer.audio_tokenizer import AudioTokenizer, ProgressiveCodes
 from .lm_levo import LmModel
 from ..modules.conditioners import ConditioningAttributes, AudioCondition
 from ..utils.autocast import TorchAutocast
@@ -55,6 +57,7 @@ class CodecLM:
         self.generation_params: dict = {}
         # self.set_generation_params(duration=15)  # 15 seconds by default
         self.set_generation_params(duration=15, extend_stride=self.max_duration // 2)
+        self.diffusion_params: dict = {}
         self._progress_callback: tp.Optional[tp.Callable[[int, int], None]] = None
         if self.device.type == 'cpu':
             self.autocast = TorchAutocast(enabled=False)
@@ -65,7 +68,11 @@ class CodecLM:
                               top_p: float = 0.0, temperature: float = 1.0,
                               duration: float = 30.0, cfg_coef: float = 3.0,
                              extend_stride: float = 18, record_tokens: bool = False,
-                             record_window: int = 50):
+                             record_window: int = 50, cfg_mode: str = 'full',
+                             cfg_cutoff_step: int = 0, cfg_reuse_interval: int = 1,
+                             compile_decode: bool = False, prefix_cache: bool = False,
+                             prefix_cache_max_bytes: int = 256 * 1024 ** 2,
+                             speculative_steps: int = 0):
         """Set the generation parameters for CodecLM.
 
         Args:
@@ -81,6 +88,18 @@ class CodecLM:
             extend_stride: when doing extended generation (i.e. more than 30 seconds), by how much
                 should we extend the audio each time. Larger values will mean less context is
                 preserved, and shorter value will require extra computations.
+            cfg_mode (str, optional): Execution mode of the unconditional CFG branch, one of 'full',
+                'cutoff', 'first_codebook' or 'reuse', see `LmModel.generate`. Defaults to 'full'.
+            cfg_cutoff_step (int, optional): Number of guided steps in 'cutoff' mode.
+            cfg_reuse_interval (int, optional): Refresh interval of the unconditional logits in 'reuse' mode.
+            compile_decode (bool, optional): Replay the decoding step from a captured CUDA graph, see
+                `LmModel.generate`. Defaults to False.
+            prefix_cache (bool, optional): Reuse the prefill of the prepended conditions across calls with
+                the same lyrics, descriptions and prompt, see `LmModel.generate`. Defaults to False.
+            prefix_cache_max_bytes (int, optional): Memory budget of the prefix cache, whose KV snapshots
+                stay on the device of the LM. Defaults to 256 MiB.
+            speculative_steps (int, optional): Maximum number of steps proposed by the n-gram draft of
+                speculative decoding, 0 to disable it. Defaults to 0.
         """
         assert extend_stride <= self.max_duration, "Cannot stride by more than max generation duration."
         self.extend_stride = extend_stride
@@ -93,6 +112,38 @@ class CodecLM:
             'cfg_coef': cfg_coef,
             'record_tokens': record_tokens,
             'record_window': record_window,
+            'cfg_mode': cfg_mode,
+            'cfg_cutoff_step': cfg_cutoff_step,
+            'cfg_reuse_interval': cfg_reuse_interval,
+            'compile_decode': compile_decode,
+            'prefix_cache': prefix_cache,
+            'speculative_steps': speculative_steps,
+        }
+        if self.lm is not None:
+            self.lm.prefix_cache.resize(prefix_cache_max_bytes)
+
+    def set_diffusion_params(self, num_steps: int = 50, solver: str = 'euler', t_schedule: str = 'linear',
+                             guidance_scale: tp.Union[float, tp.List[float]] = 1.5,
+                             guidance_interval: tp.Tuple[float, float] = (0., 1.)):
+        """Set the parameters of the flow matching decoder of the separate tokenizer.
+
+        Args:
+            num_steps (int, optional): Number of ODE solver steps. Defaults to 50.
+            solver (str, optional): ODE solver, one of 'euler', 'heun', 'midpoint', 'rk4' or 'multistep'.
+                Heun, midpoint and RK4 take 2 and 4 estimator evaluations per step. Defaults to 'euler'.
+            t_schedule (str, optional): Time grid of the solver, one of 'linear', 'cosine' or 'shift'.
+                Defaults to 'linear'.
+            guidance_scale (float or list of float, optional): Classifier free guidance scale of the
+                decoder, or one scale per solver step. Defaults to 1.5.
+            guidance_interval (tuple of float, optional): Steps starting at a time t (0 being the noise)
+                outside [t_start, t_end] are evaluated without guidance, at half the cost. Defaults to (0., 1.).
+        """
+        self.diffusion_params = {
+            'num_steps': num_steps,
+            'solver': solver,
+            't_schedule': t_schedule,
+            'guidance_scale': guidance_scale,
+            'guidance_interval': tuple(guidance_interval),
         }
 
     def set_custom_progress_callback(self, progress_callback: tp.Optional[tp.Callable[[int, int], None]] = None):
@@ -107,6 +158,7 @@ class CodecLM:
                  vocal_wavs: torch.Tensor = None,
                  bgm_wavs: torch.Tensor = None,
                  return_tokens: bool = False,
+                 num_takes: int = 1,
                  ) -> tp.Union[torch.Tensor, tp.Tuple[torch.Tensor, torch.Tensor]]:
         """Generate samples conditioned on text and melody.
 
@@ -118,32 +170,16 @@ class CodecLM:
                 a list of [C, T] tensors.
             melody_sample_rate: (int): Sample rate of the melody waveforms.
             progress (bool, optional): Flag to display progress of the generation process. Defaults to False.
+            num_takes (int, optional): Number of alternative songs sampled for the lyric, decoded together
+                as one batch. With more than one take, a list with the tokens (or audio) of every take
+                is returned, takes having their own length.
         """
-        if melody_wavs is not None:
-            if melody_wavs.dim() == 2:
-                melody_wavs = melody_wavs[None]
-            if melody_wavs.dim() != 3:
-                raise ValueError("Melody wavs should have a shape [B, C, T].")
-            melody_wavs = list(melody_wavs)
-        if vocal_wavs is not None:
-            if vocal_wavs.dim() == 2:
-                vocal_wavs = vocal_wavs[None]
-            if vocal_wavs.dim() != 3:
-                raise ValueError("Vocal wavs should have a shape [B, C, T].")
-            vocal_wavs = list(vocal_wavs)
-        if bgm_wavs is not None:
-            if bgm_wavs.dim() == 2:
-                bgm_wavs = bgm_wavs[None]
-            if bgm_wavs.dim() != 3:
-                raise ValueError("BGM wavs should have a shape [B, C, T].")
-            bgm_wavs = list(bgm_wavs)
-        
-        texts, audio_qt_embs = self._prepare_tokens_and_attributes(lyrics=lyrics, melody_wavs=melody_wavs, vocal_wavs=vocal_wavs, bgm_wavs=bgm_wavs, melody_is_wav=melody_is_wav)
-        tokens = self._generate_tokens(texts, descriptions, audio_qt_embs)
-
-        if (tokens == self.lm.eos_token_id).any():
-            length = torch.nonzero(torch.eq(tokens, self.lm.eos_token_id))[:,-1].min()
-            tokens = tokens[...,:length] 
+        texts, audio_qt_embs = self.prepare_inputs(lyrics, melody_wavs, melody_is_wav, vocal_wavs, bgm_wavs)
+        tokens = self.generate_tokens(texts, descriptions, audio_qt_embs, num_takes=num_takes)
+        if num_takes > 1:
+            if return_tokens:
+                return tokens
+            return [self.generate_audio(take) for take in tokens]
 
         if return_tokens:
             return tokens
@@ -151,6 +187,130 @@ class CodecLM:
             out = self.generate_audio(tokens)
             return out
 
+    def prepare_inputs(self, lyrics: tp.List[str],
+                       melody_wavs: torch.Tensor = None,
+                       melody_is_wav: bool = True,
+                       vocal_wavs: torch.Tensor = None,
+                       bgm_wavs: torch.Tensor = None) -> tp.Tuple[tp.List[str], torch.Tensor]:
+        """First stage of `generate`: encode the prompts into tokens.
+        Returns the texts and prompt tokens to give to `generate_tokens`."""
+        melody_wavs = self._as_wav_list(melody_wavs, "Melody")
+        vocal_wavs = self._as_wav_list(vocal_wavs, "Vocal")
+        bgm_wavs = self._as_wav_list(bgm_wavs, "BGM")
+        return self._prepare_tokens_and_attributes(lyrics=lyrics, melody_wavs=melody_wavs, vocal_wavs=vocal_wavs,
+                                                   bgm_wavs=bgm_wavs, melody_is_wav=melody_is_wav)
+
+    def generate_tokens(self, texts: tp.List[str], descriptions: tp.List[str], audio_qt_embs: torch.Tensor,
+                        num_takes: int = 1) -> tp.Union[torch.Tensor, tp.List[torch.Tensor]]:
+        """Second stage of `generate`: sample the tokens with the LM and trim them at EOS.
+        Returns a list of tokens, one per take, when `num_takes` > 1."""
+        assert num_takes >= 1, "num_takes should be at least 1"
+        tokens = self._generate_tokens(texts, descriptions, audio_qt_embs, num_samples=num_takes)
+        if num_takes > 1:
+            return [self._trim_eos(tokens[[i]]) for i in range(num_takes)]
+        return self._trim_eos(tokens)
+
+    @torch.no_grad()
+    def generate_progressive(self, texts: tp.List[str], descriptions: tp.List[str], audio_qt_embs: torch.Tensor,
+                             vocal_prompt=None, bgm_prompt=None, chunked=False,
+                             timesteps_interval: int = 25) -> tp.Tuple[torch.Tensor, torch.Tensor]:
+        """`generate_tokens` followed by `generate_audio`, overlapped: the diffusion decoder runs in a worker
+        thread on its own CUDA stream and decodes every window as soon as the LM has completed its
+        timesteps, so that only the windows at the end of the song are left when the LM stops.
+        Needs the separate tokenizer.
+
+        Args:
+            texts, descriptions, audio_qt_embs: Inputs of `generate_tokens`, see `prepare_inputs`.
+            vocal_prompt, bgm_prompt, chunked: Arguments of `generate_audio`.
+            timesteps_interval (int): Number of completed timesteps between two handoffs of codes.
+        Returns:
+            tuple of torch.Tensor: Tokens trimmed at EOS, as `generate_tokens`, and audio [1, 2, n].
+        """
+        assert self.seperate_tokenizer is not None, "progressive decoding needs the separate tokenizer"
+        source = ProgressiveCodes()
+        chunks: tp.List[torch.Tensor] = []
+        errors: tp.List[BaseException] = []
+
+        def decode():
+            try:
+                stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+                with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+                    for chunk in self.seperate_tokenizer.decode_progressive(source, vocal_prompt, bgm_prompt,
+                                                                            chunked=chunked, **self.diffusion_params):
+                        chunks.append(chunk)
+            except BaseException as e:
+                errors.append(e)
+
+        def on_timesteps(tokens: torch.Tensor):
+            tokens = self._trim_eos(tokens)
+            source.update([tokens[:, [1], :], tokens[:, [2], :]])
+
+        worker = threading.Thread(target=decode, name="progressive-diffusion", daemon=True)
+        worker.start()
+        try:
+            tokens = self._generate_tokens(texts, descriptions, audio_qt_embs, on_timesteps=on_timesteps,
+                                           on_timesteps_interval=timesteps_interval)
+            tokens = self._trim_eos(tokens)
+            source.finish([tokens[:, [1], :].cpu(), tokens[:, [2], :].cpu()])
+        except BaseException:
+            source.fail()
+            raise
+        finally:
+            worker.join()
+        if errors:
+            raise errors[0]
+        return tokens, torch.cat(chunks, -1)
+
+    @torch.no_grad()
+    def generate_batch(self, items: tp.List[dict], max_batch_size: int = 4,
+                       melody_is_wav: bool = True) -> tp.List[torch.Tensor]:
+        """Generate tokens for several songs with continuous batching, see `ContinuousBatchingGenerator`.
+        Every decoding step runs `max_batch_size` rows, even once fewer songs are left. The generation
+        parameters that the batched generator does not implement (`compile_decode`, `prefix_cache`,
+        `speculative_steps`, `cfg_cutoff_step`, `cfg_reuse_interval`) are ignored, with a warning if set.
+
+        Args:
+            items (list of dict): One dict per song with keys 'lyric', 'description' and optionally
+                'melody_wav', 'vocal_wav' and 'bgm_wav' ([C, T] or [1, C, T] tensors).
+            max_batch_size (int): Number of songs decoded concurrently.
+            melody_is_wav (bool): Whether the prompts are waveforms or already tokens.
+        Returns:
+            list of torch.Tensor: Tokens of every song in the order of `items`, as returned by
+                `generate(..., return_tokens=True)`.
+        """
+        from .lm_batching import ContinuousBatchingGenerator, GenerationRequest
+        requests = []
+        for idx, item in enumerate(items):
+            texts, audio_qt_embs = self._prepare_tokens_and_attributes(
+                lyrics=[item['lyric']],
+                melody_wavs=self._as_wav_list(item.get('melody_wav'), "Melody"),
+                vocal_wavs=self._as_wav_list(item.get('vocal_wav'), "Vocal"),
+                bgm_wavs=self._as_wav_list(item.get('bgm_wav'), "BGM"),
+                melody_is_wav=melody_is_wav)
+            requests.append(GenerationRequest(texts=texts, descriptions=[item.get('description')],
+                                              audio_qt_embs=audio_qt_embs, request_id=idx))
+        generator = ContinuousBatchingGenerator(self.lm, max_batch_size=max_batch_size,
+                                                max_gen_len=int(self.duration * self.frame_rate),
+                                                **self.generation_params)
+        with self.autocast:
+            results = dict(generator.run(requests))
+        return [self._trim_eos(results[idx]) for idx in range(len(items))]
+
+    def _as_wav_list(self, wavs: tp.Optional[torch.Tensor], kind: str) -> tp.Optional[MelodyList]:
+        if wavs is None:
+            return None
+        if wavs.dim() == 2:
+            wavs = wavs[None]
+        if wavs.dim() != 3:
+            raise ValueError(f"{kind} wavs should have a shape [B, C, T].")
+        return list(wavs)
+
+    def _trim_eos(self, tokens: torch.Tensor) -> torch.Tensor:
+        if (tokens == self.lm.eos_token_id).any():
+            length = torch.nonzero(torch.eq(tokens, self.lm.eos_token_id))[:,-1].min()
+            tokens = tokens[...,:length] 
+        return tokens
+
 
     @torch.no_grad()
     def _prepare_tokens_and_attributes(
@@ -236,13 +396,17 @@ class CodecLM:
     def _generate_tokens(self, 
                         texts: tp.Optional[tp.List[str]] = None,
                         descriptions: tp.Optional[tp.List[str]] = None,
-                        audio_qt_embs: tp.Optional[tp.List[torch.Tensor]] = None) -> torch.Tensor:
+                        audio_qt_embs: tp.Optional[tp.List[torch.Tensor]] = None,
+                        num_samples: tp.Optional[int] = None,
+                        **kwargs) -> torch.Tensor:
         """Generate discrete audio tokens given audio prompt and/or conditions.
 
         Args:
             attributes (list of ConditioningAttributes): Conditions used for generation (text/melody).
             prompt_tokens (torch.Tensor, optional): Audio prompt used for continuation.
             progress (bool, optional): Flag to display progress of the generation process. Defaults to False.
+            num_samples (int, optional): Number of takes sampled for the same conditions.
+            **kwargs: Additional arguments of `LmModel.generate`.
         Returns:
             torch.Tensor: Generated audio, of shape [B, C, T], T is defined by the generation params.
         """
@@ -264,23 +428,52 @@ class CodecLM:
                 gen_tokens = self.lm.generate(texts=texts, 
                                               descriptions=descriptions, 
                                               audio_qt_embs=audio_qt_embs, 
+                                              num_samples=num_samples,
                                               max_gen_len=total_gen_len, 
-                                              **self.generation_params)
+                                              **self.generation_params, **kwargs)
         else:
             raise NotImplementedError(f"duration {self.duration} < max duration {self.max_duration}")
         return gen_tokens
 
     @torch.no_grad()
-    def generate_audio(self, gen_tokens: torch.Tensor, prompt=None, vocal_prompt=None, bgm_prompt=None, chunked=False):
-        """Generate Audio from tokens"""
+    def generate_audio(self, gen_tokens: torch.Tensor, prompt=None, vocal_prompt=None, bgm_prompt=None, chunked=False,
+                       stream: bool = False):
+        """Generate Audio from tokens. With `stream`, an iterator over the chunks of audio [1, 2, n] is
+        returned instead, each chunk being yielded as soon as its diffusion window is decoded."""
         assert gen_tokens.dim() == 3
         if self.seperate_tokenizer is not None:
             gen_tokens_song = gen_tokens[:, [0], :]
             gen_tokens_vocal = gen_tokens[:, [1], :]
             gen_tokens_bgm = gen_tokens[:, [2], :]
+            if stream:
+                return self.seperate_tokenizer.decode_stream([gen_tokens_vocal, gen_tokens_bgm], vocal_prompt, bgm_prompt,
+                                                             chunked=chunked, **self.diffusion_params)
             # gen_audio_song = self.audiotokenizer.decode(gen_tokens_song, prompt)
-            gen_audio_seperate = self.seperate_tokenizer.decode([gen_tokens_vocal, gen_tokens_bgm], vocal_prompt, bgm_prompt, chunked=chunked)
+            gen_audio_seperate = self.seperate_tokenizer.decode([gen_tokens_vocal, gen_tokens_bgm], vocal_prompt, bgm_prompt, chunked=chunked,
+                                                                **self.diffusion_params)
             return gen_audio_seperate
         else:
+            assert not stream, "streaming needs the separate tokenizer"
             gen_audio = self.audiotokenizer.decode(gen_tokens, prompt)
             return gen_audio
+
+    @torch.no_grad()
+    def generate_audio_batch(self, gen_tokens: tp.List[torch.Tensor], vocal_prompt=None, bgm_prompt=None,
+                             chunked=False) -> tp.List[torch.Tensor]:
+        """Generate the audio of several songs at once from their tokens [1, 3, T] of any length T.
+        The windows of all songs go through the diffusion decoder in shared batches.
+
+        Args:
+            gen_tokens (list of torch.Tensor): Tokens of each song.
+            vocal_prompt, bgm_prompt (torch.Tensor or list, optional): Prompts shared by all the
+                songs, or one per song.
+        Returns:
+            list of torch.Tensor: Audio of each song.
+        """
+        assert self.seperate_tokenizer is not None, "batched decoding needs the separate tokenizer"
+        codes = []
+        for tokens in gen_tokens:
+            assert tokens.dim() == 3
+            codes.append([tokens[:, [1], :], tokens[:, [2], :]])
+        return self.seperate_tokenizer.decode_batch(codes, vocal_prompt, bgm_prompt, chunked=chunked,
+                                                    **self.diffusion_params)
@@ -1,5 +1,6 @@
 
 from .llama.modeling_llama import LlamaConfig, CausalLMOutputWithPast, BaseModelOutputWithPast, LlamaDecoderLayer, LlamaRMSNorm
+from .llama.modeling_llama import StaticKVCache
 from .llama.modeling_llama import LlamaForCausalLM as LlamaForCausalLM_base
 from .llama.modeling_llama import LlamaModel as LlamaModel_base
 import torch
@@ -139,10 +140,18 @@ class LmModel(LlamaModel_base):
         seq_length_with_past = seq_length
         past_key_values_length = 0
 
-        if past_key_values is not None:
+        if isinstance(past_key_values, StaticKVCache):
+            past_key_values_length = past_key_values.get_seq_length()
+            seq_length_with_past = seq_length_with_past + past_key_values_length
+        elif past_key_values is not None:
             past_key_values_length = past_key_values[0][0].shape[2]
             seq_length_with_past = seq_length_with_past + past_key_values_length
 
+        if getattr(past_key_values, 'static_shapes', False):
+            # fixed-shape decoding: visible positions and current positions are kept on device by the cache
+            attention_mask = past_key_values.attention_mask(batch_size) if attention_mask is None else attention_mask
+            position_ids = past_key_values.position_ids(batch_size) if position_ids is None else position_ids
+
         if position_ids is None:
             device = input_ids.device if input_ids is not None else inputs_embeds.device
             position_ids = torch.arange(
@@ -157,6 +166,12 @@ class LmModel(LlamaModel_base):
             attention_mask = torch.ones(
                 (batch_size, seq_length_with_past), dtype=torch.bool, device=inputs_embeds.device
             )
+            padding_mask = None
+        elif getattr(past_key_values, 'static_shapes', False):
+            padding_mask = None
+        else:
+            # only the flash attention path needs it, to unpad ragged rows
+            padding_mask = attention_mask if 0 in attention_mask else None
         attention_mask = self._prepare_decoder_attention_mask(
             attention_mask, (batch_size, seq_length), inputs_embeds, past_key_values_length
         )
@@ -196,7 +211,8 @@ class LmModel(LlamaModel_base):
                 layer_outputs = decoder_layer(*layer_args, 
                                               past_key_value=past_key_value, 
                                               output_attentions=output_attentions,
-                                              use_cache=use_cache)
+                                              use_cache=use_cache,
+                                              padding_mask=padding_mask)
 
             hidden_states = layer_outputs[0]
 
@@ -208,6 +224,12 @@ class LmModel(LlamaModel_base):
 
         hidden_states = self.norm(hidden_states)
 
+        if isinstance(past_key_values, StaticKVCache):
+            # all layers have written their k, v for this step: move the shared pointer once
+            past_key_values.advance(seq_length)
+            if use_cache:
+                next_decoder_cache = past_key_values
+
         # add hidden states from the last decoder layer
         if output_hidden_states:
             all_hidden_states += (hidden_states,)
@@ -261,6 +261,227 @@ def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
     return hidden_states.reshape(batch, num_key_value_heads * n_rep, slen, head_dim)
 
 
+class StaticKVCache:
+    """
+    Preallocated key/value cache for incremental decoding. Every layer owns a pair of buffers of shape
+    `(batch, num_key_value_heads, max_len, head_dim)` that are allocated on the first write and then filled in place
+    through a position pointer shared by all layers, so the per-token cost does not grow with the number of cached
+    positions and no reallocation happens while decoding.
+
+    Args:
+        num_layers (`int`): Number of decoder layers sharing the cache.
+        max_len (`int`): Maximum number of positions the cache can hold.
+    """
+
+    static_shapes = False
+
+    def __init__(self, num_layers: int, max_len: int):
+        self.num_layers = num_layers
+        self.max_len = max_len
+        self.seq_len = 0
+        self.key_cache: List[Optional[torch.Tensor]] = [None] * num_layers
+        self.value_cache: List[Optional[torch.Tensor]] = [None] * num_layers
+        self.layers = [StaticKVCacheLayer(self, idx) for idx in range(num_layers)]
+
+    def __len__(self):
+        return self.num_layers
+
+    def __getitem__(self, layer_idx: int) -> "StaticKVCacheLayer":
+        return self.layers[layer_idx]
+
+    def get_seq_length(self) -> int:
+        return self.seq_len
+
+    def update(self, layer_idx: int, key_states: torch.Tensor, value_states: torch.Tensor):
+        """Write `key_states` / `value_states` at the current position and return views over all valid positions."""
+        start = self.seq_len
+        end = start + key_states.shape[-2]
+        if end > self.max_len:
+            raise RuntimeError(f"StaticKVCache overflow: {end} positions requested, capacity is {self.max_len}")
+        if self.key_cache[layer_idx] is None:
+            bsz, num_heads, _, head_dim = key_states.shape
+            self.key_cache[layer_idx] = key_states.new_zeros(bsz, num_heads, self.max_len, head_dim)
+            self.value_cache[layer_idx] = value_states.new_zeros(bsz, num_heads, self.max_len, head_dim)
+        key_cache = self.key_cache[layer_idx]
+        value_cache = self.value_cache[layer_idx]
+        key_cache[:, :, start:end] = key_states
+        value_cache[:, :, start:end] = value_states
+        return key_cache[:, :, :end], value_cache[:, :, :end]
+
+    def advance(self, num_tokens: int):
+        """Move the position pointer once all layers have written `num_tokens` new positions."""
+        self.seq_len += num_tokens
+
+    def rewind(self, num_tokens: int):
+        """Drop the last `num_tokens` positions, e.g. rejected speculative steps; they are overwritten next."""
+        if num_tokens > self.seq_len:
+            raise RuntimeError(f"StaticKVCache underflow: cannot drop {num_tokens} of {self.seq_len} positions")
+        self.seq_len -= num_tokens
+
+    def split_rows(self, num_rows: int) -> Tuple["StaticKVCache", "StaticKVCache"]:
+        """
+        Split the cache along the batch dimension into the first `num_rows` rows and the remaining ones. Both caches
+        are views over the same buffers but have their own position pointer, so the two groups of rows can be
+        advanced independently from now on.
+        """
+        first, second = StaticKVCache(self.num_layers, self.max_len), StaticKVCache(self.num_layers, self.max_len)
+        for cache, rows in ((first, slice(None, num_rows)), (second, slice(num_rows, None))):
+            cache.seq_len = self.seq_len
+            cache.key_cache = [None if k is None else k[rows] for k in self.key_cache]
+            cache.value_cache = [None if v is None else v[rows] for v in self.value_cache]
+        return first, second
+
+
+class GraphKVCache(StaticKVCache):
+    """
+    `StaticKVCache` with fixed shapes, for decoding steps captured in a CUDA graph. The position pointer lives on
+    device, every step writes one position with `index_copy_` and attention always covers the whole buffers, the
+    positions past the pointer being masked out by `attention_mask()`. As the pointer is only updated on device,
+    `seq_len` keeps the length at conversion time.
+    """
+
+    static_shapes = True
+
+    @classmethod
+    def from_static(cls, cache: StaticKVCache) -> "GraphKVCache":
+        """Take over the (already allocated) buffers of `cache` and continue from its current position."""
+        assert all(k is not None for k in cache.key_cache), "the cache should have been written at least once"
+        graph_cache = cls(cache.num_layers, cache.max_len)
+        graph_cache.seq_len = cache.seq_len
+        graph_cache.key_cache = cache.key_cache
+        graph_cache.value_cache = cache.value_cache
+        device = cache.key_cache[0].device
+        graph_cache.position = torch.tensor([cache.seq_len], dtype=torch.long, device=device)
+        graph_cache._positions = torch.arange(cache.max_len, device=device)
+        return graph_cache
+
+    def get_seq_length(self) -> int:
+        return self.max_len - 1
+
+    def update(self, layer_idx: int, key_states: torch.Tensor, value_states: torch.Tensor):
+        if key_states.shape[-2] != 1:
+            raise ValueError("GraphKVCache only supports single-step decoding")
+        self.key_cache[layer_idx].index_copy_(2, self.position, key_states)
+        self.value_cache[layer_idx].index_copy_(2, self.position, value_states)
+        return self.key_cache[layer_idx], self.value_cache[layer_idx]
+
+    def advance(self, num_tokens: int):
+        self.position += num_tokens
+
+    def attention_mask(self, batch_size: int) -> torch.Tensor:
+        """Boolean mask of shape `(batch_size, max_len)` over the positions visible at the next step."""
+        return (self._positions <= self.position)[None, :].expand(batch_size, -1)
+
+    def position_ids(self, batch_size: int) -> torch.Tensor:
+        return self.position.view(1, 1).expand(batch_size, 1)
+
+
+class RaggedKVCache(StaticKVCache):
+    """
+    `StaticKVCache` whose rows hold sequences of different lengths, used to decode several independent sequences in
+    one padded batch. Each row keeps its own length; prefixes are computed separately and copied into free rows with
+    `load_rows`, after which every decoding step writes one position per row at that row's current length. Rows not
+    currently in use are left at length 0 and do not advance.
+
+    The attention modules see `max(lengths) + 1` key/value positions, so callers must pass the padding mask returned
+    by `attention_mask()` and the per-row positions returned by `position_ids()` to the model.
+
+    Args:
+        num_layers (`int`): Number of decoder layers sharing the cache.
+        max_len (`int`): Maximum number of positions a single row can hold.
+        batch_size (`int`): Number of rows of the cache.
+    """
+
+    def __init__(self, num_layers: int, max_len: int, batch_size: int):
+        super().__init__(num_layers, max_len)
+        self.batch_size = batch_size
+        self.lengths = [0] * batch_size
+        self.active = [False] * batch_size
+        self.seq_lens: Optional[torch.Tensor] = None
+        self._active_rows: Optional[torch.Tensor] = None
+        self._rows: Optional[torch.Tensor] = None
+
+    def get_seq_length(self) -> int:
+        return max(self.lengths)
+
+    def load_rows(self, rows: List[int], cache: StaticKVCache):
+        """Copy the prefix held by `cache` (one sequence per batch row) into the given rows."""
+        assert len(rows) == cache.key_cache[0].shape[0], "one destination row is needed per cached sequence"
+        length = cache.get_seq_length()
+        if length >= self.max_len:
+            raise RuntimeError(f"RaggedKVCache overflow: prefix of {length} positions, capacity is {self.max_len}")
+        for layer_idx in range(self.num_layers):
+            src_key, src_value = cache.key_cache[layer_idx], cache.value_cache[layer_idx]
+            if self.key_cache[layer_idx] is None:
+                _, num_heads, _, head_dim = src_key.shape
+                self.key_cache[layer_idx] = src_key.new_zeros(self.batch_size, num_heads, self.max_len, head_dim)
+                self.value_cache[layer_idx] = src_value.new_zeros(self.batch_size, num_heads, self.max_len, head_dim)
+            for i, row in enumerate(rows):
+                self.key_cache[layer_idx][row, :, :length] = src_key[i, :, :length]
+                self.value_cache[layer_idx][row, :, :length] = src_value[i, :, :length]
+        if self.seq_lens is None:
+            device = cache.key_cache[0].device
+            self.seq_lens = torch.zeros(self.batch_size, dtype=torch.long, device=device)
+            self._active_rows = torch.zeros(self.batch_size, dtype=torch.long, device=device)
+            self._rows = torch.arange(self.batch_size, device=device)
+        for row in rows:
+            self.lengths[row] = length
+            self.active[row] = True
+        self.seq_lens[rows] = length
+        self._active_rows[rows] = 1
+
+    def release_rows(self, rows: List[int]):
+        """Mark rows as free; their content is overwritten by the next `load_rows`."""
+        for row in rows:
+            self.lengths[row] = 0
+            self.active[row] = False
+        if self.seq_lens is not None:
+            self.seq_lens[rows] = 0
+            self._active_rows[rows] = 0
+
+    def attention_mask(self) -> torch.Tensor:
+        """Boolean mask of shape `(batch_size, max(lengths) + 1)` over the positions visible at the next step."""
+        positions = torch.arange(self.get_seq_length() + 1, device=self.seq_lens.device)
+        return positions[None, :] <= self.seq_lens[:, None]
+
+    def position_ids(self) -> torch.Tensor:
+        """Position of the next token of every row, of shape `(batch_size, 1)`."""
+        return self.seq_lens[:, None]
+
+    def update(self, layer_idx: int, key_states: torch.Tensor, value_states: torch.Tensor):
+        if key_states.shape[-2] != 1:
+            raise ValueError("RaggedKVCache only supports single-step decoding, load prefixes with `load_rows`")
+        end = self.get_seq_length() + 1
+        key_cache = self.key_cache[layer_idx]
+        value_cache = self.value_cache[layer_idx]
+        key_cache[self._rows, :, self.seq_lens] = key_states[:, :, 0]
+        value_cache[self._rows, :, self.seq_lens] = value_states[:, :, 0]
+        return key_cache[:, :, :end], value_cache[:, :, :end]
+
+    def advance(self, num_tokens: int):
+        for row in range(self.batch_size):
+            if self.active[row]:
+                self.lengths[row] += num_tokens
+        if self.get_seq_length() >= self.max_len:
+            raise RuntimeError(f"RaggedKVCache overflow: capacity of {self.max_len} positions reached")
+        self.seq_lens += num_tokens * self._active_rows
+
+
+class StaticKVCacheLayer:
+    """Per-layer handle on a `StaticKVCache`, passed to the attention modules in place of a `(key, value)` tuple."""
+
+    def __init__(self, cache: StaticKVCache, layer_idx: int):
+        self.cache = cache
+        self.layer_idx = layer_idx
+
+    def get_seq_length(self) -> int:
+        # subclasses (ragged rows, fixed-shape graphs) define the length seen by attention
+        return self.cache.get_seq_length()
+
+    def update(self, key_states: torch.Tensor, value_states: torch.Tensor):
+        return self.cache.update(self.layer_idx, key_states, value_states)
+
+
 class LlamaAttention(nn.Module):
     """Multi-headed attention from 'Attention Is All You Need' paper"""
 
@@ -355,17 +576,24 @@ class LlamaAttention(nn.Module):
         value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
 
         kv_seq_len = key_states.shape[-2]
-        if past_key_value is not None:
+        if isinstance(past_key_value, StaticKVCacheLayer):
+            kv_seq_len += past_key_value.get_seq_length()
+        elif past_key_value is not None:
             kv_seq_len += past_key_value[0].shape[-2]
         cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
 
-        if past_key_value is not None:
-            # reuse k, v, self_attention
-            key_states = torch.cat([past_key_value[0], key_states], dim=2)
-            value_states = torch.cat([past_key_value[1], value_states], dim=2)
+        if isinstance(past_key_value, StaticKVCacheLayer):
+            # write k, v in place into the preallocated cache
+            key_states, value_states = past_key_value.update(key_states, value_states)
+            past_key_value = past_key_value if use_cache else None
+        else:
+            if past_key_value is not None:
+                # reuse k, v, self_attention
+                key_states = torch.cat([past_key_value[0], key_states], dim=2)
+                value_states = torch.cat([past_key_value[1], value_states], dim=2)
 
-        past_key_value = (key_states, value_states) if use_cache else None
+            past_key_value = (key_states, value_states) if use_cache else None
 
         key_states = repeat_kv(key_states, self.num_key_value_groups)
         value_states = repeat_kv(value_states, self.num_key_value_groups)
@@ -429,6 +657,12 @@ class LlamaFlashAttention2(LlamaAttention):
         use_cache: bool = False,
         padding_mask: Optional[torch.LongTensor] = None,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
+        if isinstance(past_key_value, StaticKVCacheLayer) and past_key_value.cache.static_shapes:
+            # fixed-shape decoding attends over the whole cache with a mask, which flash attention does not support
+            return LlamaAttention.forward(
+                self, hidden_states, attention_mask, position_ids, past_key_value, output_attentions, use_cache
+            )
+
         # LlamaFlashAttention2 attention does not support output_attentions
         output_attentions = False
 
@@ -446,19 +680,26 @@ class LlamaFlashAttention2(LlamaAttention):
         value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
 
         kv_seq_len = key_states.shape[-2]
-        if past_key_value is not None:
+        if isinstance(past_key_value, StaticKVCacheLayer):
+            kv_seq_len += past_key_value.get_seq_length()
+        elif past_key_value is not None:
             kv_seq_len += past_key_value[0].shape[-2]
 
         cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
 
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
 
-        if past_key_value is not None:
-            # reuse k, v, self_attention
-            key_states = torch.cat([past_key_value[0], key_states], dim=2)
-            value_states = torch.cat([past_key_value[1], value_states], dim=2)
+        if isinstance(past_key_value, StaticKVCacheLayer):
+            # write k, v in place into the preallocated cache
+            key_states, value_states = past_key_value.update(key_states, value_states)
+            past_key_value = past_key_value if use_cache else None
+        else:
+            if past_key_value is not None:
+                # reuse k, v, self_attention
+                key_states = torch.cat([past_key_value[0], key_states], dim=2)
+                value_states = torch.cat([past_key_value[1], value_states], dim=2)
 
-        past_key_value = (key_states, value_states) if use_cache else None
+            past_key_value = (key_states, value_states) if use_cache else None
 
         query_states = query_states.transpose(1, 2)
         key_states = key_states.transpose(1, 2)
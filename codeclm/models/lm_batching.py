@@ -0,0 +1,282 @@
+"""
+Continuous batching on top of `LmModel`: several songs are decoded in one padded batch,
+new songs are admitted into slots as soon as a running song reaches EOS on all codebooks.
+"""
+
+import typing as tp
+import warnings
+from collections import deque
+from dataclasses import dataclass
+
+import torch
+
+from codeclm.models.levo import StaticKVCache
+from codeclm.models.llama.modeling_llama import RaggedKVCache
+from codeclm.models.lm_levo import LmModel, RepetitionPenaltyBuffer
+
+
+# generation parameters of `LmModel.generate` that the batched generator does not implement, with their
+# default values: other values are ignored, with a warning
+UNSUPPORTED_PARAMS = {
+    'cfg_cutoff_step': 0,
+    'cfg_reuse_interval': 1,
+    'compile_decode': False,
+    'prefix_cache': False,
+    'speculative_steps': 0,
+    'static_kv_cache': True,
+}
+
+
+@dataclass
+class GenerationRequest:
+    """A single song to generate.
+
+    Args:
+        texts (list of str): Lyrics, a list of one element as for `LmModel.generate`.
+        descriptions (list of str, optional): Descriptions, a list of one element.
+        audio_qt_embs (torch.Tensor): Prompt tokens of shape [1, K, T].
+        request_id (any, optional): Identifier returned with the generated codes.
+    """
+    texts: tp.List[str]
+    descriptions: tp.Optional[tp.List[str]]
+    audio_qt_embs: torch.Tensor
+    request_id: tp.Any = None
+
+
+@dataclass
+class _Slot:
+    request: GenerationRequest
+    ignore_tokens: torch.Tensor
+
+
+class ContinuousBatchingGenerator:
+    """Decode several songs at once with slot-based continuous batching.
+
+    Every slot owns two rows of the ragged KV caches (conditional and unconditional rows for CFG).
+    When a request is admitted, its conditions and first step are run on their own and the resulting
+    prefix is copied into the free rows; all running slots then advance together by one pattern step
+    per forward. A slot is released as soon as its song has emitted EOS on every codebook, and the
+    next pending request is admitted in its place at the following step.
+
+    Sampling matches `LmModel.generate`: same CFG, repetition penalty and prompt token masking,
+    applied per song. The batch has a fixed size: every `step()` runs all `max_batch_size` slots,
+    empty ones included, so a last song decoded alone costs as much as a full batch.
+
+    Args:
+        lm (LmModel): Language model, in eval mode.
+        max_batch_size (int): Number of songs decoded concurrently.
+        max_gen_len (int): Maximum number of frames generated per song.
+        use_sampling (bool): Whether to use a sampling strategy or not.
+        temp (float): Sampling temperature.
+        top_k (int): K for "top-k" sampling.
+        top_p (float): P for "top-p" sampling.
+        cfg_coef (float, optional): Classifier-free guidance coefficient.
+        record_tokens (bool): Whether to penalize recently sampled tokens.
+        record_window (int): Number of past steps considered by the repetition penalty.
+        cfg_mode (str): CFG execution mode, only 'full' is supported.
+        **kwargs: Other generation parameters of `LmModel.generate`, ignored. Those of
+            `UNSUPPORTED_PARAMS` raise a warning when they differ from their default.
+    """
+    def __init__(self,
+                 lm: LmModel,
+                 max_batch_size: int = 4,
+                 max_gen_len: int = 256,
+                 use_sampling: bool = True,
+                 temp: float = 1.0,
+                 top_k: int = 250,
+                 top_p: float = 0.0,
+                 cfg_coef: tp.Optional[float] = None,
+                 record_tokens: bool = True,
+                 record_window: int = 150,
+                 cfg_mode: str = 'full',
+                 **kwargs):
+        assert not lm.training, "generation shouldn't be used in training mode."
+        assert cfg_mode == 'full', "only the 'full' CFG mode is supported by the batched generator"
+        assert len(lm.fuser.fuse2cond.get('sum', [])) == 0, \
+            "conditions fused by 'sum' are not supported by the batched generator"
+        ignored = {name: kwargs[name] for name, default in UNSUPPORTED_PARAMS.items()
+                   if name in kwargs and kwargs[name] != default}
+        if ignored:
+            warnings.warn(f"generation parameters not supported by the batched generator, ignored: {ignored}")
+        self.lm = lm
+        self.max_batch_size = max_batch_size
+        self.max_gen_len = max_gen_len
+        self.use_sampling = use_sampling
+        self.temp = temp
+        self.top_k = top_k
+        self.top_p = top_p
+        self.cfg_coef = lm.cfg_coef if cfg_coef is None else cfg_coef
+        self.record_tokens = record_tokens
+        self.record_window = record_window
+        self.unknown_token = -1
+
+        self.pattern = lm.pattern_provider.get_pattern(max_gen_len)
+        self.start_offset = self.pattern.get_first_step_with_timesteps(0)
+        assert self.start_offset is not None
+        self.device = next(iter(lm.parameters())).device
+
+        self.pending: tp.Deque[GenerationRequest] = deque()
+        self.slots: tp.List[tp.Optional[_Slot]] = [None] * max_batch_size
+        self.stats = {'steps': 0, 'admitted': 0, 'finished': 0, 'active_slot_steps': 0}
+        self._reset_batch_state()
+
+    def _reset_batch_state(self):
+        B, K = self.max_batch_size, self.lm.code_depth
+        gen_codes = torch.full((B, K, self.max_gen_len), self.unknown_token, dtype=torch.long, device=self.device)
+        # [B, K, S] sequences and the [K, S] pattern mask shared by all songs
+        self.gen_sequence, _, self.mask = self.pattern.build_pattern_sequence(gen_codes, self.lm.special_token_id)
+        self.offsets = torch.full((B,), self.start_offset, dtype=torch.long, device=self.device)
+        self.is_end = torch.zeros((B, K, 1), dtype=torch.bool, device=self.device)
+        self.token_pool: tp.Optional[RepetitionPenaltyBuffer] = None
+        if self.record_tokens:
+            self.token_pool = RepetitionPenaltyBuffer(B, K, self.record_window, self.lm.eos_token_id, self.device)
+        self.cache_1: tp.Optional[RaggedKVCache] = None
+        self.cache_2: tp.Optional[RaggedKVCache] = None
+
+    @property
+    def num_active(self) -> int:
+        return sum(slot is not None for slot in self.slots)
+
+    def submit(self, request: GenerationRequest):
+        """Queue a request, it is admitted at the next step with a free slot."""
+        self.pending.append(request)
+
+    @torch.no_grad()
+    def run(self, requests: tp.Iterable[GenerationRequest]) -> tp.List[tp.Tuple[tp.Any, torch.Tensor]]:
+        """Generate all requests and return `(request_id, codes)` pairs in completion order,
+        codes being of shape [1, K, T] as returned by `LmModel.generate`."""
+        for request in requests:
+            self.submit(request)
+        results = []
+        with self.lm.streaming():
+            self._reset_batch_state()
+            while self.pending or self.num_active > 0:
+                results.extend(self.step())
+        return results
+
+    @torch.no_grad()
+    def step(self) -> tp.List[tp.Tuple[tp.Any, torch.Tensor]]:
+        """Admit pending requests into free slots and decode one step for every running song.
+        The forward covers all `max_batch_size` rows, empty slots included.
+        Must be called within `lm.streaming()`. Returns the songs finished at this step."""
+        finished = []
+        for idx in range(self.max_batch_size):
+            if self.slots[idx] is None and self.pending:
+                finished.extend(self._admit(idx, self.pending.popleft()))
+        if self.num_active == 0:
+            return finished
+
+        B = self.max_batch_size
+        lm = self.lm
+        idx = (self.offsets - 1).view(B, 1, 1).expand(-1, lm.code_depth, 1)
+        curr_sequence = self.gen_sequence.gather(-1, idx)  # [B, K, 1]
+        lm._streaming_state['past_key_values_1'] = self.cache_1
+        lm._streaming_state['past_key_values_2'] = self.cache_2
+        all_logits = lm(torch.cat([curr_sequence, curr_sequence], dim=0), condition_tensors={},
+                        attention_mask=self.cache_1.attention_mask(),
+                        position_ids=self.cache_1.position_ids())
+        active = [i for i, slot in enumerate(self.slots) if slot is not None]
+        self.stats['steps'] += 1
+        self.stats['active_slot_steps'] += len(active)
+        next_token = self._sample(all_logits, list(range(B)))
+        finished.extend(self._commit(next_token[active], active))
+        return finished
+
+    def _admit(self, slot_idx: int, request: GenerationRequest) -> tp.List[tp.Tuple[tp.Any, torch.Tensor]]:
+        """Run the conditions and the first step of a request, copy its prefix into the rows of the slot
+        and write its first token."""
+        lm = self.lm
+        B = self.max_batch_size
+        condition_tensors = lm.prepare_condition_tensors(batch_size=1, text=request.texts,
+                                                         descriptions=request.descriptions,
+                                                         audio_qt_emb=request.audio_qt_embs,
+                                                         prepare_null_condition=True)
+        prefix_len = lm.get_prepend_length(condition_tensors) + self.start_offset
+        max_len = prefix_len + self.gen_sequence.shape[-1]
+        if self.cache_1 is None:
+            self.cache_1 = RaggedKVCache(lm.transformer.config.num_hidden_layers, max_len, 2 * B)
+            self.cache_2 = RaggedKVCache(lm.transformer2.config.num_hidden_layers, max_len, 2 * B)
+        assert max_len <= self.cache_1.max_len, "all requests must share the same prepended conditions length"
+
+        self.gen_sequence[slot_idx] = self.unknown_token
+        self.gen_sequence[slot_idx][~self.mask] = lm.special_token_id
+        self.offsets[slot_idx] = self.start_offset
+        self.is_end[slot_idx] = False
+        if self.token_pool is not None:
+            self.token_pool.reset_rows(torch.tensor([slot_idx], device=self.device))
+        ignore_tokens = request.audio_qt_embs[0][0]
+        self.slots[slot_idx] = _Slot(request, ignore_tokens[ignore_tokens < 16384])
+        self.stats['admitted'] += 1
+
+        # the fuser prepends the conditions only when it has no streaming offsets yet
+        lm.fuser._streaming_state.pop('offsets', None)
+        prefix_1 = StaticKVCache(lm.transformer.config.num_hidden_layers, prefix_len)
+        prefix_2 = StaticKVCache(lm.transformer2.config.num_hidden_layers, prefix_len)
+        lm._streaming_state['past_key_values_1'] = prefix_1
+        lm._streaming_state['past_key_values_2'] = prefix_2
+        sequence = self.gen_sequence[[slot_idx], :, :self.start_offset]
+        all_logits = lm(torch.cat([sequence, sequence], dim=0), condition_tensors)
+        rows = [slot_idx, B + slot_idx]
+        self.cache_1.load_rows(rows, prefix_1)
+        self.cache_2.load_rows(rows, prefix_2)
+
+        next_token = self._sample(all_logits, [slot_idx])
+        return self._commit(next_token, [slot_idx])
+
+    def _sample(self, all_logits: torch.Tensor, slot_ids: tp.List[int]) -> torch.Tensor:
+        """Apply CFG, penalties and sampling on logits [2 * N, K, S, card] of the given slots."""
+        cond_logits, uncond_logits = all_logits.split(len(slot_ids), dim=0)
+        logits = uncond_logits + (cond_logits - uncond_logits) * self.cfg_coef
+        logits = logits[:, :, -1, :]  # [N, K, card]
+        if self.token_pool is not None:
+            self.token_pool.penalize_(logits, torch.tensor(slot_ids, device=self.device))
+        for i, slot_idx in enumerate(slot_ids):
+            slot = self.slots[slot_idx]
+            if slot is not None:
+                self.lm._penalize_logits(logits[i:i+1], None, slot.ignore_tokens)
+        return self.lm._sample_from_logits(logits, self.use_sampling, self.temp, self.top_k, self.top_p)
+
+    def _commit(self, next_token: torch.Tensor,
+                slot_ids: tp.List[int]) -> tp.List[tp.Tuple[tp.Any, torch.Tensor]]:
+        """Write sampled tokens [N, K, 1] of the given slots, same rules as `LmModel.generate`,
+        and release the songs that are done."""
+        lm = self.lm
+        index = torch.tensor(slot_ids, device=self.device)
+        offsets = self.offsets[index]
+        valid_mask = self.mask[:, offsets].t().unsqueeze(-1)  # [N, K, 1]
+        next_token[~valid_mask] = lm.special_token_id
+        is_end = self.is_end[index]
+        next_token[is_end] = lm.special_token_id
+        is_end = is_end | (next_token == lm.eos_token_id)
+        self.is_end[index] = is_end
+
+        pos = offsets.view(-1, 1, 1).expand(-1, lm.code_depth, 1)
+        gen_sequence = self.gen_sequence[index]
+        curr = gen_sequence.gather(-1, pos)
+        gen_sequence.scatter_(-1, pos, torch.where(curr == self.unknown_token, next_token, curr))
+        self.gen_sequence[index] = gen_sequence
+        self.offsets[index] = offsets + 1
+        if self.token_pool is not None:
+            self.token_pool.push(next_token, index)
+
+        done = (is_end.flatten(1).all(dim=1) | (offsets + 1 >= self.gen_sequence.shape[-1])).tolist()
+        offsets = offsets.tolist()
+        finished = []
+        for i, slot_idx in enumerate(slot_ids):
+            slot = self.slots[slot_idx]
+            if slot is None:
+                continue
+            if done[i]:
+                finished.append((slot.request.request_id, self._finalize(slot_idx, offsets[i])))
+        return finished
+
+    def _finalize(self, slot_idx: int, offset: int) -> torch.Tensor:
+        gen_sequence = self.gen_sequence[[slot_idx], :, :offset + 1]
+        output_codes = torch.full_like(self.gen_sequence[[slot_idx]], self.lm.code_size)
+        out_codes = self.lm.revert_generated_sequence(self.pattern, gen_sequence, output_codes, self.unknown_token)
+        B = self.max_batch_size
+        self.cache_1.release_rows([slot_idx, B + slot_idx])
+        self.cache_2.release_rows([slot_idx, B + slot_idx])
+        self.slots[slot_idx] = None
+        self.stats['finished'] += 1
+        return out_codes
@@ -0,0 +1,80 @@
+"""
+CUDA graph capture of the steady-state decoding step of `LmModel.generate`.
+"""
+
+import typing as tp
+
+import torch
+
+from codeclm.models.llama.modeling_llama import GraphKVCache, StaticKVCache
+
+
+class DecodeStepGraph:
+    """Replayable decoding step: `transformer`, `transformer2`, CFG combine, repetition penalty
+    and sampling of one pattern step, captured once in a CUDA graph and replayed afterwards.
+
+    It is created after the first (prompt) step, which has a different shape and is run eagerly.
+    The static KV caches are converted to fixed-shape `GraphKVCache`, the input tokens are copied
+    into a static buffer and the sampled tokens are read from the static output of the graph.
+    The first `warmup_steps` calls run the same fixed-shape step eagerly on a side stream, as
+    required before capture; they produce real tokens.
+
+    Args:
+        lm (LmModel): Language model, in streaming mode, after the first step.
+        sequence (torch.Tensor): Example input of shape [B, K, 1], for the static input buffer.
+        warmup_steps (int): Number of eager steps before capture.
+        **sample_kwargs: Arguments of `LmModel._sample_next_token` (everything but the sequence),
+            they are frozen in the graph.
+    """
+    def __init__(self, lm, sequence: torch.Tensor, warmup_steps: int = 2, **sample_kwargs):
+        assert sequence.is_cuda, "CUDA graphs need a CUDA device"
+        self.lm = lm
+        self.sample_kwargs = sample_kwargs
+        self.warmup_steps = warmup_steps
+        for key in ['past_key_values_1', 'past_key_values_2']:
+            cache = lm._streaming_state.get(key)
+            if cache is None:
+                continue
+            assert isinstance(cache, StaticKVCache), "decoding graphs need the static KV cache"
+            lm._streaming_state[key] = GraphKVCache.from_static(cache)
+        self.sequence = torch.empty_like(sequence)
+        self.graph: tp.Optional[torch.cuda.CUDAGraph] = None
+        self.next_token: tp.Optional[torch.Tensor] = None
+        self.replays = 0
+
+    @classmethod
+    def is_supported(cls, device: torch.device, cfg_mode: str, static_kv_cache: bool) -> bool:
+        return device.type == 'cuda' and cfg_mode == 'full' and static_kv_cache
+
+    def _step(self) -> torch.Tensor:
+        return self.lm._sample_next_token(self.sequence, **self.sample_kwargs)
+
+    def __call__(self, sequence: torch.Tensor) -> torch.Tensor:
+        """Sample the next token [B, K, 1] given the current step [B, K, 1]."""
+        self.sequence.copy_(sequence)
+        if self.graph is None and self.warmup_steps > 0:
+            self.warmup_steps -= 1
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                next_token = self._step()
+            torch.cuda.current_stream().wait_stream(stream)
+            return next_token
+        if self.graph is None:
+            # capture records the step without running it, the replay below runs it
+            self.graph = torch.cuda.CUDAGraph()
+            autocast = torch.is_autocast_enabled()
+            with torch.cuda.graph(self.graph), \
+                    torch.autocast('cuda', dtype=torch.get_autocast_gpu_dtype(), enabled=autocast,
+                                   cache_enabled=False):
+                self.next_token = self._step()
+        else:
+            # python side effects of the step only happened during capture
+            cfg_state = self.sample_kwargs.get('cfg_state')
+            if cfg_state is not None:
+                B = sequence.shape[0]
+                cfg_state.step += 1
+                cfg_state.count(2 * B, 2 * B, 2 * B)
+        self.graph.replay()
+        self.replays += 1
+        return self.next_token.clone()
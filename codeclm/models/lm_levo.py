@@ -1,13 +1,18 @@
 
 import torch
+import copy
 import math
+import time
 import random
 import torch.nn as nn
 import typing as tp
 import torch.nn.functional as F
 from tqdm import tqdm
-from dataclasses import dataclass
-from codeclm.models.levo import CausalLM, LlamaConfig
+from dataclasses import dataclass, field
+from collections import OrderedDict
+from codeclm.models.levo import CausalLM, LlamaConfig, StaticKVCache
+from codeclm.models.lm_graph import DecodeStepGraph
+from codeclm.models.lm_speculative import NGramDraft, SpeculativeDecoder
 from codeclm.modules.streaming import StreamingModule
 from codeclm.modules.conditioners import (
     ConditioningAttributes,
@@ -19,10 +24,218 @@ from codeclm.modules.conditioners import (
     ClassifierFreeGuidanceDropout,
     AttributeDropout,
 )
-from codeclm.utils.utils import create_norm_fn, init_layer, sample_top_k, sample_top_p, multinomial
+from codeclm.utils.utils import create_norm_fn, init_layer, sample_top_k, sample_top_p, multinomial, content_hash
 from codeclm.modules.pattern import CodebooksPatternProvider
 ConditionTensors = tp.Dict[str, ConditionType]
 
+CFG_MODES = ['full', 'cutoff', 'first_codebook', 'reuse']
+
+
+@dataclass
+class CFGState:
+    """Bookkeeping of classifier-free guidance during one generation, see `LmModel.generate`.
+
+    Cost counters are in rows x positions fed to each transformer; `baseline_rows` is what
+    full CFG would have fed to both of them.
+    """
+    mode: str = 'full'
+    cutoff_step: int = 0
+    reuse_interval: int = 1
+    step: int = 0
+    caches: tp.Optional[tp.Dict[str, dict]] = None
+    uncond_logits: tp.Optional[torch.Tensor] = None
+    uncond_pending: tp.List[torch.Tensor] = field(default_factory=list)
+    forwards: int = 0
+    main_rows: int = 0
+    sub_rows: int = 0
+    baseline_rows: int = 0
+    drift_sum: float = 0.
+    drift_count: int = 0
+    prefix_key: tp.Optional[str] = None
+    num_takes: int = 1
+
+    def count(self, main_rows: int, sub_rows: int, baseline_rows: int):
+        self.forwards += 1
+        self.main_rows += main_rows
+        self.sub_rows += sub_rows
+        self.baseline_rows += baseline_rows
+
+    def summary(self, num_layers: int, num_layers_sub: int, elapsed: float) -> tp.Dict[str, float]:
+        cost = self.main_rows * num_layers + self.sub_rows * num_layers_sub
+        baseline = self.baseline_rows * (num_layers + num_layers_sub)
+        return {
+            'mode': self.mode,
+            'steps': self.step,
+            'forwards': self.forwards,
+            'relative_compute': cost / max(baseline, 1),
+            'uncond_drift_kl': self.drift_sum / self.drift_count if self.drift_count else 0.,
+            'elapsed': elapsed,
+        }
+
+
+class RepetitionPenaltyBuffer:
+    """On-device ring buffer of the last `window` sampled tokens of every batch row and codebook,
+    used for the repetition penalty of `LmModel.generate`.
+
+    A token seen in the window gets its logit divided by `penalty` once, whatever its number of
+    occurrences, as was done with `torch.bincount(torch.unique(pool))`. Empty entries and tokens
+    from `num_penalized` on (EOS, special token) are never penalized. The penalty of all rows and
+    codebooks is computed with a single scatter.
+
+    Args:
+        batch_size (int): Number of rows.
+        code_depth (int): Number of codebooks.
+        window (int): Number of past steps kept per row.
+        num_penalized (int): Tokens in [0, num_penalized) can be penalized.
+        device (torch.device): Device of the buffer.
+        penalty (float): Penalty factor.
+    """
+    def __init__(self, batch_size: int, code_depth: int, window: int, num_penalized: int,
+                 device: tp.Union[torch.device, str], penalty: float = 1.1):
+        assert window > 0, "window of the repetition penalty should be positive"
+        self.window = window
+        self.num_penalized = num_penalized
+        self.penalty = penalty
+        self.tokens = torch.full((batch_size, code_depth, window), -1, dtype=torch.long, device=device)
+        self.ptr = torch.zeros(batch_size, dtype=torch.long, device=device)
+        self._rows = torch.arange(batch_size, device=device)
+
+    def reset_rows(self, rows: torch.Tensor):
+        self.tokens[rows] = -1
+        self.ptr[rows] = 0
+
+    def clone(self) -> "RepetitionPenaltyBuffer":
+        other = copy.copy(self)
+        other.tokens = self.tokens.clone()
+        other.ptr = self.ptr.clone()
+        return other
+
+    def push(self, tokens: torch.Tensor, rows: tp.Optional[torch.Tensor] = None):
+        """Record sampled tokens of shape [N, K, 1], N being all rows or the given `rows`."""
+        rows = self._rows if rows is None else rows
+        ptr = self.ptr[rows]
+        self.tokens[rows, :, ptr] = tokens[..., 0]
+        self.ptr[rows] = (ptr + 1) % self.window
+
+    def penalize_(self, logits: torch.Tensor, rows: tp.Optional[torch.Tensor] = None):
+        """Apply the penalty in place on logits of shape [N, K, card]."""
+        tokens = self.tokens if rows is None else self.tokens[rows]
+        card = logits.shape[-1]
+        # entries that are not penalized all go to an extra bin
+        tokens = torch.where((tokens >= 0) & (tokens < min(self.num_penalized, card)), tokens, card)
+        seen = torch.zeros(*tokens.shape[:-1], card + 1, dtype=torch.bool, device=logits.device)
+        seen.scatter_(-1, tokens, True)
+        logits.copy_(torch.where(seen[..., :card], logits / self.penalty, logits))
+
+
+def _split_kv_cache_rows(cache, num_rows: int):
+    """Split a KV cache (`StaticKVCache` or tuple of (key, value) per layer) into its first
+    `num_rows` rows and the remaining ones."""
+    if cache is None:
+        return None, None
+    if isinstance(cache, StaticKVCache):
+        return cache.split_rows(num_rows)
+    first = tuple((k[:num_rows], v[:num_rows]) for k, v in cache)
+    second = tuple((k[num_rows:], v[num_rows:]) for k, v in cache)
+    return first, second
+
+
+def _snapshot_kv_cache(cache):
+    """Compact copy of the valid positions of a KV cache, as a tuple of (key, value) per layer."""
+    if cache is None:
+        return None
+    if isinstance(cache, StaticKVCache):
+        end = cache.get_seq_length()
+        return tuple((k[:, :, :end].clone(), v[:, :, :end].clone())
+                     for k, v in zip(cache.key_cache, cache.value_cache))
+    # tuple caches are grown by concatenation, their tensors are never written in place
+    return cache
+
+
+def _restore_kv_cache(snapshot, like, repeats: int = 1):
+    """Rebuild a cache of the same kind as `like` holding the positions of `snapshot`, each row
+    being repeated `repeats` times."""
+    if snapshot is None:
+        return None
+    if repeats > 1:
+        snapshot = tuple((k.repeat_interleave(repeats, dim=0), v.repeat_interleave(repeats, dim=0))
+                         for k, v in snapshot)
+    if isinstance(like, StaticKVCache):
+        cache = StaticKVCache(like.num_layers, like.max_len)
+        for layer_idx, (k, v) in enumerate(snapshot):
+            cache.update(layer_idx, k, v)
+        cache.advance(snapshot[0][0].shape[2])
+        return cache
+    return snapshot
+
+
+class PrefixKVCache:
+    """LRU cache of the streaming state after the first decoding step, which only depends on the
+    prepended conditions: every take of a song with the same lyrics, descriptions and prompt starts
+    from the same KV caches and the same first logits, see `LmModel.generate`.
+
+    Entries are keyed by the `content_hash` of the conditions and evicted, least recently used first,
+    to keep the cached tensors under `max_bytes`. The snapshots stay on the device of the model until
+    evicted or cleared.
+
+    Args:
+        max_bytes (int): Memory budget of the cached tensors.
+    """
+    def __init__(self, max_bytes: int = 256 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: tp.OrderedDict[str, tp.Dict[str, tp.Any]] = OrderedDict()
+
+    def get(self, key: str) -> tp.Optional[tp.Dict[str, tp.Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, state: tp.Dict[str, tp.Any], logits: tp.Tuple[torch.Tensor, torch.Tensor]):
+        tensors = [t for value in state.values() for t in _flatten_tensors(value)] + list(logits)
+        nbytes = sum(t.numel() * t.element_size() for t in tensors)
+        if nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)['nbytes']
+        self._entries[key] = {'state': state, 'logits': logits, 'nbytes': nbytes}
+        self.nbytes += nbytes
+        self._evict()
+
+    def resize(self, max_bytes: int):
+        """Change the memory budget, evicting entries if it shrinks."""
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= evicted['nbytes']
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    @property
+    def stats(self) -> tp.Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+                'bytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+
+def _flatten_tensors(value) -> tp.List[torch.Tensor]:
+    if isinstance(value, torch.Tensor):
+        return [value]
+    if isinstance(value, (list, tuple)):
+        return [t for item in value for t in _flatten_tensors(item)]
+    return []
+
+
 @dataclass
 class LMOutput:
     # The logits are already re-aligned with the input codes
@@ -142,6 +355,7 @@ class LmModel(StreamingModule):
         self._init_weights(weight_init, depthwise_init, zero_bias_init)
         self._fsdp: tp.Optional[nn.Module]
         self.__dict__['_fsdp'] = None
+        self.prefix_cache = PrefixKVCache()
 
         self.reset_streaming()
         
@@ -239,13 +453,15 @@ class LmModel(StreamingModule):
                 null_conditions = cfg_inference(conditions, condition_types=["audio", "text"], 
                                                 customized=None)
                 conditions = conditions + null_conditions
-            tokenized_conditions = self.condition_provider.tokenize(conditions)
-            condition_tensors = self.condition_provider(tokenized_conditions)
+            condition_tensors = self.condition_provider.get_conditions(conditions)
         return condition_tensors
         
     def forward(self, 
                 sequence: torch.Tensor,
-                condition_tensors: ConditionTensors) -> torch.Tensor:
+                condition_tensors: ConditionTensors,
+                attention_mask: tp.Optional[torch.Tensor] = None,
+                position_ids: tp.Optional[torch.Tensor] = None,
+                sub_batch_size: tp.Optional[int] = None) -> torch.Tensor:
         """Apply language model on sequence and conditions.
         Given a tensor of sequence of shape [B, K, S] with K the number of codebooks and
         S the sequence steps, return the logits with shape [B, card, K, S].
@@ -254,6 +470,11 @@ class LmModel(StreamingModule):
             indices (torch.Tensor): Indices of the codes to model.
             condition_tensors (dict[str, ConditionType], optional): Pre-computed conditioning
                 tensors, see `conditions`.
+            attention_mask (torch.Tensor, optional): Padding mask over the cached and current
+                positions, only needed when the rows of the KV cache have different lengths.
+            position_ids (torch.Tensor, optional): Per-row positions of the current steps.
+            sub_batch_size (int, optional): If set, only the first rows go through `transformer2`
+                and the logits of the other codebooks are repeated for the remaining rows.
         Returns:
             torch.Tensor: Logits.
         """
@@ -265,6 +486,8 @@ class LmModel(StreamingModule):
         input_2 = sum([self.layer2_emb[k](sequence[:, k]) for k in range(1, K)])
         fused_input1, fused_input2 = self.fuser(input_1, input_2, condition_tensors)
         output = self.transformer(inputs_embeds=fused_input1, 
+                                  attention_mask=attention_mask,
+                                  position_ids=position_ids,
                                   use_cache=self._is_streaming, 
                                   past_key_values=self._streaming_state.get('past_key_values_1', None))
         if self._is_streaming:
@@ -275,15 +498,25 @@ class LmModel(StreamingModule):
         # if self.out_norm:
         #     out = self.out_norm(out.to(self.out_norm.weight.data.dtype))
         if K > 1:
-            fused_input2 = torch.cat([fused_input2, output.hidden_states], dim=-1)
+            hidden_states = output.hidden_states
+            if sub_batch_size is not None:
+                fused_input2 = fused_input2[:sub_batch_size]
+                hidden_states = hidden_states[:sub_batch_size]
+                attention_mask = None if attention_mask is None else attention_mask[:sub_batch_size]
+                position_ids = None if position_ids is None else position_ids[:sub_batch_size]
+            fused_input2 = torch.cat([fused_input2, hidden_states], dim=-1)
             fused_input2 = self.mlp(fused_input2)
             output2 = self.transformer2(inputs_embeds=fused_input2, 
+                                           attention_mask=attention_mask,
+                                           position_ids=position_ids,
                                            use_cache=self._is_streaming, 
                                            past_key_values=self._streaming_state.get('past_key_values_2', None))
             if self._is_streaming:
                 self._streaming_state['past_key_values_2'] = output2.past_key_values
             
             res_logits = torch.stack([self.linears[k](output2.hidden_states) for k in range(K - 1)], dim=1)  # [B, K, S, card] # [B, K, S, card]
+            if sub_batch_size is not None:
+                res_logits = res_logits.repeat(B // sub_batch_size, 1, 1, 1)
             logits = torch.cat([logits, res_logits], dim=1)  # [B, K, S, card]
         
         # remove the prefix from the model outputs
@@ -350,7 +583,17 @@ class LmModel(StreamingModule):
                  cfg_coef: tp.Optional[float] = None,
                  check: bool = False,        
                  record_tokens: bool = True,
-                 record_window: int = 150
+                 record_window: int = 150,
+                 static_kv_cache: bool = True,
+                 cfg_mode: str = 'full',
+                 cfg_cutoff_step: int = 0,
+                 cfg_reuse_interval: int = 1,
+                 compile_decode: bool = False,
+                 prefix_cache: bool = False,
+                 speculative_steps: int = 0,
+                 speculative_ngram: int = 4,
+                 on_timesteps: tp.Optional[tp.Callable[[torch.Tensor], None]] = None,
+                 on_timesteps_interval: int = 25,
                  ) -> torch.Tensor:
         """Generate tokens sampling from the model given a prompt or unconditionally. Generation can
         be perform in a greedy fashion or using sampling with top K and top P strategies.
@@ -358,7 +601,8 @@ class LmModel(StreamingModule):
         Args:
             prompt (torch.Tensor, optional): Prompt tokens of shape [B, K, T].
             conditions_tensors (list of ConditioningAttributes, optional): List of conditions.
-            num_samples (int, optional): Number of samples to generate when no prompt and no conditions are given.
+            num_samples (int, optional): Number of independent takes of the song, decoded as one batch that
+                shares the conditions and the prefill of the prepended conditions. Takes end independently.
             max_gen_len (int): Maximum generation length.
             use_sampling (bool): Whether to use a sampling strategy or not.
             temp (float): Sampling temperature.
@@ -367,9 +611,45 @@ class LmModel(StreamingModule):
             cfg_coeff (float, optional): Classifier-free guidance coefficient.
             check (bool): Whether to apply further checks on generated sequence.
             callback (Callback, optional): Callback function to report generation progress.
+            static_kv_cache (bool): Whether to decode with preallocated KV caches written in place
+                instead of caches grown by concatenation at every step.
+            cfg_mode (str): How the unconditional branch of CFG is executed, one of:
+                'full': both branches at every step (reference quality, 2x the compute of unguided decoding);
+                'cutoff': both branches for the first `cfg_cutoff_step` steps only, unguided afterwards.
+                    Compute tends to 1/2 of 'full' for long songs; the opening that sets style and
+                    structure stays guided while the adherence to the prompt may weaken later on;
+                'first_codebook': the unconditional branch skips `transformer2`, so only the first
+                    codebook is guided. Saves the sub-transformer half of the unconditional pass
+                    (~15% of 'full' with 28 + 12 layers); vocal/bgm tokens follow the guided first codebook;
+                'reuse': unconditional logits are refreshed every `cfg_reuse_interval` steps and reused in
+                    between; the unconditional KV cache catches up on the skipped steps in a single forward.
+                    Same FLOPs, but ~1/k of the unconditional forwards, which dominate a bandwidth-bound
+                    decode; guidance uses stale unconditional logits, their drift is reported.
+                The tradeoff of the last generation is printed and kept in `self.last_cfg_stats`.
+            cfg_cutoff_step (int): Number of guided steps for the 'cutoff' mode.
+            cfg_reuse_interval (int): Refresh interval of the unconditional logits for the 'reuse' mode.
+            compile_decode (bool): Whether to capture the decoding step after the prompt in a CUDA graph
+                and replay it, removing the per-step kernel launch overhead. Needs a CUDA device,
+                the static KV cache and 'full' CFG, falls back to eager decoding otherwise.
+            prefix_cache (bool): Whether to keep the state after the first step (the prefill of the
+                prepended conditions) in `self.prefix_cache` and restore it, instead of running the prefill
+                again, when the same lyrics, descriptions and prompt are generated again.
+            speculative_steps (int): If positive, up to that many steps are proposed by an n-gram draft
+                over the generated tokens and verified in a single forward, see `SpeculativeDecoder`.
+                Samples follow the same distribution as regular decoding. Needs the 'full' CFG mode and
+                is not combined with `compile_decode`.
+            speculative_ngram (int): Context length of the n-gram draft.
+            on_timesteps (callable, optional): Called during the generation with the codes [B, K, T'] of the
+                timesteps completed so far for every codebook (with the delays of the pattern, timestep t
+                is complete once its most delayed codebook is generated), whenever at least
+                `on_timesteps_interval` more timesteps are complete. Lets a consumer decode the song
+                while it is generated; the codes are on the CPU and the final ones are returned as usual.
+            on_timesteps_interval (int): Minimum number of newly completed timesteps between two calls.
         Returns:
             torch.Tensor: Generated tokens.
         """
+        assert cfg_mode in CFG_MODES, f"unknown cfg_mode {cfg_mode}, expected one of {CFG_MODES}"
+        assert cfg_reuse_interval >= 1, "cfg_reuse_interval should be at least 1"
         assert not self.training, "generation shouldn't be used in training mode."
         first_param = next(iter(self.parameters()))
         device = first_param.device
@@ -387,10 +667,14 @@ class LmModel(StreamingModule):
         assert [x == possible_num_samples[0] for x in possible_num_samples], "Inconsistent inputs shapes"
         num_samples = possible_num_samples[0]
         condition_tensors = self.prepare_condition_tensors(batch_size=1, text=texts, descriptions=descriptions, audio_qt_emb=audio_qt_embs, prepare_null_condition=True)
+        if num_samples > 1:
+            # independent takes of the same song share the conditions
+            condition_tensors = self.expand_condition_tensors(condition_tensors, num_samples)
         # 3) Prepare token pool
         record_token_pool = None
         if record_tokens:
-            record_token_pool = []
+            record_token_pool = RepetitionPenaltyBuffer(num_samples, self.code_depth, record_window,
+                                                        self.eos_token_id, device)
             
         # 4) set up startoff patterns
         start_offset = 0
@@ -412,9 +696,32 @@ class LmModel(StreamingModule):
         is_end = torch.zeros((B, self.code_depth, 1)).bool().to(device)
         ignore_tokens = audio_qt_embs[0][0]
         ignore_tokens = ignore_tokens[ignore_tokens < 16384]
+        cfg_state = CFGState(mode=cfg_mode, cutoff_step=cfg_cutoff_step, reuse_interval=cfg_reuse_interval,
+                             num_takes=num_samples)
+        if prefix_cache:
+            cfg_state.prefix_key = content_hash(texts, descriptions, audio_qt_embs, cfg_mode)
+        if compile_decode and not DecodeStepGraph.is_supported(device, cfg_mode, static_kv_cache):
+            print(f"compile_decode needs a CUDA device, static_kv_cache and cfg_mode 'full' "
+                  f"(got {device.type}, {static_kv_cache}, '{cfg_mode}'), decoding eagerly")
+            compile_decode = False
+        if speculative_steps > 0 and (cfg_mode != 'full' or compile_decode):
+            print("speculative decoding needs cfg_mode 'full' and no compile_decode, decoding step by step")
+            speculative_steps = 0
+        graph_step = None
+        speculative = None
+        if speculative_steps > 0:
+            speculative = SpeculativeDecoder(
+                self, NGramDraft(speculative_ngram), speculative_steps, condition_tensors,
+                use_sampling, temp, top_k, top_p, cfg_coef, sampled_token_pool=record_token_pool,
+                ignore_tokens=ignore_tokens, cfg_state=cfg_state)
+        pending_tokens: tp.List[torch.Tensor] = []
+        num_reported = 0
+        start_time = time.time()
         # 5) auto-regressive sampling
         with self.streaming():
             gen_sequence_len = gen_sequence.shape[-1]  # gen_sequence shape is [B, K, S]
+            if static_kv_cache:
+                self.init_static_kv_cache(gen_sequence_len, condition_tensors)
             prev_offset = 0
             for offset in tqdm(range(start_offset_sequence, gen_sequence_len)):
                 # get current sequence (note that the streaming API is providing the caching over previous offsets)
@@ -426,12 +733,22 @@ class LmModel(StreamingModule):
                     # should never happen as gen_sequence is filled progressively
                     assert not (curr_sequence == unknown_token).any()
                 # sample next token from the model, next token shape is [B, K, 1]
-                next_token = self._sample_next_token(
-                    curr_sequence, condition_tensors, use_sampling, temp, top_k, top_p,
-                    cfg_coef=cfg_coef, 
-                    sampled_token_pool=record_token_pool[-record_window:] if record_tokens else None,
-                    ignore_tokens = ignore_tokens
-                    )
+                if pending_tokens:
+                    # accepted by the previous speculative step, already in the KV caches
+                    next_token = pending_tokens.pop(0)
+                elif speculative is not None and cfg_state.step > 0:
+                    next_token, *pending_tokens = speculative.step(curr_sequence, gen_sequence, mask,
+                                                                   offset, is_end)
+                elif graph_step is not None:
+                    next_token = graph_step(curr_sequence)
+                else:
+                    next_token = self._sample_next_token(
+                        curr_sequence, condition_tensors, use_sampling, temp, top_k, top_p,
+                        cfg_coef=cfg_coef, 
+                        sampled_token_pool=record_token_pool,
+                        ignore_tokens = ignore_tokens,
+                        cfg_state=cfg_state,
+                        )
                 # ensure the tokens that should be masked are properly set to special_token_id
                 # as the model never output special_token_id
                 valid_mask = mask[..., offset:offset+1].expand(B, -1, -1)
@@ -447,12 +764,53 @@ class LmModel(StreamingModule):
                 
                 # record sampled tokens in a window
                 if record_tokens:
-                    record_token_pool.append(next_token.squeeze())
+                    record_token_pool.push(next_token)
                 if torch.all(is_end):
                     gen_sequence = gen_sequence[..., :offset+1]
                     break
+                if on_timesteps is not None:
+                    num_complete = pattern.get_num_complete_timesteps(offset)
+                    if num_complete - num_reported >= on_timesteps_interval:
+                        codes, _, _ = pattern.revert_pattern_sequence(gen_sequence, special_token=unknown_token)
+                        on_timesteps(codes[..., :num_complete].cpu())
+                        num_reported = num_complete
+                if compile_decode and graph_step is None:
+                    # the prompt step is done, every following step has the same shapes
+                    graph_step = DecodeStepGraph(
+                        self, gen_sequence[..., offset:offset+1],
+                        condition_tensors=condition_tensors, use_sampling=use_sampling,
+                        temp=temp, top_k=top_k, top_p=top_p, cfg_coef=cfg_coef,
+                        sampled_token_pool=record_token_pool, ignore_tokens=ignore_tokens,
+                        cfg_state=cfg_state)
                 prev_offset = offset
-                
+
+        self.last_cfg_stats = cfg_state.summary(self.transformer.config.num_hidden_layers,
+                                                self.transformer2.config.num_hidden_layers,
+                                                time.time() - start_time)
+        if speculative is not None:
+            self.last_speculative_stats = speculative.stats
+            print(f"speculative decoding: {speculative.stats['generated']} steps in "
+                  f"{speculative.stats['forwards']} forwards, "
+                  f"acceptance rate {speculative.stats['acceptance_rate']:.2f}")
+        if cfg_mode != 'full':
+            print(f"CFG mode '{cfg_mode}': {self.last_cfg_stats['forwards']} forwards for "
+                  f"{self.last_cfg_stats['steps']} steps, "
+                  f"{self.last_cfg_stats['relative_compute']:.2f}x the compute of full CFG, "
+                  f"unconditional drift (KL) {self.last_cfg_stats['uncond_drift_kl']:.4f}, "
+                  f"{self.last_cfg_stats['elapsed']:.1f}s")
+        return self.revert_generated_sequence(pattern, gen_sequence, output_codes, unknown_token)
+
+    def revert_generated_sequence(self, pattern, gen_sequence: torch.Tensor,
+                                  output_codes: torch.Tensor, unknown_token: int = -1) -> torch.Tensor:
+        """Map a (possibly early-stopped) generated pattern sequence back to codes of shape [B, K, T].
+
+        Args:
+            pattern (Pattern): Pattern used to build the generated sequence.
+            gen_sequence (torch.Tensor): Generated pattern sequence [B, K, S'], S' <= S.
+            output_codes (torch.Tensor): Full-length [B, K, S] sequence filled with `code_size`,
+                written in place with `gen_sequence`.
+            unknown_token (int): Token marking positions that were not generated.
+        """
         # ensure sequence has been entirely filled
         assert not (gen_sequence == unknown_token).any()
         max_gen_len = gen_sequence.shape[-1]
@@ -471,6 +829,53 @@ class LmModel(StreamingModule):
         assert (out_codes >= 0).all() and (out_codes <= self.code_size).all()
         return out_codes      
     
+    def expand_condition_tensors(self, condition_tensors: ConditionTensors, num_samples: int) -> ConditionTensors:
+        """Repeat every row of the conditions (conditional rows then null rows) `num_samples` times."""
+        return {attr: tuple(None if x is None else x.repeat_interleave(num_samples, dim=0) for x in cond)
+                for attr, cond in condition_tensors.items()}
+
+    def get_prepend_length(self, condition_tensors: ConditionTensors) -> int:
+        """Number of positions the fuser prepends to the input on the first streaming step."""
+        return sum(condition_tensors[cond][0].shape[1]
+                   for cond in self.fuser.fuse2cond.get('prepend', []) if cond in condition_tensors)
+
+    def init_static_kv_cache(self, gen_sequence_len: int, condition_tensors: ConditionTensors):
+        """Preallocate the KV caches of both transformers for a whole generation and expose them
+        through the streaming state, where `forward` picks them up and writes them in place.
+
+        Args:
+            gen_sequence_len (int): Length of the pattern sequence that will be decoded.
+            condition_tensors (dict[str, ConditionType]): Conditions used for the generation,
+                needed to account for the prepended conditions.
+        """
+        assert self._is_streaming, "static KV cache can only be used in streaming mode"
+        max_len = self.get_prepend_length(condition_tensors) + gen_sequence_len
+        self._streaming_state['past_key_values_1'] = StaticKVCache(
+            self.transformer.config.num_hidden_layers, max_len)
+        if self.code_depth > 1:
+            self._streaming_state['past_key_values_2'] = StaticKVCache(
+                self.transformer2.config.num_hidden_layers, max_len)
+
+    def snapshot_prefix_state(self) -> tp.Dict[str, tp.Any]:
+        """Copy of the streaming state with compact KV caches, to be restored by `restore_prefix_state`."""
+        state = self.get_streaming_state()
+        for key in ['past_key_values_1', 'past_key_values_2']:
+            if key in state:
+                state[key] = _snapshot_kv_cache(state[key])
+        return state
+
+    def restore_prefix_state(self, state: tp.Dict[str, tp.Any], repeats: int = 1):
+        """Restore a state from `snapshot_prefix_state`, KV caches are rebuilt with the same kind
+        (and capacity) as the current ones so that the snapshot itself is never written to.
+        With `repeats` > 1, every row of the snapshot is repeated for as many consecutive rows."""
+        state = dict(state)
+        for key, value in state.items():
+            if key in ['past_key_values_1', 'past_key_values_2']:
+                state[key] = _restore_kv_cache(value, self._streaming_state.get(key), repeats)
+            elif repeats > 1 and isinstance(value, torch.Tensor):
+                state[key] = value.repeat_interleave(repeats, dim=0)
+        self.set_streaming_state(state)
+
     def _sample_next_token(self,
                            sequence: torch.Tensor,
                            condition_tensors: ConditionTensors,
@@ -479,8 +884,9 @@ class LmModel(StreamingModule):
                            top_k: int = 0,
                            top_p: float = 0.0,
                            cfg_coef: tp.Optional[float] = None,
-                           sampled_token_pool: tp.Optional[list] = None,
-                           ignore_tokens: tp.Optional[torch.tensor] = torch.tensor([])) -> torch.Tensor:
+                           sampled_token_pool: tp.Optional[RepetitionPenaltyBuffer] = None,
+                           ignore_tokens: tp.Optional[torch.tensor] = torch.tensor([]),
+                           cfg_state: tp.Optional[CFGState] = None) -> torch.Tensor:
         """Sample next token from the model given a sequence and a set of conditions. The model supports
         multiple sampling strategies (greedy sampling, softmax, top-k, top-p...).
 
@@ -495,35 +901,174 @@ class LmModel(StreamingModule):
             top_k (int): K for "top-k" sampling.
             top_p (float): P for "top-p" sampling.
             cfg_coef (float, optional): classifier free guidance coefficient
+            cfg_state (CFGState, optional): CFG execution mode and its state, full CFG if not given.
         Returns:
             next_token (torch.Tensor): Next token tensor of shape [B, K, 1].
         """
         # import pdb; pdb.set_trace()
         B = sequence.shape[0]
         cfg_coef = self.cfg_coef if cfg_coef is None else cfg_coef
-        model = self if self._fsdp is None else self._fsdp
+        cfg_state = CFGState() if cfg_state is None else cfg_state
         
-        # Preparing for CFG, predicting both conditional and unconditional logits.
-        sequence = torch.cat([sequence, sequence], dim=0)
-        all_logits = model(sequence, condition_tensors=condition_tensors)
-        cond_logits, uncond_logits = all_logits.split(B, dim=0)  # [B, K, T, card]
-        logits = uncond_logits + (cond_logits - uncond_logits) * cfg_coef
+        cond_logits, uncond_logits = self._cfg_logits(sequence, condition_tensors, cfg_state)
+        cfg_state.step += 1
+        if uncond_logits is None:
+            logits = cond_logits
+        else:
+            logits = uncond_logits + (cond_logits - uncond_logits) * cfg_coef
 
         logits = logits.permute(0, 1, 3, 2)  # [B, K, card, T]
         logits = logits[..., -1]  # [B x K x card]
         
+        self._penalize_logits(logits, sampled_token_pool, ignore_tokens)
+        return self._sample_from_logits(logits, use_sampling, temp, top_k, top_p)
+
+    def _cfg_logits(self, sequence: torch.Tensor, condition_tensors: ConditionTensors,
+                    cfg_state: CFGState) -> tp.Tuple[torch.Tensor, tp.Optional[torch.Tensor]]:
+        """Run the conditional and, depending on the CFG mode, unconditional branches.
+        Returns conditional and unconditional logits [B, K, T, card], the latter being None
+        when the step is not guided. The first step always runs both branches on the doubled
+        batch as the conditions are prepended to both of them."""
+        B, _, S = sequence.shape
+        model = self if self._fsdp is None else self._fsdp
+        mode = cfg_state.mode
+        guided = mode != 'cutoff' or cfg_state.step < cfg_state.cutoff_step
+        if cfg_state.step == 0:
+            return self._prefill_logits(model, sequence, condition_tensors, cfg_state, guided)
+        if mode != 'reuse' and guided:
+            # Preparing for CFG, predicting both conditional and unconditional logits.
+            sub_batch_size = B if mode == 'first_codebook' else None
+            all_logits = model(torch.cat([sequence, sequence], dim=0), condition_tensors=condition_tensors,
+                               sub_batch_size=sub_batch_size)
+            cfg_state.count(2 * B * S, (B if sub_batch_size else 2 * B) * S, 2 * B * S)
+            cond_logits, uncond_logits = all_logits.split(B, dim=0)  # [B, K, T, card]
+            return cond_logits, uncond_logits if guided else None
+
+        if cfg_state.caches is None:
+            # from now on the conditional and unconditional rows are decoded separately
+            cond_caches, uncond_caches = {}, {}
+            for key in ['past_key_values_1', 'past_key_values_2']:
+                cond_caches[key], uncond_caches[key] = _split_kv_cache_rows(self._streaming_state.get(key), B)
+            cfg_state.caches = {'cond': cond_caches, 'uncond': uncond_caches}
+
+        cond_logits = self._forward_with_caches(model, sequence, condition_tensors, cfg_state.caches['cond'])
+        if mode == 'cutoff':
+            cfg_state.count(B * S, B * S, 2 * B * S)
+            return cond_logits, None
+
+        # 'reuse': the unconditional rows catch up with the skipped steps every `reuse_interval` steps
+        cfg_state.uncond_pending.append(sequence)
+        refresh = cfg_state.step % cfg_state.reuse_interval == 0
+        if refresh:
+            pending = torch.cat(cfg_state.uncond_pending, dim=-1)
+            cfg_state.uncond_pending = []
+            uncond_logits = self._forward_with_caches(model, pending, condition_tensors,
+                                                      cfg_state.caches['uncond'])[:, :, -1:]
+            stale = cfg_state.uncond_logits
+            if stale is not None:
+                # drift of the reused unconditional distribution of the first codebook
+                fresh_log_probs = torch.log_softmax(uncond_logits[:, 0, -1].float(), dim=-1)
+                stale_log_probs = torch.log_softmax(stale[:, 0, -1].float(), dim=-1)
+                kl = F.kl_div(stale_log_probs, fresh_log_probs, log_target=True, reduction='batchmean')
+                cfg_state.drift_sum += kl.item()
+                cfg_state.drift_count += 1
+            cfg_state.uncond_logits = uncond_logits
+        cfg_state.count(B * S + (B * pending.shape[-1] if refresh else 0),
+                        B * S + (B * pending.shape[-1] if refresh else 0), 2 * B * S)
+        return cond_logits, cfg_state.uncond_logits
+
+    def _prefill_logits(self, model, sequence: torch.Tensor, condition_tensors: ConditionTensors,
+                        cfg_state: CFGState, guided: bool) -> tp.Tuple[torch.Tensor, tp.Optional[torch.Tensor]]:
+        """First step of `_cfg_logits`, both branches on the doubled batch with the prepended conditions.
+        The `cfg_state.num_takes` takes of a song share their conditions and first step, which is run
+        on a single take (or restored from `self.prefix_cache`) and then expanded to all of them."""
+        B, _, S = sequence.shape
+        mode = cfg_state.mode
+        takes = cfg_state.num_takes
+        assert B % takes == 0, f"batch size {B} is not a multiple of the number of takes {takes}"
+        entry = None
+        if cfg_state.prefix_key is not None:
+            entry = self.prefix_cache.get(cfg_state.prefix_key)
+        if entry is None:
+            rows = B // takes
+            if takes > 1:
+                # cond rows then null rows, each repeated `takes` times: keep one of each
+                sequence = sequence[:rows]
+                condition_tensors = {
+                    attr: tuple(None if x is None else x[::takes] for x in cond)
+                    for attr, cond in condition_tensors.items()}
+            sub_batch_size = rows if mode == 'first_codebook' else None
+            all_logits = model(torch.cat([sequence, sequence], dim=0), condition_tensors=condition_tensors,
+                               sub_batch_size=sub_batch_size)
+            cfg_state.count(2 * rows * S, (rows if sub_batch_size else 2 * rows) * S, 2 * rows * S)
+            cond_logits, uncond_logits = all_logits[:, :, -1:].split(rows, dim=0)  # [rows, K, 1, card]
+            if cfg_state.prefix_key is not None or takes > 1:
+                entry = {'state': self.snapshot_prefix_state(),
+                         'logits': (cond_logits.clone(), uncond_logits.clone())}
+            if cfg_state.prefix_key is not None:
+                self.prefix_cache.put(cfg_state.prefix_key, entry['state'], entry['logits'])
+            if takes == 1:
+                # the streaming state just computed is already the one of the single take
+                entry = None
+        if entry is not None:
+            self.restore_prefix_state(entry['state'], repeats=takes)
+            cond_logits, uncond_logits = (x.repeat_interleave(takes, dim=0) for x in entry['logits'])
+        if mode == 'reuse':
+            cfg_state.uncond_logits = uncond_logits
+        return cond_logits, uncond_logits if guided else None
+
+    def _forward_with_caches(self, model, sequence: torch.Tensor, condition_tensors: ConditionTensors,
+                             caches: tp.Dict[str, tp.Any]) -> torch.Tensor:
+        """Run the model on a subset of the rows, whose KV caches are swapped in the streaming state."""
+        for key, cache in caches.items():
+            self._streaming_state[key] = cache
+        logits = model(sequence, condition_tensors=condition_tensors)
+        for key in caches:
+            caches[key] = self._streaming_state.get(key)
+        return logits
+
+    def _penalize_logits(self,
+                         logits: torch.Tensor,
+                         sampled_token_pool: tp.Optional[RepetitionPenaltyBuffer] = None,
+                         ignore_tokens: tp.Optional[torch.tensor] = None):
+        """Apply the repetition penalty over recently sampled tokens and mask the prompt tokens
+        of the first codebook, in place on logits of shape [B, K, card]."""
         # add punishment to pre-sampled tokens
-        if sampled_token_pool is not None and len(sampled_token_pool) > 0:
-            sampled_token_pool = torch.stack(sampled_token_pool, -1) # [K, T]
-            for q in range(self.code_depth):
-                # q_count = torch.bincount(sampled_token_pool)
-                q_count = torch.bincount(torch.unique(sampled_token_pool[q]))
-                tmp = min(q_count.shape[-1], self.code_size - 1) 
-                logits[:, q, :tmp] /= (1.1 ** q_count[:tmp])
+        if sampled_token_pool is not None:
+            sampled_token_pool.penalize_(logits)
 
-        # Apply softmax for sampling if temp > 0. Else, do greedy sampling to avoid zero division error.
         if(ignore_tokens is not None and len(ignore_tokens) > 0):
-            logits[0][0][ignore_tokens.to(torch.int)] = float('-inf')
+            logits[:, 0, ignore_tokens.to(torch.long)] = float('-inf')
+
+    def _sampling_probs(self,
+                        logits: torch.Tensor,
+                        use_sampling: bool = False,
+                        temp: float = 1.0,
+                        top_k: int = 0,
+                        top_p: float = 0.0) -> torch.Tensor:
+        """Distribution of shape [B, K, card] that `_sample_from_logits` samples from."""
+        if not (use_sampling and temp > 0.0):
+            return F.one_hot(torch.argmax(logits, dim=-1), logits.shape[-1]).to(logits.dtype)
+        probs = torch.softmax(logits / temp, dim=-1)
+        if top_p > 0.0:
+            probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
+            mask = torch.cumsum(probs_sort, dim=-1) - probs_sort > top_p
+            probs = torch.zeros_like(probs).scatter(-1, probs_idx, probs_sort * (~mask).float())
+        elif top_k > 0:
+            # top_k on the first codebook, top 1 on the others
+            min_first = torch.topk(probs[:, :1], top_k, dim=-1).values[..., -1:]
+            min_res = probs[:, 1:].max(dim=-1, keepdim=True).values
+            probs = probs * (probs >= torch.cat([min_first, min_res], dim=1)).float()
+        return probs / probs.sum(dim=-1, keepdim=True)
+
+    def _sample_from_logits(self,
+                            logits: torch.Tensor,
+                            use_sampling: bool = False,
+                            temp: float = 1.0,
+                            top_k: int = 0,
+                            top_p: float = 0.0) -> torch.Tensor:
+        """Sample tokens of shape [B, K, 1] from logits of shape [B, K, card]."""
+        # Apply softmax for sampling if temp > 0. Else, do greedy sampling to avoid zero division error.
         if use_sampling and temp > 0.0:
             probs = torch.softmax(logits / temp, dim=-1)
             if top_p > 0.0:
@@ -0,0 +1,191 @@
+"""
+Speculative decoding of the pattern sequence for `LmModel.generate`.
+"""
+
+import typing as tp
+
+import torch
+
+from codeclm.models.llama.modeling_llama import StaticKVCache
+from codeclm.utils.utils import multinomial
+
+
+class NGramDraft:
+    """Draft proposing the next pattern steps from the history of the song itself: the last `ngram`
+    tokens of the first codebook are looked up in the already generated steps and the steps that
+    followed their latest earlier occurrence are proposed, for all codebooks. Songs repeat themselves
+    (chorus, riffs), which is where drafts get accepted.
+
+    Args:
+        ngram (int): Length of the matched context.
+    """
+    def __init__(self, ngram: int = 4):
+        assert ngram >= 1, "ngram should be at least 1"
+        self.ngram = ngram
+
+    def propose(self, gen_sequence: torch.Tensor, offset: int, num_steps: int) -> tp.Optional[torch.Tensor]:
+        """Propose steps [offset, offset + num_steps) of `gen_sequence` [B, K, S], whose steps before
+        `offset` are generated. Returns None unless every row has a match."""
+        n = self.ngram
+        num_candidates = offset - num_steps - n + 1
+        if num_steps < 1 or num_candidates < 1:
+            return None
+        B, K, _ = gen_sequence.shape
+        history = gen_sequence[:, 0, :offset]
+        context = history[:, -n:]
+        # candidate p matches if history[p:p+n] == context and its continuation is generated
+        windows = history[:, :offset - num_steps].unfold(-1, n, 1)  # [B, num_candidates, n]
+        match = (windows == context[:, None]).all(dim=-1)
+        positions = torch.arange(num_candidates, device=gen_sequence.device)
+        last = torch.where(match, positions, -1).max(dim=-1).values
+        if not bool((last >= 0).all()):
+            return None
+        index = (last + n)[:, None] + torch.arange(num_steps, device=gen_sequence.device)
+        return gen_sequence.gather(-1, index[:, None, :].expand(-1, K, -1))
+
+
+def _rewind_kv_cache(cache, num_tokens: int):
+    if cache is None or num_tokens == 0:
+        return cache
+    if isinstance(cache, StaticKVCache):
+        cache.rewind(num_tokens)
+        return cache
+    return tuple((k[:, :, :-num_tokens], v[:, :, :-num_tokens]) for k, v in cache)
+
+
+class SpeculativeDecoder:
+    """Decode several pattern steps per forward of `LmModel` with a draft and exact acceptance.
+
+    The draft proposes the next steps, the full model (both transformers, with CFG) scores the last
+    generated step followed by the proposed ones in a single forward, and proposed tokens are accepted
+    with probability p(x), p being the distribution `LmModel._sample_from_logits` samples from
+    (CFG, repetition penalty over the tokens accepted so far, top-k/top-p and temperature). The first
+    rejected token is replaced by a sample of p with the draft token removed, so every token follows
+    the distribution of regular decoding. All rows stop at the first step with a rejection, and the
+    rejected positions are dropped from the KV caches. Greedy codebooks (top-k of 1) only accept the
+    argmax.
+
+    Args:
+        lm (LmModel): Language model, in streaming mode, after the first step.
+        draft (NGramDraft): Draft proposing the next steps.
+        num_steps (int): Maximum number of proposed steps per forward.
+        condition_tensors (dict[str, ConditionType]): Conditions of the generation.
+        use_sampling, temp, top_k, top_p, cfg_coef: Sampling parameters, see `LmModel.generate`.
+        sampled_token_pool (RepetitionPenaltyBuffer, optional): Window of the repetition penalty,
+            only read here, generated tokens are pushed by the caller.
+        ignore_tokens (torch.Tensor, optional): Prompt tokens masked out of the first codebook.
+        cfg_state (CFGState): CFG bookkeeping, only the 'full' mode is supported.
+    """
+    def __init__(self, lm, draft: NGramDraft, num_steps: int, condition_tensors,
+                 use_sampling: bool, temp: float, top_k: int, top_p: float, cfg_coef: tp.Optional[float],
+                 sampled_token_pool=None, ignore_tokens: tp.Optional[torch.Tensor] = None, cfg_state=None):
+        assert num_steps >= 1, "num_steps should be at least 1"
+        assert cfg_state is None or cfg_state.mode == 'full', "speculative decoding needs the 'full' CFG mode"
+        self.lm = lm
+        self.draft = draft
+        self.num_steps = num_steps
+        self.condition_tensors = condition_tensors
+        self.use_sampling = use_sampling
+        self.temp = temp
+        self.top_k = top_k
+        self.top_p = top_p
+        self.cfg_coef = lm.cfg_coef if cfg_coef is None else cfg_coef
+        self.sampled_token_pool = sampled_token_pool
+        self.ignore_tokens = ignore_tokens
+        self.cfg_state = cfg_state
+        self.forwards = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.generated = 0
+
+    @property
+    def stats(self) -> tp.Dict[str, float]:
+        return {
+            'forwards': self.forwards,
+            'generated': self.generated,
+            'tokens_per_forward': self.generated / max(self.forwards, 1),
+            'acceptance_rate': self.accepted / max(self.proposed, 1),
+        }
+
+    def step(self, sequence: torch.Tensor, gen_sequence: torch.Tensor, mask: torch.Tensor,
+             offset: int, is_end: torch.Tensor) -> tp.List[torch.Tensor]:
+        """Generate the tokens of steps `offset`, `offset + 1`, ... of the pattern sequence.
+
+        Args:
+            sequence (torch.Tensor): Last generated step [B, K, 1], not in the KV caches yet.
+            gen_sequence (torch.Tensor): Pattern sequence [B, K, S], generated up to `offset`.
+            mask (torch.Tensor): Pattern mask [K, S] of the valid positions.
+            offset (int): Step to generate.
+            is_end (torch.Tensor): Codebooks that reached EOS [B, K, 1].
+        Returns:
+            list of torch.Tensor: Tokens [B, K, 1] of the consecutive steps, at least one, to be
+                processed by the caller exactly as regular samples (masking, EOS, penalty window).
+        """
+        lm = self.lm
+        B, K, _ = sequence.shape
+        num_steps = min(self.num_steps, gen_sequence.shape[-1] - 1 - offset)
+        draft = self.draft.propose(gen_sequence, offset, num_steps)
+        if draft is None:
+            self.forwards += 1
+            self.generated += 1
+            return [lm._sample_next_token(sequence, self.condition_tensors, self.use_sampling, self.temp,
+                                          self.top_k, self.top_p, cfg_coef=self.cfg_coef,
+                                          sampled_token_pool=self.sampled_token_pool,
+                                          ignore_tokens=self.ignore_tokens, cfg_state=self.cfg_state)]
+
+        # the draft as the caller would write it: masked positions and ended codebooks are forced
+        draft = draft.clone()
+        forced = []
+        is_end = is_end.clone()
+        for j in range(num_steps):
+            forced_j = ~mask[None, :, offset + j:offset + j + 1].expand(B, -1, -1) | is_end
+            draft[..., j:j + 1][forced_j] = lm.special_token_id
+            is_end = is_end | (draft[..., j:j + 1] == lm.eos_token_id)
+            forced.append(forced_j[..., 0])
+
+        model = lm if lm._fsdp is None else lm._fsdp
+        steps = torch.cat([sequence, draft], dim=-1)
+        S = steps.shape[-1]
+        all_logits = model(torch.cat([steps, steps], dim=0), condition_tensors=self.condition_tensors)
+        if self.cfg_state is not None:
+            self.cfg_state.count(2 * B * S, 2 * B * S, 2 * B * S)
+        cond_logits, uncond_logits = all_logits.split(B, dim=0)
+        logits = uncond_logits + (cond_logits - uncond_logits) * self.cfg_coef  # [B, K, S, card]
+        card = logits.shape[-1]
+
+        pool = None if self.sampled_token_pool is None else self.sampled_token_pool.clone()
+        tokens = []
+        for j in range(S):
+            step_logits = logits[:, :, j].contiguous()
+            lm._penalize_logits(step_logits, pool, self.ignore_tokens)
+            probs = lm._sampling_probs(step_logits, self.use_sampling, self.temp, self.top_k, self.top_p)
+            if j == num_steps:
+                # every proposed step was accepted, the last position gives one more step
+                tokens.append(multinomial(probs, num_samples=1))
+                break
+            proposal = draft[..., j].clamp(max=card - 1)[..., None]  # [B, K, 1]
+            p_proposal = probs.gather(-1, proposal)[..., 0]
+            accept = forced[j] | (torch.rand_like(p_proposal) < p_proposal)
+            if bool(accept.all()):
+                tokens.append(draft[..., j:j + 1])
+                if pool is not None:
+                    pool.push(draft[..., j:j + 1])
+                continue
+            residual = probs.scatter(-1, proposal, 0.)
+            residual = residual / residual.sum(dim=-1, keepdim=True).clamp_min(1e-20)
+            resampled = multinomial(residual, num_samples=1)
+            tokens.append(torch.where(accept[..., None], draft[..., j:j + 1], resampled))
+            break
+
+        # positions of the rejected proposals were written to the caches, drop them
+        rejected = num_steps - (len(tokens) - 1)
+        for key in ['past_key_values_1', 'past_key_values_2']:
+            if key in lm._streaming_state:
+                lm._streaming_state[key] = _rewind_kv_cache(lm._streaming_state[key], rejected)
+        if self.cfg_state is not None:
+            self.cfg_state.step += len(tokens)
+        self.forwards += 1
+        self.proposed += num_steps
+        self.accepted += len(tokens) - 1
+        self.generated += len(tokens)
+        return tokens
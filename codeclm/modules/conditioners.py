@@ -7,9 +7,9 @@ from itertools import chain
 import warnings
 import torch.nn.functional as F
 from torch.nn.utils.rnn import pad_sequence
-from codeclm.utils.utils import length_to_mask, collate
+from codeclm.utils.utils import length_to_mask, collate, content_hash
 from codeclm.modules.streaming import StreamingModule
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from copy import deepcopy
 ConditionType = tp.Tuple[torch.Tensor, torch.Tensor]  # condition, mask
 
@@ -293,13 +293,21 @@ class QuantizedEmbeddingConditioner(AudioConditioner):
 class ConditionerProvider(nn.Module):
     """Prepare and provide conditions given all the supported conditioners.
 
+    Encoded conditions are kept in a content-addressed LRU cache at inference, see `get_conditions`.
+
     Args:
         conditioners (dict): Dictionary of conditioners.
         device (torch.device or str, optional): Device for conditioners and output condition types.
+        cache_size (int): Maximum number of encoded condition batches kept in the cache, 0 disables it.
     """
-    def __init__(self, conditioners: tp.Dict[str, BaseConditioner]):
+    def __init__(self, conditioners: tp.Dict[str, BaseConditioner], cache_size: int = 16):
         super().__init__()
         self.conditioners = nn.ModuleDict(conditioners)
+        assert cache_size >= 0, "cache_size should be non negative"
+        self.cache_size = cache_size
+        self._cache: tp.OrderedDict[str, tp.Dict[str, ConditionType]] = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     @property
     def text_conditions(self):
@@ -359,6 +367,46 @@ class ConditionerProvider(nn.Module):
             output[attribute] = (condition1, condition2, mask)
         return output
 
+    def get_conditions(self, inputs: tp.List[ConditioningAttributes]) -> tp.Dict[str, ConditionType]:
+        """Tokenize and encode a batch of conditions, the whole batch (e.g. conditional and null
+        halves for CFG) being looked up in the cache first. The key hashes the texts and the prompt
+        tokens of every sample, so repeated lyrics, descriptions and prompts skip conditioning.
+        Cached tensors are shared between requests and should not be modified in place.
+
+        Args:
+            inputs (list[ConditioningAttributes]): List of ConditioningAttributes objects containing
+                text and audio conditions.
+        """
+        if self.training or self.cache_size == 0:
+            return self(self.tokenize(inputs))
+        key = self.cache_key(inputs)
+        if key in self._cache:
+            self.cache_hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        self.cache_misses += 1
+        with torch.no_grad():
+            condition_tensors = self(self.tokenize(inputs))
+        self._cache[key] = condition_tensors
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return condition_tensors
+
+    def cache_key(self, inputs: tp.List[ConditioningAttributes]) -> str:
+        """Content hash of a batch of conditions."""
+        return content_hash([(sample.text, {attribute: audio.wav for attribute, audio in sample.audio.items()})
+                             for sample in inputs])
+
+    def clear_cache(self):
+        self._cache.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @property
+    def cache_stats(self) -> tp.Dict[str, int]:
+        return {'hits': self.cache_hits, 'misses': self.cache_misses,
+                'size': len(self._cache), 'capacity': self.cache_size}
+
     def _collate_text(self, samples: tp.List[ConditioningAttributes]) -> tp.Dict[str, tp.List[tp.Optional[str]]]:
         """Given a list of ConditioningAttributes objects, compile a dictionary where the keys
         are the attributes and the values are the aggregated input per attribute.
@@ -1,3 +1,4 @@
+import bisect
 from collections import namedtuple
 from dataclasses import dataclass
 from functools import lru_cache
@@ -47,6 +48,7 @@ class Pattern:
         self._validate_layout()
         self._build_reverted_sequence_scatter_indexes = lru_cache(100)(self._build_reverted_sequence_scatter_indexes)
         self._build_pattern_sequence_scatter_indexes = lru_cache(100)(self._build_pattern_sequence_scatter_indexes)
+        self._complete_steps: tp.Optional[tp.List[int]] = None
         logger.info("New pattern, time steps: %d, sequence steps: %d", self.timesteps, len(self.layout))
 
     def _validate_layout(self):
@@ -109,6 +111,22 @@ class Pattern:
         steps_with_timesteps = self.get_steps_with_timestep(t, q)
         return steps_with_timesteps[0] if len(steps_with_timesteps) > 0 else None
 
+    def get_num_complete_timesteps(self, step: int) -> int:
+        """Number of leading timesteps whose codes, for every codebook, are at sequence steps <= `step`,
+        i.e. the timesteps that can be reverted once the sequence is generated up to `step`.
+        """
+        if self._complete_steps is None:
+            # last sequence step of each timestep, made non-decreasing over the timesteps
+            last_steps = [0] * self.timesteps
+            for s, seq_coords in enumerate(self.layout):
+                for coord in seq_coords:
+                    if coord.t < self.timesteps:
+                        last_steps[coord.t] = max(last_steps[coord.t], s)
+            for t in range(1, self.timesteps):
+                last_steps[t] = max(last_steps[t], last_steps[t - 1])
+            self._complete_steps = last_steps
+        return bisect.bisect_right(self._complete_steps, step)
+
     def _build_pattern_sequence_scatter_indexes(self, timesteps: int, 
                                                 code_depth: int, 
                                                 keep_only_valid_steps: bool,
@@ -0,0 +1,82 @@
+import argparse
+import os
+import time
+import torch,torchaudio
+
+from generate_septoken import Tango
+
+# A/B of guidance schedules of the flow matching decoder: a song is tokenized once, then decoded
+# with full guidance (A) and with every guidance interval given (B), from the same noise. Reports
+# the estimator evaluations and batch rows of each run, the rows saved against A and how far the
+# audio of B is from the one of A.
+
+def read_wav(fname, sample_rate=48_000):
+    orig_samples, fs = torchaudio.load(fname)
+    if(fs!=sample_rate):
+        orig_samples = torchaudio.functional.resample(orig_samples, fs, sample_rate)
+    if orig_samples.shape[0] == 1:
+        orig_samples = torch.cat([orig_samples, orig_samples], 0)
+    return orig_samples
+
+def snr(reference, estimate):
+    length = min(reference.shape[-1], estimate.shape[-1])
+    reference, estimate = reference[..., :length], estimate[..., :length]
+    return 10 * torch.log10(reference.pow(2).sum() / (reference - estimate).pow(2).sum().clamp_min(1e-12)).item()
+
+def log_mel_distance(reference, estimate, sample_rate=48_000):
+    length = min(reference.shape[-1], estimate.shape[-1])
+    mel = torchaudio.transforms.MelSpectrogram(sample_rate, n_fft=2048, hop_length=480, n_mels=128)
+    ref_mel, est_mel = mel(reference[..., :length]), mel(estimate[..., :length])
+    return (ref_mel.clamp_min(1e-5).log10() - est_mel.clamp_min(1e-5).log10()).abs().mean().item()
+
+def decode(tango, codes, args, guidance_interval):
+    torch.manual_seed(args.seed)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.time()
+    wav = tango.code2sound(codes, guidance_scale=args.guidance_scale, num_steps=args.num_steps, disable_progress=True,
+                           solver=args.solver, t_schedule=args.t_schedule, guidance_interval=guidance_interval)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    # a guided evaluation runs the estimator over twice the rows of an unguided one
+    return wav, {'time': time.time() - start, 'nfe': tango.last_nfe, 'nfe_guided': tango.last_nfe_guided,
+                 'rows': tango.last_nfe + tango.last_nfe_guided}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--vae_config", type=str, required=True)
+    parser.add_argument("--vae_model", type=str, required=True)
+    parser.add_argument("--vocal", type=str, required=True, help="vocal stem of the song")
+    parser.add_argument("--bgm", type=str, required=True, help="accompaniment stem of the song")
+    parser.add_argument("--intervals", type=str, nargs='+', default=["0.0,0.8", "0.0,0.6", "0.2,0.8"],
+                        help="guided intervals T_START,T_END of the B runs (t=0 is the noise)")
+    parser.add_argument("--guidance_scale", type=float, default=1.5)
+    parser.add_argument("--num_steps", type=int, default=50)
+    parser.add_argument("--solver", type=str, default="euler")
+    parser.add_argument("--t_schedule", type=str, default="linear")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out_dir", type=str, default=None, help="keep the decoded audio of every run")
+    args = parser.parse_args()
+
+    tango = Tango(model_path=args.model_path, vae_config=args.vae_config, vae_model=args.vae_model, device="cuda:0")
+    codes = list(tango.sound2code(read_wav(args.vocal), read_wav(args.bgm)))
+    if(args.out_dir is not None):
+        os.makedirs(args.out_dir, exist_ok=True)
+
+    runs = [("A", (0., 1.))] + [("B" + str(i), tuple(float(t) for t in interval.split(','))) for i, interval in enumerate(args.intervals)]
+    reference, reference_stats = None, None
+    print(f"{'run':<4} {'interval':<12} {'time':>8} {'nfe':>6} {'guided':>7} {'rows':>6} {'saved':>7} {'snr_db':>8} {'mel_l1':>8}")
+    for name, interval in runs:
+        wav, stats = decode(tango, codes, args, interval)
+        wav = wav.float().cpu()
+        if(reference is None):
+            reference, reference_stats = wav, stats
+            saved, snr_db, mel_l1 = 0., float('inf'), 0.
+        else:
+            saved = 1 - stats['rows'] / reference_stats['rows']
+            snr_db, mel_l1 = snr(reference, wav), log_mel_distance(reference, wav)
+        print(f"{name:<4} {str(interval):<12} {stats['time']:>7.2f}s {stats['nfe']:>6} {stats['nfe_guided']:>7} {stats['rows']:>6} "
+              f"{saved:>6.1%} {snr_db:>8.2f} {mel_l1:>8.4f}")
+        if(args.out_dir is not None):
+            torchaudio.save(os.path.join(args.out_dir, f"{name}.flac"), wav, tango.sample_rate)
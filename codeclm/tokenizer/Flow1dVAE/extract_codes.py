@@ -0,0 +1,185 @@
+import argparse
+import json
+import os
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import torch,torchaudio
+from tqdm import tqdm
+
+from audio import AudioFile
+from tools.token_store import TokenShardWriter, completed_keys
+
+# Extraction of the codes of a jsonl of songs into a token store (see tools/token_store.py), in place of the
+# extract_codes_stereo_7_* scripts. Items are dealt round robin to num_jobs x len(gpus) workers, one process per
+# gpu, each appending to its own shard of out_dir, while a thread pool decodes the audio of the next items. Items
+# already in a shard of out_dir are skipped: a stopped extraction resumes by running it again, with any num_jobs.
+#   python extract_codes.py --jsonl songs.jsonl --out_dir codes --mode 1x1_and_sep --gpus 0,1,2,3 \
+#       --vae_config <vae config> --vae_model <vae model>
+# Modes and rows of the codes of an item:
+#   1x1_and_sep  first codebook of the 2rvq tokenizer of the mix, then the vocal and bgm septokens (3 rows)
+#   1x1_sep      vocal and bgm septokens of the stems vocal_path / bgm_path of the item, separated if missing (2 rows)
+#   1x2, 1x4     2rvq / 4rvq tokenizer of the mix (2 / 4 rows)
+#   1x4_ds       4rvq tokenizer of the mix, downsampled by --ds (4 rows)
+
+SAMPLE_RATE = 48_000
+MODES = ['1x1_and_sep', '1x1_sep', '1x2', '1x4', '1x4_ds']
+
+def read_wav(fname, sample_rate=SAMPLE_RATE):
+    try:
+        orig_samples, fs = torchaudio.load(fname)
+    except:
+        af = AudioFile(fname)
+        orig_samples = af.read()
+        fs = af.samplerate()
+        orig_samples = orig_samples[0]
+    if(fs!=sample_rate):
+        orig_samples = torchaudio.functional.resample(orig_samples, fs, sample_rate)
+    if orig_samples.shape[0] == 1:
+        orig_samples = torch.cat([orig_samples, orig_samples], 0)
+    return orig_samples
+
+def resolve_path(path, path_root):
+    # relative paths of the catalog are tried as given, then under path_root
+    if(os.path.exists(path) or path_root is None):
+        return path
+    return os.path.join(path_root, path)
+
+def item_key(item):
+    return str(item['idx']) if 'idx' in item else item['path']
+
+def read_items(jsonl):
+    with open(jsonl) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def load_item(item, args):
+    """Audio of an item: the vocal and bgm stems of the item in 1x1_sep mode if it has them, the mix otherwise."""
+    if(args.mode == '1x1_sep' and 'vocal_path' in item):
+        vocal = read_wav(resolve_path(item['vocal_path'], args.path_root))
+        bgm = sum([read_wav(resolve_path(p, args.path_root)) for p in item['bgm_path']])
+        return {'vocal': vocal, 'bgm': bgm}
+    return {'mix': read_wav(resolve_path(item['path'], args.path_root))}
+
+def decode_ahead(items, load, num_threads, depth):
+    """(item, future of load(item)) in the order of items, with up to depth items loading ahead of the consumer."""
+    with ThreadPoolExecutor(num_threads) as pool:
+        pending = deque()
+        for item in items:
+            pending.append((item, pool.submit(load, item)))
+            if(len(pending) > depth):
+                yield pending.popleft()
+        while(len(pending) > 0):
+            yield pending.popleft()
+
+class Extractor:
+    def __init__(self, args, device):
+        self.mode = args.mode
+        self.ds = args.ds
+        self.device = device
+        if(self.mode in ('1x1_and_sep', '1x1_sep')):
+            from generate_septoken import Tango as Tango_sep
+            from third_party.demucs.models.pretrained import get_model_from_yaml
+            self.tango_sep = Tango_sep(model_path=args.model_sep, vae_config=args.vae_config, vae_model=args.vae_model, device=device)
+            self.demucs_model = get_model_from_yaml(args.demucs_config, args.demucs_model).to(device).eval()
+        if(self.mode in ('1x1_and_sep', '1x2')):
+            from generate_2rvq import Tango as Tango_1x2
+            self.tango_1x2 = Tango_1x2(model_path=args.model_1x2, rvq_num=2, device=device)
+        if(self.mode in ('1x4', '1x4_ds')):
+            from generate_4rvq import Tango as Tango_1x4
+            self.tango_1x4 = Tango_1x4(model_path=args.model_1x4, rvq_num=4, device=device)
+
+    def separate(self, mix):
+        from codeclm.utils.separation import separate_sources
+        sources = separate_sources(self.demucs_model, mix, SAMPLE_RATE, self.device)
+        if(self.demucs_model.samplerate != SAMPLE_RATE):
+            sources = torchaudio.functional.resample(sources, self.demucs_model.samplerate, SAMPLE_RATE)
+        vocal = sources[self.demucs_model.sources.index('vocals')]
+        # bgm is the sum of the other sources (drums, bass, other)
+        return vocal, sources.sum(0) - vocal
+
+    @torch.no_grad()
+    def __call__(self, audio):
+        """Codes [R, T] of the audio of an item."""
+        if(self.mode == '1x2'):
+            codes = self.tango_1x2.sound2code(audio['mix'])
+        elif(self.mode == '1x4'):
+            codes = self.tango_1x4.sound2code(audio['mix'])
+        elif(self.mode == '1x4_ds'):
+            codes = self.tango_1x4.sound2code_ds(audio['mix'], self.ds)
+        else:
+            if('vocal' in audio):
+                vocal, bgm = audio['vocal'], audio['bgm']
+            else:
+                vocal, bgm = self.separate(audio['mix'])
+            codes = list(self.tango_sep.sound2code(vocal, bgm))
+            if(self.mode == '1x1_and_sep'):
+                codes = [self.tango_1x2.sound2code(audio['mix'])[:, [0], :]] + codes
+            # the stems can be a few samples shorter than the mix after the resampling of the separation
+            length = min(c.shape[-1] for c in codes)
+            codes = torch.cat([c[..., :length] for c in codes], 1)
+        return codes[0].cpu().numpy()
+
+def run_worker(local_rank, args, gpus):
+    rank = args.job_id * len(gpus) + local_rank
+    world_size = args.num_jobs * len(gpus)
+    device = "cuda:{}".format(gpus[local_rank])
+    torch.cuda.set_device(device)
+
+    done = completed_keys(args.out_dir)
+    todo, seen = [], set()
+    for item in read_items(args.jsonl)[rank::world_size]:
+        key = item_key(item)
+        if(key not in done and key not in seen):
+            todo.append(item)
+            seen.add(key)
+    print("worker {}/{} on {}: {} items to extract".format(rank, world_size, device, len(todo)))
+    if(len(todo) == 0):
+        return
+
+    extractor = Extractor(args, device)
+    prefix = os.path.join(args.out_dir, "shard_{:05d}-of-{:05d}".format(rank, world_size))
+    num_failed = 0
+    loader = decode_ahead(todo, lambda item: load_item(item, args), args.num_loaders, args.prefetch)
+    with TokenShardWriter(prefix) as writer, open(prefix + '.failed', 'a') as failed:
+        for item, audio in tqdm(loader, total=len(todo), position=local_rank, desc="worker {}".format(rank)):
+            try:
+                codes = extractor(audio.result())
+            except Exception:
+                # kept out of the shard, so a rerun tries the item again
+                num_failed += 1
+                failed.write(json.dumps({'key': item_key(item), 'path': item.get('path'), 'error': traceback.format_exc()}) + '\n')
+                failed.flush()
+                continue
+            writer.write(item_key(item), codes)
+    print("worker {}/{}: {} items failed, see {}.failed".format(rank, world_size, num_failed, prefix))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jsonl", type=str, required=True, help="catalog, one json per line with idx and path (and vocal_path, bgm_path)")
+    parser.add_argument("--out_dir", type=str, required=True, help="directory of the token store")
+    parser.add_argument("--mode", type=str, default="1x1_and_sep", choices=MODES)
+    parser.add_argument("--gpus", type=str, default="0", help="gpus of this job, one worker process each")
+    parser.add_argument("--num_jobs", type=int, default=1, help="jobs sharing the catalog, e.g. one per node")
+    parser.add_argument("--job_id", type=int, default=0)
+    parser.add_argument("--num_loaders", type=int, default=4, help="audio decoding threads per worker")
+    parser.add_argument("--prefetch", type=int, default=8, help="items decoded ahead of the gpu per worker")
+    parser.add_argument("--path_root", type=str, default="/mnt/share/", help="root of the paths not found as given")
+    parser.add_argument("--model_sep", type=str, default="./saved/model_septoken/model_2.safetensors")
+    parser.add_argument("--model_1x2", type=str, default="./saved/model_2rvq/model_2_fixed.safetensors")
+    parser.add_argument("--model_1x4", type=str, default="./saved/model_4rvq/model_2_fixed.safetensors")
+    parser.add_argument("--vae_config", type=str, default=None)
+    parser.add_argument("--vae_model", type=str, default=None)
+    parser.add_argument("--demucs_model", type=str, default="demucs/ckpt/htdemucs.pth")
+    parser.add_argument("--demucs_config", type=str, default="demucs/ckpt/htdemucs.yaml")
+    parser.add_argument("--ds", type=int, default=1, help="downsampling of the 1x4_ds mode")
+    args = parser.parse_args()
+    assert 0 <= args.job_id < args.num_jobs, (args.job_id, args.num_jobs)
+    if(args.mode in ('1x1_and_sep', '1x1_sep')):
+        assert args.vae_config is not None and args.vae_model is not None, "the septoken tokenizer needs --vae_config and --vae_model"
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    gpus = [int(gpu) for gpu in args.gpus.split(',')]
+    if(len(gpus) == 1):
+        run_worker(0, args, gpus)
+    else:
+        torch.multiprocessing.spawn(run_worker, args=(args, gpus), nprocs=len(gpus))
@@ -10,6 +10,9 @@ import math
 import numpy as np
 from tools.get_1dvae_large import get_model
 import tools.torch_tools as torch_tools
+from tools.overlap_add import OverlapAdd
+from tools.shared_models import SHARED_MODELS, acquire_vae, release_vae, bestrq_key, checkpoint_digest
+from our_MERT_BESTRQ.test import load_model
 from safetensors.torch import load_file
 
 class Tango:
@@ -24,9 +27,9 @@ class Tango:
         scheduler_name = "configs/scheduler/stable_diffusion_2.1_largenoise_sample.json"
         self.device = device
 
-        self.vae = get_model(vae_config, vae_model)
-        self.vae = self.vae.to(device)
-        self.vae=self.vae.eval()
+        # one VAE per process, shared with the other tokenizers (see tools/shared_models.py)
+        self.vae_source = (vae_config, vae_model, device)
+        self.vae = acquire_vae(vae_config, vae_model, device)
         self.layer_num = layer_num
 
         self.MAX_DURATION = 360
@@ -36,11 +39,23 @@ class Tango:
             "unet_model_config_path":"configs/models/transformer2D_wocross_inch112_1x4_multi_large.json",
             "snr_gamma":None,
         }
-        self.model = PromptCondAudioDiffusion(**main_config).to(device)
         if model_path.endswith(".safetensors"):
             main_weights = load_file(model_path)
         else:
             main_weights = torch.load(model_path, map_location=device)
+        # BEST-RQ with the same weights as another tokenizer of the process is shared with it: taken from
+        # the registry before the model is built, so that it is only loaded if no tokenizer has it yet
+        bestrq_weights = {k[len('bestrq.'):]: main_weights.pop(k) for k in list(main_weights) if k.startswith('bestrq.')}
+        self.bestrq_digest = checkpoint_digest(model_path, 'bestrq', bestrq_weights) if len(bestrq_weights) > 0 else None
+        bestrq_source = PromptCondAudioDiffusion.bestrq_source
+        self.bestrq_key = bestrq_key(digest=self.bestrq_digest, device=device, **bestrq_source)
+        def build_bestrq():
+            bestrq = load_model(**bestrq_source)
+            bestrq.load_state_dict(bestrq_weights, strict=False)
+            return bestrq.to(device)
+        bestrq = SHARED_MODELS.acquire(self.bestrq_key, build_bestrq)
+        del bestrq_weights
+        self.model = PromptCondAudioDiffusion(**main_config, bestrq=bestrq).to(device)
         self.model.load_state_dict(main_weights, strict=False)
         print ("Successfully loaded checkpoint from:", model_path)
         
@@ -92,6 +107,14 @@ class Tango:
     #         output = torch.cat([saved_samples.detach().cpu(),audio[0].detach().cpu()],0)
     #     return output
 
+    def release(self):
+        # drop the shared VAE and BEST-RQ, the Tango is unusable afterwards
+        if(self.vae is not None):
+            self.vae = None
+            release_vae(*self.vae_source)
+            del self.model.bestrq
+            SHARED_MODELS.release(self.bestrq_key)
+
     @torch.no_grad()
     @torch.autocast(device_type="cuda", dtype=torch.float32)
     def sound2code(self, orig_samples, batch_size=3):
@@ -130,7 +153,7 @@ class Tango:
         return codes
 
     @torch.no_grad()
-    def code2sound(self, codes, prompt=None, duration=40, guidance_scale=1.5, num_steps=20, disable_progress=False):
+    def code2sound(self, codes, prompt=None, duration=40, guidance_scale=1.5, num_steps=20, disable_progress=False, pin_memory=False):
         codes = codes.to(self.device)
 
         min_samples = int(duration * 25) # 40ms per frame
@@ -220,21 +243,10 @@ class Tango:
         hop_samples = int(hop_samples * self.sample_rate // 1000 * 40)
         ovlp_samples = min_samples - hop_samples
         with torch.no_grad():
-            output = None
-            for i in range(len(latent_list)):
-                latent = latent_list[i]
-                cur_output = self.vae.decode_audio(latent)[0].detach().cpu()
-
-                if output is None:
-                    output = cur_output
-                else:
-                    ov_win = torch.from_numpy(np.linspace(0, 1, ovlp_samples)[None, :])
-                    ov_win = torch.cat([ov_win, 1 - ov_win], -1)
-                    print("output.shape", output.shape)
-                    print("ov_win.shape", ov_win.shape)
-                    output[:, -ovlp_samples:] = output[:, -ovlp_samples:] * ov_win[:, -ovlp_samples:] + cur_output[:, 0:ovlp_samples] * ov_win[:, 0:ovlp_samples]
-                    output = torch.cat([output, cur_output[:, ovlp_samples:]], -1)
-            output = output[:, 0:target_len]
+            stitcher = OverlapAdd(target_len, ovlp_samples, pin_memory=pin_memory)
+            for latent in latent_list:
+                stitcher.add(self.vae.decode_audio(latent)[0].detach())
+            output = stitcher.result()
         return output
 
     @torch.no_grad()
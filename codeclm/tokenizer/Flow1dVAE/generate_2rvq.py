@@ -11,6 +11,7 @@ import numpy as np
 # from tools.get_mulan import get_mulan
 from tools.get_1dvae_large import get_model
 import tools.torch_tools as torch_tools
+from tools.overlap_add import OverlapAdd
 from safetensors.torch import load_file
 from audio import AudioFile
 import kaldiio
@@ -140,7 +141,7 @@ class Tango:
         return codes
 
     @torch.no_grad()
-    def code2sound(self, codes, prompt=None, duration=40, guidance_scale=1.5, num_steps=20, disable_progress=False):
+    def code2sound(self, codes, prompt=None, duration=40, guidance_scale=1.5, num_steps=20, disable_progress=False, pin_memory=False):
         codes = codes.to(self.device)
 
         min_samples = duration * 25 # 40ms per frame
@@ -227,21 +228,10 @@ class Tango:
         hop_samples = int(hop_samples * self.sample_rate // 1000 * 40)
         ovlp_samples = min_samples - hop_samples
         with torch.no_grad():
-            output = None
-            for i in range(len(latent_list)):
-                latent = latent_list[i]
-                cur_output = self.vae.decode_audio(latent)[0].detach().cpu()
-
-                if output is None:
-                    output = cur_output
-                else:
-                    ov_win = torch.from_numpy(np.linspace(0, 1, ovlp_samples)[None, :])
-                    ov_win = torch.cat([ov_win, 1 - ov_win], -1)
-                    print("output.shape", output.shape)
-                    print("ov_win.shape", ov_win.shape)
-                    output[:, -ovlp_samples:] = output[:, -ovlp_samples:] * ov_win[:, -ovlp_samples:] + cur_output[:, 0:ovlp_samples] * ov_win[:, 0:ovlp_samples]
-                    output = torch.cat([output, cur_output[:, ovlp_samples:]], -1)
-            output = output[:, 0:target_len]
+            stitcher = OverlapAdd(target_len, ovlp_samples, pin_memory=pin_memory)
+            for latent in latent_list:
+                stitcher.add(self.vae.decode_audio(latent)[0].detach())
+            output = stitcher.result()
         return output
 
     @torch.no_grad()
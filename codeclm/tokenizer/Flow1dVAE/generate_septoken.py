@@ -1,28 +1,34 @@
 import json
 import torch
 from tqdm import tqdm
-from model_septoken import PromptCondAudioDiffusion
+from model_septoken import PromptCondAudioDiffusion, GuidanceSchedule
 from diffusers import DDIMScheduler, DDPMScheduler
 import torchaudio
 import librosa
 import os
 import math
+import hashlib
+from collections import OrderedDict
 import numpy as np
 # from tools.get_mulan import get_mulan
 from tools.get_1dvae_large import get_model
 import tools.torch_tools as torch_tools
+from tools.overlap_add import OverlapAdd, crossfade_window
+from tools.shared_models import acquire_vae, release_vae
 from safetensors.torch import load_file
 from third_party.demucs.models.pretrained import get_model_from_yaml
+from codeclm.utils.separation import StemCache, separate_prompt
 from filelock import FileLock
 import kaldiio
 # os.path.join(args.model_dir, "htdemucs.pth"), os.path.join(args.model_dir, "htdemucs.yaml")
 class Separator:
-    def __init__(self, dm_model_path='demucs/ckpt/htdemucs.pth', dm_config_path='demucs/ckpt/htdemucs.yaml', gpu_id=0) -> None:
+    def __init__(self, dm_model_path='demucs/ckpt/htdemucs.pth', dm_config_path='demucs/ckpt/htdemucs.yaml', gpu_id=0, stem_cache_dir=None) -> None:
         if torch.cuda.is_available() and gpu_id < torch.cuda.device_count():
             self.device = torch.device(f"cuda:{gpu_id}")
         else:
             self.device = torch.device("cpu")
         self.demucs_model = self.init_demucs_model(dm_model_path, dm_config_path)
+        self.stem_cache = StemCache(stem_cache_dir)
 
     def init_demucs_model(self, model_path, config_path):
         model = get_model_from_yaml(config_path, model_path)
@@ -41,30 +47,46 @@ class Separator:
         # return a[:, 0:48000*10]
         return a
     
-    def run(self, audio_path, output_dir='demucs/test_output', ext=".flac"):
-        name, _ = os.path.splitext(os.path.split(audio_path)[-1])
-        output_paths = []
-        # lock_path = os.path.join(output_dir, f"{name}.lock")
-        # with FileLock(lock_path):  # 加一个避免多卡访问时死锁
-        for stem in self.demucs_model.sources:
-            output_path = os.path.join(output_dir, f"{name}_{stem}{ext}")
-            if os.path.exists(output_path):
-                output_paths.append(output_path)
-        if len(output_paths) == 1:  # 4
-            # drums_path, bass_path, other_path, vocal_path = output_paths
-            vocal_path = output_paths[0]
-        else:
-            lock_path = os.path.join(output_dir, f"{name}_separate.lock")
-            with FileLock(lock_path):
-                drums_path, bass_path, other_path, vocal_path = self.demucs_model.separate(audio_path, output_dir, device=self.device)
-        full_audio = self.load_audio(audio_path)
-        vocal_audio = self.load_audio(vocal_path)
-        minlen = min(full_audio.shape[-1], vocal_audio.shape[-1])
-        # bgm_audio = full_audio[:, 0:minlen] - vocal_audio[:, 0:minlen]
-        bgm_audio = self.load_audio(drums_path) + self.load_audio(bass_path) + self.load_audio(other_path)
-        for path in [drums_path, bass_path, other_path, vocal_path]:
-            os.remove(path)
-        return full_audio, vocal_audio, bgm_audio
+    def run(self, audio_path):
+        # 30s cover the prompt windows of Tango.prepare_prompt
+        return separate_prompt(self.demucs_model, audio_path, self.device, seconds=30, fit=False, cache=self.stem_cache)
+
+class PromptCache(object):
+    """
+    LRU cache of the features of the prompts (in-context VAE latents, codes), keyed by the content
+    hash of the prompt audio and the window of samples the features are computed on. Songs reusing
+    a reference track skip the VAE encoder and BEST-RQ, and the tokens of the prompt for the LM are
+    shared with the codes of the prompt for the decoder. Cached tensors must not be modified.
+    """
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def make_key(audios, window):
+        hasher = hashlib.sha1()
+        hasher.update("window{};".format(tuple(window)).encode())
+        for audio in audios:
+            hasher.update("{},{};".format(tuple(audio.shape), audio.dtype).encode())
+            hasher.update(audio.detach().cpu().contiguous().numpy().tobytes())
+        return hasher.hexdigest()
+
+    def get_or_compute(self, key, compute):
+        if(key in self._entries):
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.misses += 1
+        value = compute()
+        self._entries[key] = value
+        while(len(self._entries) > self.max_entries):
+            self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self._entries.clear()
 
 class Tango:
     def __init__(self, \
@@ -73,15 +95,20 @@ class Tango:
         vae_model,
         layer_vocal=7,\
         layer_bgm=3,\
-        device="cuda:0"):
+        device="cuda:0",
+        encoder_loading='lazy',
+        attn_implementation=None):
+        # encoder_loading: BEST-RQ / HuBERT loading, 'lazy' builds them the first time a prompt is tokenized,
+        # 'decode_only' never builds them, 'eager' builds them here (see PromptCondAudioDiffusion)
+        # attn_implementation: 'sdpa' for the fused attention of the estimator, eager by default
         
         self.sample_rate = 48000
         scheduler_name = "configs/scheduler/stable_diffusion_2.1_largenoise_sample.json"
         self.device = device
 
-        self.vae = get_model(vae_config, vae_model)
-        self.vae = self.vae.to(device)
-        self.vae=self.vae.eval()
+        # one VAE per process, shared with the other tokenizers (see tools/shared_models.py)
+        self.vae_source = (vae_config, vae_model, device)
+        self.vae = acquire_vae(vae_config, vae_model, device)
         self.layer_vocal=layer_vocal
         self.layer_bgm=layer_bgm
 
@@ -91,6 +118,8 @@ class Tango:
             "unet_model_name":None,
             "unet_model_config_path":"configs/models/transformer2D_wocross_inch112_1x4_multi_large.json",
             "snr_gamma":None,
+            "encoder_loading":encoder_loading,
+            "attn_implementation":attn_implementation,
         }
         self.model = PromptCondAudioDiffusion(**main_config).to(device)
         if model_path.endswith(".safetensors"):
@@ -109,7 +138,19 @@ class Tango:
         # self.scheduler = DDPMScheduler.from_pretrained( \
         #     scheduler_name, subfolder="scheduler")
         print("Successfully loaded inference scheduler from {}".format(scheduler_name))
+        self.prompt_cache = PromptCache()
+
 
+    def release_encoders(self):
+        # free BEST-RQ / HuBERT once the prompts are tokenized, they are loaded again if needed
+        self.model.release_encoders()
+
+    def release(self):
+        # drop the shared VAE and encoders, the Tango is unusable afterwards
+        self.release_encoders()
+        if(self.vae is not None):
+            self.vae = None
+            release_vae(*self.vae_source)
 
     @torch.no_grad()
     @torch.autocast(device_type="cuda", dtype=torch.float32)
@@ -172,21 +213,28 @@ class Tango:
 
         return codes_vocal, codes_bgm
 
-    @torch.no_grad()
-    def code2sound(self, codes, prompt_vocal=None, prompt_bgm=None, duration=40, guidance_scale=1.5, num_steps=20, disable_progress=False, chunked=False):
-        codes_vocal,codes_bgm = codes
-        codes_vocal = codes_vocal.to(self.device)
-        codes_bgm = codes_bgm.to(self.device)
+    def sound2code_cached(self, orig_vocal, orig_bgm):
+        """sound2code of one prompt [C, T] (or [1, C, T]) through self.prompt_cache."""
+        if(orig_vocal.ndim == 3):
+            assert orig_vocal.shape[0] == 1, orig_vocal.shape
+            orig_vocal, orig_bgm = orig_vocal[0], orig_bgm[0]
+        key = self.prompt_cache.make_key([orig_vocal, orig_bgm], (0, orig_vocal.shape[-1]))
+        return self.prompt_cache.get_or_compute(('codes', key), lambda: self.sound2code(orig_vocal, orig_bgm))
 
+    @torch.no_grad()
+    def prepare_prompt(self, prompt_vocal=None, prompt_bgm=None, duration=40):
+        """
+        Prompt of one song for prepare_song: a dict with first_latent (the first window, starting
+        with the latent of the prompt), first_latent_length and the codes_vocal, codes_bgm of the
+        prompt (None without prompt).
+        """
         min_samples = duration * 25 # 40ms per frame
-        hop_samples = min_samples // 4 * 3
-        ovlp_samples = min_samples - hop_samples
-        hop_frames = hop_samples
-        ovlp_frames = ovlp_samples
-        first_latent = torch.randn(codes_vocal.shape[0], min_samples, 64).to(self.device)
-        first_latent_length = 0
-        first_latent_codes_length = 0
-
+        prompt = {
+            'first_latent': torch.randn(1, min_samples, 64).to(self.device),
+            'first_latent_length': 0,
+            'codes_vocal': None,
+            'codes_bgm': None,
+        }
 
         if(isinstance(prompt_vocal, torch.Tensor)):
             # prepare prompt
@@ -206,24 +254,47 @@ class Tango:
 
             if(prompt_vocal.shape[-1] < int(30 * self.sample_rate)):
                 # if less than 30s, just choose the first 10s
-                prompt_vocal = prompt_vocal[:,:int(10*self.sample_rate)] # limit max length to 10.24
-                prompt_bgm = prompt_bgm[:,:int(10*self.sample_rate)] # limit max length to 10.24
+                window = (0, int(10*self.sample_rate)) # limit max length to 10.24
             else:
                 # else choose from 20.48s which might includes verse or chorus
-                prompt_vocal = prompt_vocal[:,int(20*self.sample_rate):int(30*self.sample_rate)] # limit max length to 10.24
-                prompt_bgm = prompt_bgm[:,int(20*self.sample_rate):int(30*self.sample_rate)] # limit max length to 10.24
+                window = (int(20*self.sample_rate), int(30*self.sample_rate)) # limit max length to 10.24
+            window = (window[0], min(window[1], prompt_vocal.shape[-1]))
+            # the whole prompt is hashed, a prompt shorter than the window shares the codes of the LM prompt
+            key = self.prompt_cache.make_key([prompt_vocal, prompt_bgm], window)
+            prompt_vocal = prompt_vocal[:,window[0]:window[1]]
+            prompt_bgm = prompt_bgm[:,window[0]:window[1]]
             
-            true_latent = self.vae.encode_audio(prompt_vocal+prompt_bgm).permute(0,2,1)
-            
-            first_latent[:,0:true_latent.shape[1],:] = true_latent
-            first_latent_length = true_latent.shape[1]
-            first_latent_codes = self.sound2code(prompt_vocal, prompt_bgm)
-            first_latent_codes_vocal = first_latent_codes[0]
-            first_latent_codes_bgm = first_latent_codes[1]
-            first_latent_codes_length = first_latent_codes_vocal.shape[-1]
-            codes_vocal = torch.cat([first_latent_codes_vocal, codes_vocal], -1)
-            codes_bgm = torch.cat([first_latent_codes_bgm, codes_bgm], -1)
+            true_latent = self.prompt_cache.get_or_compute(('latent', key), lambda: self.vae.encode_audio(prompt_vocal+prompt_bgm).permute(0,2,1))
             
+            prompt['first_latent'][:,0:true_latent.shape[1],:] = true_latent
+            prompt['first_latent_length'] = true_latent.shape[1]
+            first_latent_codes = self.prompt_cache.get_or_compute(('codes', key), lambda: self.sound2code(prompt_vocal, prompt_bgm))
+            prompt['codes_vocal'] = first_latent_codes[0]
+            prompt['codes_bgm'] = first_latent_codes[1]
+        return prompt
+
+    def prepare_song(self, codes, prompt_vocal=None, prompt_bgm=None, duration=40, prompt=None):
+        """
+        Codes of one song ready for the windowed diffusion: the codes of the prompt are prepended,
+        the codes are repeated to cover whole windows, and the first window starts from the latent
+        of the prompt. Returns a dict with codes_vocal, codes_bgm [1, 1, T], first_latent,
+        first_latent_length (in-context frames of the first window) and target_len (samples).
+        prompt is the output of prepare_prompt, computed from prompt_vocal / prompt_bgm if not given.
+        """
+        if(prompt is None):
+            prompt = self.prepare_prompt(prompt_vocal, prompt_bgm, duration)
+        codes_vocal,codes_bgm = codes
+        codes_vocal = codes_vocal.to(self.device)
+        codes_bgm = codes_bgm.to(self.device)
+
+        min_samples = duration * 25 # 40ms per frame
+        hop_samples = min_samples // 4 * 3
+        ovlp_samples = min_samples - hop_samples
+        first_latent_codes_length = 0
+        if(prompt['codes_vocal'] is not None):
+            first_latent_codes_length = prompt['codes_vocal'].shape[-1]
+            codes_vocal = torch.cat([prompt['codes_vocal'], codes_vocal], -1)
+            codes_bgm = torch.cat([prompt['codes_bgm'], codes_bgm], -1)
 
         codes_len= codes_vocal.shape[-1]
         target_len = int((codes_len - first_latent_codes_length) / 100 * 4 * self.sample_rate)
@@ -244,47 +315,208 @@ class Tango:
                 codes_bgm = torch.cat([codes_bgm, codes_bgm], -1)
             codes_vocal = codes_vocal[:,:,0:len_codes]
             codes_bgm = codes_bgm[:,:,0:len_codes]
-        latent_length = min_samples
-        latent_list = []
-        spk_embeds = torch.zeros([1, 32, 1, 32], device=codes_vocal.device)
-        with torch.autocast(device_type="cuda", dtype=torch.float16):
-            for sinx in range(0, codes_vocal.shape[-1]-hop_samples, hop_samples):
-                codes_vocal_input=codes_vocal[:,:,sinx:sinx+min_samples]
-                codes_bgm_input=codes_bgm[:,:,sinx:sinx+min_samples]
-                if(sinx == 0):
-                    incontext_length = first_latent_length
-                    latents = self.model.inference_codes([codes_vocal_input,codes_bgm_input], spk_embeds, first_latent, latent_length, incontext_length=incontext_length, additional_feats=[], guidance_scale=1.5, num_steps = num_steps, disable_progress=disable_progress, scenario='other_seg')
-                    latent_list.append(latents)
-                else:
-                    true_latent = latent_list[-1][:,:,-ovlp_frames:].permute(0,2,1)
-                    len_add_to_1000 = min_samples - true_latent.shape[-2]
-                    incontext_length = true_latent.shape[-2]
-                    true_latent = torch.cat([true_latent, torch.randn(true_latent.shape[0],  len_add_to_1000, true_latent.shape[-1]).to(self.device)], -2)
-                    latents = self.model.inference_codes([codes_vocal_input,codes_bgm_input], spk_embeds, true_latent, latent_length, incontext_length=incontext_length,  additional_feats=[], guidance_scale=1.5, num_steps = num_steps, disable_progress=disable_progress, scenario='other_seg')
-                    latent_list.append(latents)
+        return {
+            'codes_vocal': codes_vocal,
+            'codes_bgm': codes_bgm,
+            'first_latent': prompt['first_latent'],
+            'first_latent_length': prompt['first_latent_length'],
+            'target_len': target_len,
+        }
 
+    @torch.no_grad()
+    def latents2sound(self, latent_list, first_latent_length, target_len, duration=40, chunked=False, pin_memory=False):
+        """Decode the latents of the windows of one song with the VAE and crossfade the overlaps, see OverlapAdd."""
+        min_samples = duration * 25
+        hop_samples = min_samples // 4 * 3
         latent_list = [l.float() for l in latent_list]
         latent_list[0] = latent_list[0][:,:,first_latent_length:]
         min_samples =  int(min_samples * self.sample_rate // 1000 * 40)
         hop_samples = int(hop_samples * self.sample_rate // 1000 * 40)
         ovlp_samples = min_samples - hop_samples
-        torch.cuda.empty_cache()
         with torch.no_grad():
-            output = None
-            for i in range(len(latent_list)):
-                latent = latent_list[i]
-                cur_output = self.vae.decode_audio(latent, chunked=chunked)[0].detach().cpu()
-
-                if output is None:
-                    output = cur_output
-                else:
-                    ov_win = torch.from_numpy(np.linspace(0, 1, ovlp_samples)[None, :])
-                    ov_win = torch.cat([ov_win, 1 - ov_win], -1)
-                    output[:, -ovlp_samples:] = output[:, -ovlp_samples:] * ov_win[:, -ovlp_samples:] + cur_output[:, 0:ovlp_samples] * ov_win[:, 0:ovlp_samples]
-                    output = torch.cat([output, cur_output[:, ovlp_samples:]], -1)
-            output = output[:, 0:target_len]
+            stitcher = OverlapAdd(target_len, ovlp_samples, pin_memory=pin_memory)
+            for latent in latent_list:
+                stitcher.add(self.vae.decode_audio(latent, chunked=chunked)[0].detach())
+            output = stitcher.result()
         return output
 
+    @torch.no_grad()
+    def diffuse_window(self, songs, winx, last_latents, duration=40, num_steps=20, disable_progress=False, solver='euler', t_schedule='linear', guidance=None):
+        """
+        Latents [1, 64, frames] of the window winx of each of the songs, in one batch of the flow
+        matching decoder. last_latents are the latents of their previous window (unused for the
+        first one). guidance is the GuidanceSchedule of the solver, a scale of 1.5 on every step by
+        default. The number of estimator evaluations is in self.model.cfm_wrapper.nfe, and of the
+        guided ones in self.model.cfm_wrapper.nfe_guided.
+        """
+        min_samples = duration * 25 # 40ms per frame
+        hop_samples = min_samples // 4 * 3
+        ovlp_frames = min_samples - hop_samples
+        latent_length = min_samples
+        sinx = winx * hop_samples
+        spk_embeds = torch.zeros([1, 32, 1, 32], device=self.device)
+        codes_vocal_input = torch.cat([song['codes_vocal'][:,:,sinx:sinx+min_samples] for song in songs], 0)
+        codes_bgm_input = torch.cat([song['codes_bgm'][:,:,sinx:sinx+min_samples] for song in songs], 0)
+        if(winx == 0):
+            incontext_length = [song['first_latent_length'] for song in songs]
+            true_latent = torch.cat([song['first_latent'] for song in songs], 0)
+        else:
+            true_latent = torch.cat([last_latent[:,:,-ovlp_frames:] for last_latent in last_latents], 0).permute(0,2,1)
+            len_add_to_1000 = min_samples - true_latent.shape[-2]
+            incontext_length = true_latent.shape[-2]
+            true_latent = torch.cat([true_latent, torch.randn(true_latent.shape[0],  len_add_to_1000, true_latent.shape[-1]).to(self.device)], -2)
+        # autocast only around the decoder, the caller runs between the windows
+        with torch.autocast(device_type="cuda", dtype=torch.float16):
+            latents = self.model.inference_codes([codes_vocal_input,codes_bgm_input], spk_embeds, true_latent, latent_length, incontext_length=incontext_length, additional_feats=[], guidance_scale=GuidanceSchedule() if guidance is None else guidance, num_steps = num_steps, disable_progress=disable_progress, scenario='other_seg', solver=solver, t_schedule=t_schedule)
+        return [latents[j:j+1] for j in range(len(songs))]
+
+    @torch.no_grad()
+    def diffuse_windows(self, songs, duration=40, num_steps=20, disable_progress=False, solver='euler', t_schedule='linear', guidance=None):
+        """
+        Run the flow matching decoder over the windows of the songs prepared by prepare_song, the
+        windows at the same index of all songs in one batch. Yields, window after window, the
+        indices of the songs having this window and their latents [1, 64, frames]. Only the last
+        latents of each song are kept, for the in-context part of its next window.
+        """
+        min_samples = duration * 25 # 40ms per frame
+        hop_samples = min_samples // 4 * 3
+        ovlp_frames = min_samples - hop_samples
+        last_latents = [None for _ in songs]
+        num_windows = [(song['codes_vocal'].shape[-1] - ovlp_frames) // hop_samples for song in songs]
+        nfe, nfe_guided = 0, 0
+        for winx in range(max(num_windows)):
+            active = [i for i in range(len(songs)) if num_windows[i] > winx]
+            latents = self.diffuse_window([songs[i] for i in active], winx, [last_latents[i] for i in active],
+                                          duration, num_steps, disable_progress, solver, t_schedule, guidance)
+            nfe += self.model.cfm_wrapper.nfe
+            nfe_guided += self.model.cfm_wrapper.nfe_guided
+            self.last_nfe, self.last_nfe_guided = nfe, nfe_guided
+            for j, i in enumerate(active):
+                last_latents[i] = latents[j]
+            yield active, latents
+        print(f"code2sound: {len(songs)} song(s), {solver} solver, {t_schedule} schedule, {num_steps} steps, {nfe} estimator evaluations ({nfe_guided} guided)")
+
+    def _prepare_songs(self, codes, prompt_vocal, prompt_bgm, duration):
+        if(not isinstance(prompt_vocal, (list, tuple))):
+            prompt_vocal = [prompt_vocal] * len(codes)
+            prompt_bgm = [prompt_bgm] * len(codes)
+        assert len(prompt_vocal) == len(codes) and len(prompt_bgm) == len(codes)
+        return [self.prepare_song(c, pv, pb, duration) for c, pv, pb in zip(codes, prompt_vocal, prompt_bgm)]
+
+    @torch.no_grad()
+    def code2sound(self, codes, prompt_vocal=None, prompt_bgm=None, duration=40, guidance_scale=1.5, num_steps=20, disable_progress=False, chunked=False, solver='euler', t_schedule='linear', pin_memory=False, guidance_interval=(0., 1.)):
+        """
+        codes is the [codes_vocal, codes_bgm] pair of one song, or a list of such pairs of songs of
+        any length, decoded together: the windows at the same index of all songs are stacked in one
+        batch of the estimator, and a list of waveforms is returned. prompt_vocal / prompt_bgm are
+        shared by all songs, or lists with one prompt (or None) per song.
+        solver and t_schedule select the ODE solver and time grid of the flow matching decoder,
+        see BASECFM.solve and make_t_span. guidance_scale (one scale, or one per step) only guides
+        the steps starting in guidance_interval [t_start, t_end] (t=0 is the noise), the others are
+        evaluated unguided at batch 1, see GuidanceSchedule. The number of estimator evaluations of
+        the call is kept in self.last_nfe, and of the guided ones in self.last_nfe_guided. With
+        pin_memory, the waveforms are stitched in pinned host memory.
+        """
+        batched = isinstance(codes[0], (list, tuple))
+        if(not batched):
+            codes = [codes]
+        songs = self._prepare_songs(codes, prompt_vocal, prompt_bgm, duration)
+        latent_lists = [[] for _ in songs]
+        guidance = GuidanceSchedule(guidance_scale, *guidance_interval)
+        for active, latents in self.diffuse_windows(songs, duration, num_steps, disable_progress, solver, t_schedule, guidance):
+            for i, latent in zip(active, latents):
+                latent_lists[i].append(latent)
+
+        torch.cuda.empty_cache()
+        outputs = [self.latents2sound(latent_list, song['first_latent_length'], song['target_len'], duration, chunked, pin_memory)
+                   for latent_list, song in zip(latent_lists, songs)]
+        return outputs if batched else outputs[0]
+
+    @torch.no_grad()
+    def code2sound_stream(self, codes, prompt_vocal=None, prompt_bgm=None, duration=40, guidance_scale=1.5, num_steps=20, disable_progress=False, chunked=False, solver='euler', t_schedule='linear', guidance_interval=(0., 1.)):
+        """
+        Streaming code2sound of one song: every window is decoded by the VAE as soon as the
+        diffusion produced it and the waveform [2, n] is yielded chunk by chunk. A chunk holds the
+        samples that are final, the last overlap of the window is kept back to be crossfaded with
+        the next window. The concatenation of the chunks is the output of code2sound.
+        """
+        song = self._prepare_songs([codes], prompt_vocal, prompt_bgm, duration)[0]
+        guidance = GuidanceSchedule(guidance_scale, *guidance_interval)
+        windows = (latents[0] for _, latents in self.diffuse_windows([song], duration, num_steps, disable_progress, solver, t_schedule, guidance))
+        yield from self._stitch_stream(windows, song, duration, chunked)
+
+    def _stitch_stream(self, windows, song, duration=40, chunked=False):
+        """
+        Decode the latents of the successive windows of a song with the VAE and yield the final
+        samples, see code2sound_stream. song['target_len'] is read as the chunks are yielded, None
+        while the length of the song is unknown (no window reaches past its end then).
+        """
+        hop_frames = duration * 25 // 4 * 3
+        ovlp_samples = int(duration * 25 * self.sample_rate // 1000 * 40) - int(hop_frames * self.sample_rate // 1000 * 40)
+        fade_in, fade_out = crossfade_window(ovlp_samples)
+        emitted = 0
+        tail = None
+        for winx, latent in enumerate(windows):
+            latent = latent.float()
+            if(winx == 0):
+                latent = latent[:,:,song['first_latent_length']:]
+            cur_output = self.vae.decode_audio(latent, chunked=chunked)[0].detach().cpu()
+            if tail is not None:
+                cur_output[:, 0:ovlp_samples] = tail * fade_out + cur_output[:, 0:ovlp_samples] * fade_in
+            chunk, tail = cur_output[:, :-ovlp_samples], cur_output[:, -ovlp_samples:].clone()
+            if song['target_len'] is not None:
+                chunk = chunk[:, :max(song['target_len'] - emitted, 0)]
+            emitted += chunk.shape[-1]
+            if chunk.shape[-1] > 0:
+                yield chunk
+        if tail is not None and song['target_len'] > emitted:
+            yield tail[:, :song['target_len'] - emitted]
+
+    @torch.no_grad()
+    def code2sound_progressive(self, source, prompt_vocal=None, prompt_bgm=None, duration=40, guidance_scale=1.5, num_steps=20, disable_progress=False, chunked=False, solver='euler', t_schedule='linear', guidance_interval=(0., 1.)):
+        """
+        code2sound_stream of a song that is still being generated. source.wait(length) blocks until
+        the codes [codes_vocal, codes_bgm] of at least length frames are generated, or the song is
+        final, and returns them with whether they are final (see ProgressiveCodes). A window is
+        decoded as soon as its codes are generated; the windows reaching past the end of the song,
+        whose codes are repeated to fill them, once the song is final.
+        """
+        # the prompt is prepared once the first codes arrive, not while the generation starts up
+        source.wait(1)
+        prompt = self.prepare_prompt(prompt_vocal, prompt_bgm, duration)
+        song = {'first_latent_length': prompt['first_latent_length'], 'target_len': None}
+        guidance = GuidanceSchedule(guidance_scale, *guidance_interval)
+        yield from self._stitch_stream(self._progressive_windows(source, prompt, song, duration, num_steps, disable_progress, solver, t_schedule, guidance),
+                                       song, duration, chunked)
+
+    def _progressive_windows(self, source, prompt, song, duration, num_steps, disable_progress, solver, t_schedule, guidance):
+        min_samples = duration * 25 # 40ms per frame
+        hop_samples = min_samples // 4 * 3
+        ovlp_frames = min_samples - hop_samples
+        prompt_length = 0 if prompt['codes_vocal'] is None else prompt['codes_vocal'].shape[-1]
+        winx, last_latent, nfe, nfe_guided = 0, None, 0, 0
+        while True:
+            codes, final = source.wait(winx * hop_samples + min_samples - prompt_length)
+            if(final):
+                break
+            # the window lies within the generated codes, the padding of prepare_song is after it
+            current = self.prepare_song(codes, duration=duration, prompt=prompt)
+            [last_latent] = self.diffuse_window([current], winx, [last_latent], duration, num_steps, disable_progress, solver, t_schedule, guidance)
+            nfe += self.model.cfm_wrapper.nfe
+            nfe_guided += self.model.cfm_wrapper.nfe_guided
+            winx += 1
+            yield last_latent
+        song.update(self.prepare_song(codes, duration=duration, prompt=prompt))
+        num_windows = (song['codes_vocal'].shape[-1] - ovlp_frames) // hop_samples
+        num_overlapped = winx
+        for winx in range(winx, num_windows):
+            [last_latent] = self.diffuse_window([song], winx, [last_latent], duration, num_steps, disable_progress, solver, t_schedule, guidance)
+            nfe += self.model.cfm_wrapper.nfe
+            nfe_guided += self.model.cfm_wrapper.nfe_guided
+            yield last_latent
+        self.last_nfe, self.last_nfe_guided = nfe, nfe_guided
+        print(f"code2sound: {num_overlapped} of {num_windows} windows decoded during the generation, {solver} solver, {t_schedule} schedule, {num_steps} steps, {nfe} estimator evaluations ({nfe_guided} guided)")
+
     @torch.no_grad()
     def preprocess_audio(self, input_audios_vocal, threshold=0.8):
         assert len(input_audios_vocal.shape) == 3, input_audios_vocal.shape
@@ -33,6 +33,9 @@ class VectorQuantize(nn.Module):
         self.codebook = nn.Embedding(codebook_size, codebook_dim)
         self.register_buffer("stale_counter", torch.zeros(self.codebook_size,))
         self.stale_tolerance = stale_tolerance
+        # inference caches, rebuilt whenever the parameters they derive from change
+        self._normalized_codebook = None
+        self._code_table = None
 
     def forward(self, z):
         """Quantized the input tensor using a fixed codebook and returns
@@ -78,8 +81,57 @@ class VectorQuantize(nn.Module):
     def decode_code(self, embed_id):
         return self.embed_code(embed_id).transpose(1, 2)
 
+    @staticmethod
+    def _params_key(params):
+        # changes with any update of the parameters: in place (version) or replaced (data_ptr, .to()),
+        # inference tensors have no version counter
+        return tuple((p.data_ptr(), 0 if p.is_inference() else p._version, p.dtype) for p in params)
+
+    @torch.no_grad()
+    def normalized_codebook(self):
+        """L2 normalized codebook (N x D) and its squared norms (N), cached for inference"""
+        key = self._params_key([self.codebook.weight])
+        if self._normalized_codebook is None or self._normalized_codebook[0] != key:
+            with torch.autocast(self.codebook.weight.device.type, enabled=False):
+                codebook = F.normalize(self.codebook.weight)
+            self._normalized_codebook = (key, codebook, codebook.pow(2).sum(1))
+        return self._normalized_codebook[1:]
+
+    @torch.no_grad()
+    def code_table(self):
+        """out_proj of every code (N x input_dim), cached for inference: decoding codes is then a gather"""
+        key = self._params_key([self.codebook.weight] + list(self.out_proj.parameters()))
+        if self._code_table is None or self._code_table[0] != key:
+            with torch.autocast(self.codebook.weight.device.type, enabled=False):
+                table = self.out_proj(self.codebook.weight.t()[None])[0].t().contiguous()
+            self._code_table = (key, table)
+        return self._code_table[1]
+
+    def lookup_code(self, embed_id):
+        """out_proj(decode_code(embed_id)), gathered from code_table"""
+        return F.embedding(embed_id, self.code_table()).transpose(1, 2)
+
+    @torch.no_grad()
+    def nearest_codes(self, encodings, chunk_size=4096):
+        """
+        Index of the nearest code of every row of encodings ((B*T) x D), as decode_latents in
+        training: with both sides normalized, the argmax of 2 e.c - |c|^2, a single matmul with the
+        cached codebook. Rows are searched chunk_size at a time to bound the (rows x N) scores.
+        """
+        codebook, sq_norms = self.normalized_codebook()
+        encodings = F.normalize(encodings)
+        indices = torch.empty(encodings.shape[0], dtype=torch.long, device=encodings.device)
+        for start in range(0, encodings.shape[0], chunk_size):
+            scores = torch.addmm(sq_norms, encodings[start:start + chunk_size], codebook.t(), beta=-1, alpha=2)
+            indices[start:start + chunk_size] = scores.argmax(1)
+        return indices
+
     def decode_latents(self, latents):
         encodings = rearrange(latents, "b d t -> (b t) d")
+        if(not self.training):
+            indices = rearrange(self.nearest_codes(encodings), "(b t) -> b t", b=latents.size(0))
+            return self.decode_code(indices), indices
+
         codebook = self.codebook.weight  # codebook: (N x D)
 
         # L2 normalize encodings and codebook (ViT-VQGAN)
@@ -221,12 +273,6 @@ class ResidualVectorQuantize(nn.Module):
         codes = torch.stack(codebook_indices, dim=1)
         latents = torch.cat(latents, dim=1)
 
-        encodings = F.one_hot(codes, self.codebook_size).float() # B N T 1024
-        # for n in range(encodings.shape[1]):
-        #     print("Lyaer {}, Ratio of unused vector : {:.1f}".format(n, 
-        #         (encodings[:,n,:,:].sum(0).sum(0) < 1.0).sum()/torch.numel(encodings[:,n,:,:].sum(0).sum(0) < 1.0) * 100.
-        #     ))
-
         return z_q, codes, latents, commitment_loss, codebook_loss, n_quantizers.clamp(max=self.n_codebooks).long() - 1
 
     def from_codes(self, codes: torch.Tensor):
@@ -243,11 +289,16 @@ class ResidualVectorQuantize(nn.Module):
         z_q = 0.0
         z_p = []
         n_codebooks = codes.shape[1]
+        # inference: out_proj is folded into the code table of each quantizer
+        lookup = not self.training and not torch.is_grad_enabled()
         for i in range(n_codebooks):
             z_p_i = self.quantizers[i].decode_code(codes[:, i, :])
             z_p.append(z_p_i)
 
-            z_q_i = self.quantizers[i].out_proj(z_p_i)
+            if(lookup):
+                z_q_i = self.quantizers[i].lookup_code(codes[:, i, :])
+            else:
+                z_q_i = self.quantizers[i].out_proj(z_p_i)
             z_q = z_q + z_q_i
         return z_q, torch.cat(z_p, dim=1), codes
 
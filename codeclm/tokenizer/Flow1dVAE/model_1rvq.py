@@ -262,6 +262,12 @@ class BASECFM(torch.nn.Module, ABC):
         return loss, loss_re, loss_cos
 
 class PromptCondAudioDiffusion(nn.Module):
+    # files BEST-RQ is built from, before the checkpoint of the model loads its weights
+    bestrq_source = dict(
+        model_dir='codeclm/tokenizer/Flow1dVAE/our_MERT_BESTRQ/mert_fairseq',
+        checkpoint_dir='ckpt/encode-s12k.pt',
+    )
+
     def __init__(
         self,
         num_channels,
@@ -272,7 +278,9 @@ class PromptCondAudioDiffusion(nn.Module):
         ssl_layer=None,
         uncondition=True,
         out_paint=False,
+        bestrq=None,
     ):
+        """bestrq: BEST-RQ already built (e.g. shared with other tokenizers), built from bestrq_source if None"""
         super().__init__()
 
         assert unet_model_name is not None or unet_model_config_path is not None, "Either UNet pretrain model name or a config file path is required"
@@ -294,10 +302,7 @@ class PromptCondAudioDiffusion(nn.Module):
         self.rsq48towav2vec = torchaudio.transforms.Resample(48000, 16000)
         # self.wav2vec = Wav2Vec2BertModel.from_pretrained("facebook/w2v-bert-2.0", trust_remote_code=True)
         # self.wav2vec_processor = AutoFeatureExtractor.from_pretrained("facebook/w2v-bert-2.0", trust_remote_code=True)
-        self.bestrq = load_model(
-            model_dir='codeclm/tokenizer/Flow1dVAE/our_MERT_BESTRQ/mert_fairseq',
-            checkpoint_dir='ckpt/encode-s12k.pt',
-        )
+        self.bestrq = load_model(**self.bestrq_source) if bestrq is None else bestrq
         self.rsq48tobestrq = torchaudio.transforms.Resample(48000, 24000)
         self.rsq48tohubert = torchaudio.transforms.Resample(48000, 16000)
         for v in self.bestrq.parameters():v.requires_grad = False
@@ -385,7 +390,7 @@ class PromptCondAudioDiffusion(nn.Module):
         input_wav_mean = (input_audio_0 + input_audio_1) / 2.0
         # print("input_wav_mean.shape:",input_wav_mean.shape)
         # input_wav_mean = torch.randn(2,1720320*2).to(input_audio_0.device)
-        input_wav_mean = self.bestrq(self.rsq48tobestrq(input_wav_mean), features_only = True)
+        input_wav_mean = self.bestrq(self.rsq48tobestrq(input_wav_mean), features_only = True, max_layer = layer)
         layer_results = input_wav_mean['layer_results']
         # print("layer_results.shape:",layer_results[layer].shape)
         bestrq_emb = layer_results[layer]
@@ -398,7 +398,7 @@ class PromptCondAudioDiffusion(nn.Module):
         input_wav_mean = (input_audio_0 + input_audio_1) / 2.0
         # print("input_wav_mean.shape:",input_wav_mean.shape)
         # input_wav_mean = torch.randn(2,1720320*2).to(input_audio_0.device)
-        input_wav_mean = self.bestrq(self.rsq48tobestrq(input_wav_mean), features_only = True)
+        input_wav_mean = self.bestrq(self.rsq48tobestrq(input_wav_mean), features_only = True, max_layer = layer)
         layer_results = input_wav_mean['layer_results']
         # print("layer_results.shape:",layer_results[layer].shape)
         bestrq_emb = layer_results[layer]
@@ -18,11 +18,12 @@ from diffusers.utils.torch_utils import randn_tensor
 from transformers import HubertModel
 from libs.rvq.descript_quantize3 import ResidualVectorQuantize
 
-from models_gpt.models.gpt2_rope2_time_new_correct_mask_noncasual_reflow import GPT2Model
+from models_gpt.models.gpt2_rope2_time_new_correct_mask_noncasual_reflow import GPT2Model, sdpa_attention_mask
 from models_gpt.models.gpt2_config import GPT2Config
 
 from torch.cuda.amp import autocast
 from our_MERT_BESTRQ.test import load_model
+from tools.shared_models import SHARED_MODELS, bestrq_key, weights_digest
 
 class HubertModelWithFinalProj(HubertModel):
     def __init__(self, config):
@@ -36,6 +37,78 @@ class HubertModelWithFinalProj(HubertModel):
         self.final_proj = nn.Linear(config.hidden_size, config.classifier_proj_size)
 
 
+ENCODER_LOADING = ['eager', 'lazy', 'decode_only']
+
+
+class EncoderRegistry:
+    """Frozen feature encoders of `PromptCondAudioDiffusion` (BEST-RQ, HuBERT), built on first use.
+
+    Encoders built here are kept out of the module tree of their owner: they are not in its
+    `state_dict`, `parameters` or `.to()`, they are moved to the requested device when built and
+    can be released afterwards. Weights of an encoder found in the owner checkpoint are stashed
+    on the CPU and applied every time it is built.
+
+    Encoders with a shared key are taken from SHARED_MODELS, so that the tokenizers of a process
+    with the same encoder (same files and weights) hold a single instance.
+
+    Args:
+        factories (dict[str, callable]): Builder of each encoder.
+        decode_only (bool): Refuse to build any encoder.
+        shared_keys (dict[str, callable], optional): For the shared encoders, key of the encoder
+            in SHARED_MODELS given the weights_digest of its stashed weights (None if none) and device.
+    """
+    def __init__(self, factories, decode_only=False, shared_keys=None):
+        self.factories = factories
+        self.decode_only = decode_only
+        self.shared_keys = shared_keys or {}
+        self.modules = {}
+        self.state_dicts = {}
+        self.digests = {}
+        self.keys = {}
+
+    def loaded(self, name):
+        return name in self.modules
+
+    def get(self, name, device=None):
+        if name not in self.factories:
+            raise KeyError(f"unknown encoder {name}")
+        if name not in self.modules:
+            if self.decode_only:
+                raise RuntimeError(f"{name} is not loaded in decode-only mode, "
+                                   "tokenizing audio needs encoder_loading='lazy' or 'eager'")
+            def build():
+                module = self.factories[name]()
+                for v in module.parameters():v.requires_grad = False
+                if name in self.state_dicts:
+                    module.load_state_dict(self.state_dicts[name], strict=False)
+                if device is not None:
+                    module = module.to(device)
+                return module.eval()
+            if name in self.shared_keys and device is not None:
+                self.keys[name] = self.shared_keys[name](self.digests.get(name), device)
+                self.modules[name] = SHARED_MODELS.acquire(self.keys[name], build)
+            else:
+                self.modules[name] = build()
+        return self.modules[name]
+
+    def stash(self, name, state_dict):
+        self.state_dicts[name] = {k: v.detach().cpu() for k, v in state_dict.items()}
+        # hashed once here rather than at every (re)build of a shared encoder
+        if(name in self.shared_keys and len(self.state_dicts[name]) > 0):
+            self.digests[name] = weights_digest(self.state_dicts[name])
+        else:
+            self.digests.pop(name, None)
+
+    def release(self, name):
+        module = self.modules.pop(name, None)
+        if name in self.keys:
+            del module
+            SHARED_MODELS.release(self.keys.pop(name))
+        elif module is not None and torch.cuda.is_available():
+            del module
+            torch.cuda.empty_cache()
+
+
 class SampleProcessor(torch.nn.Module):
     def project_sample(self, x: torch.Tensor):
         """Project the original sample to the 'space' where the diffusion will happen."""
@@ -106,6 +179,97 @@ def pad_or_tunc_tolen(prior_text_encoder_hidden_states, prior_text_mask, prior_p
     prior_text_encoder_hidden_states = prior_text_encoder_hidden_states.permute(0,2,1).contiguous()
     return prior_text_encoder_hidden_states, prior_text_mask, prior_prompt_embeds
 
+SOLVERS = ['euler', 'heun', 'midpoint', 'rk4', 'multistep']
+T_SCHEDULES = ['linear', 'cosine', 'shift']
+
+def make_t_span(num_steps, schedule='linear', shift=3.0, device=None):
+    """
+    Time grid from noise (t=0) to data (t=1) for the ODE solvers.
+    Args:
+        num_steps (int): number of solver steps
+        schedule (str): 'linear' for uniform steps, 'cosine' for steps refined at both ends,
+            'shift' for steps refined at the noisy end (noise level sigma=1-t is mapped to
+            shift*sigma/(1+(shift-1)*sigma))
+        shift (float): strength of the 'shift' schedule
+    """
+    assert schedule in T_SCHEDULES, f"unknown t schedule {schedule}, expected one of {T_SCHEDULES}"
+    t_span = torch.linspace(0, 1, num_steps + 1, device=device)
+    if schedule == 'cosine':
+        t_span = (1 - torch.cos(t_span * np.pi)) / 2
+    elif schedule == 'shift':
+        sigma = 1 - t_span
+        t_span = 1 - shift * sigma / (1 + (shift - 1) * sigma)
+    return t_span
+
+class GuidanceSchedule(object):
+    """
+    Classifier free guidance of the solver steps. scale is one guidance scale, or a list of one per
+    step. A step is guided when its scale is above 1 and its start time t (0 being the noise) lies
+    in [t_start, t_end]; the other steps are evaluated without guidance, at batch 1.
+    """
+    def __init__(self, scale=1.5, t_start=0., t_end=1.):
+        assert t_start <= t_end, f"empty guidance interval [{t_start}, {t_end}]"
+        self.scale = scale
+        self.t_start = t_start
+        self.t_end = t_end
+
+    @classmethod
+    def make(cls, guidance):
+        """The schedule of guidance, a GuidanceSchedule or a guidance scale for every step"""
+        return guidance if isinstance(guidance, GuidanceSchedule) else cls(guidance)
+
+    def scales(self, t_span):
+        """Guidance scale of every step of t_span, 1.0 for the unguided steps"""
+        ts = t_span[:-1].tolist()
+        scales = list(self.scale) if isinstance(self.scale, (list, tuple)) else [self.scale] * len(ts)
+        assert len(scales) == len(ts), f"{len(scales)} guidance scales for {len(ts)} steps"
+        return [float(scale) if scale > 1.0 and self.t_start <= t <= self.t_end else 1.0 for scale, t in zip(scales, ts)]
+
+    def __repr__(self):
+        return f"GuidanceSchedule(scale={self.scale}, t_start={self.t_start}, t_end={self.t_end})"
+
+class EstimatorInputs(object):
+    """
+    Inputs of the estimator for one solve. The model input [latent mask, in-context, mu, x] is
+    allocated once with its step invariant channels (mu zeroed in the unconditional half of a
+    guided batch), the attention mask is doubled once, and every velocity only writes the current
+    x and timestep into these buffers. The estimator takes the channels as they are, without
+    input projection, so the buffer is all of its condition. Unguided steps only use the
+    conditional half. scales holds the guidance scale of every step, see GuidanceSchedule. With
+    sdpa, the mask is made boolean for the SDPA attention of the estimator here rather than at
+    every evaluation.
+    """
+    def __init__(self, x, t_span, latent_mask_input, incontext_x, incontext_length, mu, attention_mask, guidance_scale, sdpa=False):
+        self.noise = x.clone()
+        self.incontext_x = incontext_x
+        self.incontext_mask = BASECFM.incontext_mask(x, incontext_length)
+        self.scales = GuidanceSchedule.make(guidance_scale).scales(t_span)
+        n = 2 if max(self.scales, default=1.0) > 1.0 else 1
+        self.batch_size, num_frames, dim = x.shape
+        cond = torch.cat([latent_mask_input, incontext_x, mu], 2)
+        model_input = torch.empty(n, self.batch_size, num_frames, cond.shape[-1] + dim,
+                                  dtype=torch.promote_types(cond.dtype, x.dtype), device=x.device)
+        model_input[..., :cond.shape[-1]].copy_(cond)
+        if(n == 2):
+            model_input[0, ..., cond.shape[-1] - mu.shape[-1]:cond.shape[-1]].zero_()
+        self.x_input = model_input[..., cond.shape[-1]:] # (n, batch, frames, dim) view of the x channels
+        self.model_input = model_input.view(n * self.batch_size, num_frames, -1)
+        self.timestep = torch.empty(n * self.batch_size, dtype=t_span.dtype, device=t_span.device)
+        if(attention_mask is not None and bool(attention_mask.all())):
+            attention_mask = None # no padding: spares the estimator its mask
+        if(attention_mask is not None and sdpa):
+            attention_mask = sdpa_attention_mask(attention_mask)
+        self.attention_mask_cond = attention_mask
+        if(attention_mask is not None and n == 2 and attention_mask.shape[0] > 1):
+            attention_mask = torch.cat([attention_mask, attention_mask], 0)
+        self.attention_mask = attention_mask
+
+    def batch(self, guided):
+        """(model input, x channels, timestep, attention mask) of a guided evaluation, or of the conditional rows alone"""
+        if(guided):
+            return self.model_input, self.x_input, self.timestep, self.attention_mask
+        return self.model_input[-self.batch_size:], self.x_input[-1], self.timestep[-self.batch_size:], self.attention_mask_cond
+
 class BASECFM(torch.nn.Module, ABC):
     def __init__(
         self,
@@ -114,6 +278,8 @@ class BASECFM(torch.nn.Module, ABC):
     ):
         super().__init__()
         self.sigma_min = 1e-4
+        self.nfe = 0
+        self.nfe_guided = 0
 
         self.estimator = estimator
         self.mlp = mlp
@@ -136,6 +302,55 @@ class BASECFM(torch.nn.Module, ABC):
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device)
         return self.solve_euler(z, t_span=t_span)
 
+    def solve(self, x, latent_mask_input,incontext_x, incontext_length, t_span, mu,attention_mask, guidance_scale, solver='euler'):
+        """
+        Integrate the ODE over `t_span` with one of `SOLVERS`. The number of estimator
+        evaluations (one per velocity) is kept in `self.nfe`, and in `self.nfe_guided` the
+        number of them with a CFG doubled batch.
+        Args:
+            guidance_scale (float or GuidanceSchedule): guidance of the steps, a scale for all of
+                them or a GuidanceSchedule (per step scales, guided time interval)
+            solver (str): 'euler' (1 evaluation per step), 'heun' and 'midpoint' (2),
+                'rk4' (4), or 'multistep', a second order Adams-Bashforth/DPM-Solver-2M like
+                solver reusing the velocity of the previous step (1)
+        """
+        assert solver in SOLVERS, f"unknown solver {solver}, expected one of {SOLVERS}"
+        return getattr(self, f"solve_{solver}")(x, latent_mask_input,incontext_x, incontext_length, t_span, mu,attention_mask, guidance_scale)
+
+    @staticmethod
+    def incontext_mask(x, incontext_length):
+        """(batch, frames, 1) mask of the in-context frames of x, for one length or one per row"""
+        incontext_length = torch.as_tensor(incontext_length, device=x.device).reshape(-1, 1)
+        return (torch.arange(x.shape[1], device=x.device)[None, :] < incontext_length)[..., None]
+
+    def start_solve(self, x, t_span, latent_mask_input, incontext_x, incontext_length, mu, attention_mask, guidance_scale):
+        """Reset the evaluation counters and build the EstimatorInputs of a solve starting from the noise x"""
+        self.nfe = 0
+        self.nfe_guided = 0
+        sdpa = getattr(self.estimator, '_attn_implementation', None) == "sdpa"
+        return EstimatorInputs(x, t_span, latent_mask_input, incontext_x, incontext_length, mu, attention_mask, guidance_scale, sdpa=sdpa)
+
+    def velocity(self, x, t, inputs, guidance_scale):
+        """
+        Estimated velocity at time t, inputs being the EstimatorInputs of the solve, with classifier
+        free guidance if guidance_scale is above 1 (counted in self.nfe_guided), else from the
+        conditional rows alone. The in-context part of x is first set (in place) to its point of
+        the path from noise to the in-context latents.
+        """
+        guided = guidance_scale > 1.0
+        self.nfe += 1
+        self.nfe_guided += int(guided)
+        x.copy_(torch.where(inputs.incontext_mask, (1 - (1 - self.sigma_min) * t) * inputs.noise + t * inputs.incontext_x, x))
+        model_input, x_input, timestep, attention_mask = inputs.batch(guided)
+        x_input.copy_(x)
+        timestep.fill_(t)
+        dphi_dt = self.estimator(inputs_embeds=model_input, attention_mask=attention_mask,time_step=timestep).last_hidden_state
+        dphi_dt = dphi_dt[: ,:, -x.shape[2]:]
+        if(guided):
+            dphi_dt_uncond, dhpi_dt_cond = dphi_dt.chunk(2,0)
+            dphi_dt = torch.lerp(dphi_dt_uncond, dhpi_dt_cond, guidance_scale)
+        return dphi_dt
+
     def solve_euler(self, x, latent_mask_input,incontext_x, incontext_length, t_span, mu,attention_mask, guidance_scale):
         """
         Fixed euler solver for ODEs.
@@ -146,41 +361,70 @@ class BASECFM(torch.nn.Module, ABC):
             mu (torch.Tensor): output of encoder
                 shape: (batch_size, n_channels, mel_timesteps, n_feats)
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        noise = x.clone()
+        inputs = self.start_solve(x, t_span, latent_mask_input, incontext_x, incontext_length, mu, attention_mask, guidance_scale)
+        for step in tqdm(range(1, len(t_span))):
+            scale = inputs.scales[step - 1]
+            dphi_dt = self.velocity(x, t_span[step - 1], inputs, scale)
+            x.addcmul_(dphi_dt, t_span[step] - t_span[step - 1])
+        return x
+
+    def solve_heun(self, x, latent_mask_input,incontext_x, incontext_length, t_span, mu,attention_mask, guidance_scale):
+        """Heun's (explicit trapezoidal) second order solver, 2 evaluations per step."""
+        inputs = self.start_solve(x, t_span, latent_mask_input, incontext_x, incontext_length, mu, attention_mask, guidance_scale)
+        for step in tqdm(range(1, len(t_span))):
+            scale = inputs.scales[step - 1]
+            t, t_next = t_span[step - 1], t_span[step]
+            dt = t_next - t
+            v = self.velocity(x, t, inputs, scale)
+            v_next = self.velocity(x + dt * v, t_next, inputs, scale)
+            x = x + dt * (v + v_next) / 2
+        return x
 
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
+    def solve_midpoint(self, x, latent_mask_input,incontext_x, incontext_length, t_span, mu,attention_mask, guidance_scale):
+        """Explicit midpoint second order solver, 2 evaluations per step."""
+        inputs = self.start_solve(x, t_span, latent_mask_input, incontext_x, incontext_length, mu, attention_mask, guidance_scale)
+        for step in tqdm(range(1, len(t_span))):
+            scale = inputs.scales[step - 1]
+            t, t_next = t_span[step - 1], t_span[step]
+            dt = t_next - t
+            v = self.velocity(x, t, inputs, scale)
+            x = x + dt * self.velocity(x + dt / 2 * v, t + dt / 2, inputs, scale)
+        return x
 
+    def solve_rk4(self, x, latent_mask_input,incontext_x, incontext_length, t_span, mu,attention_mask, guidance_scale):
+        """Classical fourth order Runge-Kutta solver, 4 evaluations per step."""
+        inputs = self.start_solve(x, t_span, latent_mask_input, incontext_x, incontext_length, mu, attention_mask, guidance_scale)
         for step in tqdm(range(1, len(t_span))):
-            x[:,0:incontext_length,:] = (1 - (1 - self.sigma_min) * t) * noise[:,0:incontext_length,:] + t * incontext_x[:,0:incontext_length,:]
-            if(guidance_scale > 1.0):
-
-                model_input = torch.cat([ \
-                    torch.cat([latent_mask_input, latent_mask_input], 0), \
-                    torch.cat([incontext_x, incontext_x], 0), \
-                    torch.cat([torch.zeros_like(mu), mu], 0), \
-                    torch.cat([x, x], 0), \
-                    ], 2)
-                timestep=t.unsqueeze(-1).repeat(2)
-
-                dphi_dt = self.estimator(inputs_embeds=model_input, attention_mask=attention_mask,time_step=timestep).last_hidden_state
-                dphi_dt_uncond, dhpi_dt_cond = dphi_dt.chunk(2,0)
-                dphi_dt = dphi_dt_uncond + guidance_scale * (dhpi_dt_cond - dphi_dt_uncond)
+            scale = inputs.scales[step - 1]
+            t, t_next = t_span[step - 1], t_span[step]
+            dt = t_next - t
+            k1 = self.velocity(x, t, inputs, scale)
+            k2 = self.velocity(x + dt / 2 * k1, t + dt / 2, inputs, scale)
+            k3 = self.velocity(x + dt / 2 * k2, t + dt / 2, inputs, scale)
+            k4 = self.velocity(x + dt * k3, t_next, inputs, scale)
+            x = x + dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+        return x
+
+    def solve_multistep(self, x, latent_mask_input,incontext_x, incontext_length, t_span, mu,attention_mask, guidance_scale):
+        """
+        Second order multistep solver, 1 evaluation per step: the velocity is extrapolated
+        from the current and previous evaluations (variable step Adams-Bashforth 2, which is
+        what DPM-Solver++(2M) reduces to for a linear flow), the first step is an euler step.
+        """
+        inputs = self.start_solve(x, t_span, latent_mask_input, incontext_x, incontext_length, mu, attention_mask, guidance_scale)
+        v_prev, dt_prev = None, None
+        for step in tqdm(range(1, len(t_span))):
+            scale = inputs.scales[step - 1]
+            t, t_next = t_span[step - 1], t_span[step]
+            dt = t_next - t
+            v = self.velocity(x, t, inputs, scale)
+            if v_prev is None:
+                x = x + dt * v
             else:
-                model_input = torch.cat([latent_mask_input, incontext_x, mu, x], 2)
-                timestep=t.unsqueeze(-1)
-                dphi_dt = self.estimator(inputs_embeds=model_input, attention_mask=attention_mask,time_step=timestep).last_hidden_state
-            
-            dphi_dt = dphi_dt[: ,:, -x.shape[2]:]
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
-
-        return sol[-1]
+                r = dt / (2 * dt_prev)
+                x = x + dt * ((1 + r) * v - r * v_prev)
+            v_prev, dt_prev = v, dt
+        return x
 
     def projection_loss(self,hidden_proj, bestrq_emb):
         bsz = hidden_proj.shape[0]
@@ -242,7 +486,12 @@ class PromptCondAudioDiffusion(nn.Module):
         snr_gamma=None,
         uncondition=True,
         out_paint=False,
+        encoder_loading='eager',
+        attn_implementation=None,
     ):
+        """encoder_loading: 'eager' builds BEST-RQ and HuBERT as submodules (training), 'lazy' builds them
+        on first use outside of the module tree, 'decode_only' never builds them (code2sound without prompt).
+        attn_implementation: attention of the estimator, the eager one by default, 'sdpa' for the fused kernels"""
         super().__init__()
 
         assert unet_model_name is not None or unet_model_config_path is not None, "Either UNet pretrain model name or a config file path is required"
@@ -262,20 +511,27 @@ class PromptCondAudioDiffusion(nn.Module):
         self.rsq48towav2vec = torchaudio.transforms.Resample(48000, 16000)
         # self.wav2vec = Wav2Vec2BertModel.from_pretrained("facebook/w2v-bert-2.0", trust_remote_code=True)
         # self.wav2vec_processor = AutoFeatureExtractor.from_pretrained("facebook/w2v-bert-2.0", trust_remote_code=True)
-        self.bestrq = load_model(
+        assert encoder_loading in ENCODER_LOADING, encoder_loading
+        self.encoder_loading = encoder_loading
+        self.bestrq_source = dict(
             model_dir='codeclm/tokenizer/Flow1dVAE/our_MERT_BESTRQ/mert_fairseq',
             checkpoint_dir='ckpt/encode-s12k.pt',
         )
+        self.encoders = EncoderRegistry({
+            'bestrq': lambda: load_model(**self.bestrq_source),
+            'hubert': lambda: HubertModelWithFinalProj.from_pretrained("ckpt/models--lengyue233--content-vec-best/snapshots/c0b9ba13db21beaa4053faae94c102ebe326fd68"),
+        }, decode_only=encoder_loading == 'decode_only',
+        shared_keys={'bestrq': lambda digest, device: bestrq_key(digest=digest, device=device, **self.bestrq_source)})
+        if encoder_loading == 'eager':
+            self.bestrq = self.encoders.get('bestrq')
+            self.hubert = self.encoders.get('hubert')
         self.rsq48tobestrq = torchaudio.transforms.Resample(48000, 24000)
         self.rsq48tohubert = torchaudio.transforms.Resample(48000, 16000)
-        for v in self.bestrq.parameters():v.requires_grad = False
         self.rvq_bestrq_emb = ResidualVectorQuantize(input_dim = 1024, n_codebooks = 1, codebook_size = 16_384, codebook_dim = 32, quantizer_dropout = 0.0, stale_tolerance=200)
         self.rvq_bestrq_bgm_emb = ResidualVectorQuantize(input_dim = 1024, n_codebooks = 1, codebook_size = 16_384, codebook_dim = 32, quantizer_dropout = 0.0, stale_tolerance=200)
-        self.hubert = HubertModelWithFinalProj.from_pretrained("ckpt/models--lengyue233--content-vec-best/snapshots/c0b9ba13db21beaa4053faae94c102ebe326fd68")
-        for v in self.hubert.parameters():v.requires_grad = False
         self.zero_cond_embedding1 = nn.Parameter(torch.randn(32*32,))
         # self.xvecmodel = XVECModel()
-        config = GPT2Config(n_positions=1000,n_layer=16,n_head=20,n_embd=2200,n_inner=4400)
+        config = GPT2Config(n_positions=1000,n_layer=16,n_head=20,n_embd=2200,n_inner=4400,attn_implementation=attn_implementation)
         unet = GPT2Model(config)
         mlp =  nn.Sequential(
             nn.Linear(2200, 1024), 
@@ -290,6 +546,33 @@ class PromptCondAudioDiffusion(nn.Module):
         print("Transformer initialized from pretrain.")
         torch.cuda.empty_cache()
 
+    def __getattr__(self, name):
+        # bestrq / hubert outside of the module tree are built on first access
+        if name in ('bestrq', 'hubert') and name not in self.__dict__['_modules']:
+            return self.encoders.get(name, next(self.parameters()).device)
+        return super().__getattr__(name)
+
+    def load_state_dict(self, state_dict, strict=True):
+        if self.encoder_loading != 'eager':
+            # encoder weights of the checkpoint are kept aside until the encoder is built
+            state_dict = dict(state_dict)
+            for name in self.encoders.factories:
+                prefix = name + '.'
+                keys = [k for k in state_dict if k.startswith(prefix)]
+                weights = {k[len(prefix):]: state_dict.pop(k) for k in keys}
+                if len(weights) > 0 and self.encoder_loading == 'lazy':
+                    self.encoders.stash(name, weights)
+            strict = False
+        return super().load_state_dict(state_dict, strict=strict)
+
+    def release_encoders(self, *names):
+        """Free BEST-RQ / HuBERT (all of them by default), they are built again on next use."""
+        for name in names or list(self.encoders.factories):
+            if name in self._modules:
+                # eager encoder: keep its weights, it becomes lazy
+                self.encoders.stash(name, self._modules.pop(name).state_dict())
+            self.encoders.release(name)
+
     def compute_snr(self, timesteps):
         """
         Computes SNR as per https://github.com/TiankaiHang/Min-SNR-Diffusion-Training/blob/521b624bd70c67cee4bdf49225915f5945a872e3/guided_diffusion/gaussian_diffusion.py#L847-L849
@@ -341,12 +624,22 @@ class PromptCondAudioDiffusion(nn.Module):
     
     def extract_bestrq_embeds(self, input_audio_vocal_0,input_audio_vocal_1,layer):
         input_wav_mean = (input_audio_vocal_0 + input_audio_vocal_1) / 2.0
-        input_wav_mean = self.bestrq(self.rsq48tobestrq(input_wav_mean), features_only = True)
+        input_wav_mean = self.bestrq(self.rsq48tobestrq(input_wav_mean), features_only = True, max_layer = layer)
         layer_results = input_wav_mean['layer_results']
         bestrq_emb = layer_results[layer]
         bestrq_emb = bestrq_emb.permute(0,2,1).contiguous()
         return bestrq_emb
 
+    def extract_bestrq_embeds_pair(self, input_audio_vocal_0,input_audio_vocal_1,input_audio_bgm_0,input_audio_bgm_1,layer_vocal,layer_bgm):
+        # vocal and bgm in one batched pass, each stream leaves the encoder at its own layer
+        batch_size = input_audio_vocal_0.shape[0]
+        input_wav_mean = torch.cat([(input_audio_vocal_0 + input_audio_vocal_1) / 2.0,
+                                    (input_audio_bgm_0 + input_audio_bgm_1) / 2.0], 0)
+        row_layers = [layer_vocal] * batch_size + [layer_bgm] * input_audio_bgm_0.shape[0]
+        bestrq_emb = self.bestrq(self.rsq48tobestrq(input_wav_mean), features_only = True, max_layer = row_layers)['exit_results']
+        bestrq_emb = bestrq_emb.permute(0,2,1).contiguous()
+        return bestrq_emb[:batch_size], bestrq_emb[batch_size:]
+
 
     def extract_spk_embeds(self, input_audios):
         spk_embeds = self.xvecmodel(self.rsq48towav2vec(input_audios))
@@ -503,10 +796,8 @@ class PromptCondAudioDiffusion(nn.Module):
         # bestrq_middle,bestrq_last = self.extract_bestrq_embeds(input_audios)
         # bestrq_middle = bestrq_middle.detach()
         # bestrq_last = bestrq_last.detach()
-        bestrq_emb = self.extract_bestrq_embeds(input_audio_vocal_0,input_audio_vocal_1,layer_vocal)
+        bestrq_emb, bestrq_emb_bgm = self.extract_bestrq_embeds_pair(input_audio_vocal_0,input_audio_vocal_1,input_audio_bgm_0,input_audio_bgm_1,layer_vocal,layer_bgm)
         bestrq_emb = bestrq_emb.detach()
-
-        bestrq_emb_bgm = self.extract_bestrq_embeds(input_audio_bgm_0,input_audio_bgm_1,layer_bgm)
         bestrq_emb_bgm = bestrq_emb_bgm.detach()
 
 
@@ -549,10 +840,8 @@ class PromptCondAudioDiffusion(nn.Module):
         # bestrq_middle,bestrq_last = self.extract_bestrq_embeds(input_audios)
         # bestrq_middle = bestrq_middle.detach()
         # bestrq_last = bestrq_last.detach()
-        bestrq_emb = self.extract_bestrq_embeds(input_audio_vocal_0,input_audio_vocal_1,layer_vocal)
+        bestrq_emb, bestrq_emb_bgm = self.extract_bestrq_embeds_pair(input_audio_vocal_0,input_audio_vocal_1,input_audio_bgm_0,input_audio_bgm_1,layer_vocal,layer_bgm)
         bestrq_emb = bestrq_emb.detach()
-
-        bestrq_emb_bgm = self.extract_bestrq_embeds(input_audio_bgm_0,input_audio_bgm_1,layer_bgm)
         bestrq_emb_bgm = bestrq_emb_bgm.detach()
 
 
@@ -580,8 +869,8 @@ class PromptCondAudioDiffusion(nn.Module):
     @torch.no_grad()
     def inference_codes(self, codes, spk_embeds, true_latents, latent_length, additional_feats,incontext_length=127, 
                   guidance_scale=2, num_steps=20,
-                  disable_progress=True, scenario='start_seg'):
-        classifier_free_guidance = guidance_scale > 1.0
+                  disable_progress=True, scenario='start_seg', solver='euler', t_schedule='linear'):
+        # codes may hold a batch of windows, incontext_length is then one length or one per window
         device = self.device
         dtype = self.dtype
         # codes_bestrq_middle, codes_bestrq_last = codes
@@ -609,7 +898,7 @@ class PromptCondAudioDiffusion(nn.Module):
         latent_masks = torch.zeros(latents.shape[0], latents.shape[1], dtype=torch.int64, device=latents.device)
         latent_masks[:,0:latent_length] = 2
         if(scenario=='other_seg'):
-            latent_masks[:,0:incontext_length] = 1
+            latent_masks[self.cfm_wrapper.incontext_mask(latents, incontext_length)[..., 0]] = 1
 
         
 
@@ -621,7 +910,7 @@ class PromptCondAudioDiffusion(nn.Module):
         true_latents = self.normfeat.project_sample(true_latents)
         true_latents = true_latents.permute(0,2,1).contiguous()
         incontext_latents = true_latents * ((latent_masks > 0.5) * (latent_masks < 1.5)).unsqueeze(-1).float()
-        incontext_length = ((latent_masks > 0.5) * (latent_masks < 1.5)).sum(-1)[0]
+        incontext_length = ((latent_masks > 0.5) * (latent_masks < 1.5)).sum(-1)
 
 
         attention_mask=(latent_masks > 0.5)
@@ -639,10 +928,10 @@ class PromptCondAudioDiffusion(nn.Module):
             additional_model_input = torch.cat([quantized_bestrq_emb,quantized_bestrq_emb_bgm],2)
 
         temperature = 1.0
-        t_span = torch.linspace(0, 1, num_steps + 1, device=quantized_bestrq_emb.device)
-        latents = self.cfm_wrapper.solve_euler(latents * temperature, latent_mask_input,incontext_latents, incontext_length, t_span, additional_model_input,attention_mask,  guidance_scale)
+        t_span = make_t_span(num_steps, t_schedule, device=quantized_bestrq_emb.device)
+        latents = self.cfm_wrapper.solve(latents * temperature, latent_mask_input,incontext_latents, incontext_length, t_span, additional_model_input,attention_mask,  guidance_scale, solver=solver)
 
-        latents[:,0:incontext_length,:] = incontext_latents[:,0:incontext_length,:]
+        latents = torch.where(self.cfm_wrapper.incontext_mask(latents, incontext_length), incontext_latents, latents)
         latents = latents.permute(0,2,1).contiguous()
         latents = self.normfeat.return_sample(latents)
         # latents = latents.permute(0,2,1).contiguous()
@@ -15,6 +15,7 @@
 # limitations under the License.
 """PyTorch OpenAI GPT-2 model."""
 
+import functools
 import math
 import os
 import warnings
@@ -506,6 +507,44 @@ def apply_rotary_emb(xq: torch.Tensor,  freqs_cis: torch.Tensor,):
 
     return xq_out.type_as(xq)
 
+@functools.lru_cache(maxsize=8)
+def precompute_rotary_tables(dim: int, end: int, device: torch.device, constant: float = 10000.0):
+    '''
+    Real form of precompute_freqs_cis, cached per (dim, end, device): cos and signed sin [length, d],
+    every frequency repeated for the two elements of its pair, so that the rotation of apply_rotary_emb
+    is x * cos + swap_pairs(x) * sin. The tables are shared and must not be modified.
+    '''
+    freqs_cis = precompute_freqs_cis(dim, end, constant) # [length, d/2]
+    cos = freqs_cis.real.repeat_interleave(2, dim=-1)
+    sin = torch.stack([-freqs_cis.imag, freqs_cis.imag], dim=-1).flatten(-2)
+    return cos.to(device), sin.to(device)
+
+def apply_rotary_emb_real(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor):
+    # x:[bs, head, length, d], cos/sin:[length, d] of precompute_rotary_tables, in float32 as apply_rotary_emb
+    x_ = x.float()
+    x_swapped = x_.unflatten(-1, (-1, 2)).flip(-1).flatten(-2) # [q1, q0, q3, q2, ...]
+    return (x_ * cos + x_swapped * sin).type_as(x)
+
+def additive_attention_mask(attention_mask, dtype):
+    # boolean mask (True to attend) to the additive mask of the eager attention
+    if attention_mask is None or attention_mask.dtype != torch.bool:
+        return attention_mask
+    return torch.zeros(attention_mask.shape, dtype=dtype, device=attention_mask.device).masked_fill(
+        ~attention_mask, torch.finfo(dtype).min
+    )
+
+
+def sdpa_attention_mask(attention_mask):
+    """
+    Boolean mask of the SDPA attention (True to attend), [batch_size, 1, 1, to_seq_length] for a 2D mask. Padded
+    queries attend to every position instead of none (NaN): the other queries do not attend to them, so their output
+    never reaches the valid frames. Built once by the caller for all the evaluations sharing a mask.
+    """
+    if attention_mask.dim() != 4:
+        attention_mask = attention_mask.view(attention_mask.shape[0], -1)[:, None, None, :]
+    attention_mask = attention_mask.to(torch.bool)
+    return attention_mask | ~attention_mask.any(dim=-1, keepdim=True)
+
 
 
 class GPT2FlashAttention2(GPT2Attention):
@@ -714,6 +753,96 @@ class GPT2FlashAttention2(GPT2Attention):
         )
 
 
+class GPT2SdpaAttention(GPT2Attention):
+    """
+    GPT2 attention module using `torch.nn.functional.scaled_dot_product_attention`, on any device. This module inherits
+    from `GPT2Attention` as the weights of the module stay untouched. The rotary embedding is the one of
+    `GPT2Attention._attn`, with real tables computed once per sequence length and shared by all layers and steps. The
+    attention mask is boolean (True for the positions to attend), as built by `sdpa_attention_mask`.
+    """
+
+    def forward(
+        self,
+        hidden_states: Optional[Tuple[torch.FloatTensor]],
+        layer_past: Optional[Tuple[torch.Tensor]] = None,
+        attention_mask: Optional[torch.FloatTensor] = None,
+        head_mask: Optional[torch.FloatTensor] = None,
+        encoder_hidden_states: Optional[torch.Tensor] = None,
+        encoder_attention_mask: Optional[torch.FloatTensor] = None,
+        use_cache: Optional[bool] = False,
+        output_attentions: Optional[bool] = False,
+    ) -> Tuple[Union[torch.Tensor, Tuple[torch.Tensor]], ...]:
+        if output_attentions or head_mask is not None or self.reorder_and_upcast_attn:
+            logger.warning_once(
+                "GPT2SdpaAttention does not support `output_attentions=True`, `head_mask` or `reorder_and_upcast_attn`,"
+                " falling back to the eager attention."
+            )
+            return super().forward(
+                hidden_states,
+                layer_past=layer_past,
+                attention_mask=additive_attention_mask(attention_mask, hidden_states.dtype),
+                head_mask=head_mask,
+                encoder_hidden_states=encoder_hidden_states,
+                encoder_attention_mask=additive_attention_mask(encoder_attention_mask, hidden_states.dtype),
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+            )
+
+        if encoder_hidden_states is not None:
+            if not hasattr(self, "q_attn"):
+                raise ValueError(
+                    "If class is used as cross attention, the weights `q_attn` have to be defined. "
+                    "Please make sure to instantiate class with `GPT2Attention(..., is_cross_attention=True)`."
+                )
+
+            query = self.q_attn(hidden_states)
+            key, value = self.c_attn(encoder_hidden_states).split(self.split_size, dim=2)
+            attention_mask = encoder_attention_mask
+        else:
+            query, key, value = self.c_attn(hidden_states).split(self.split_size, dim=2)
+
+        query = self._split_heads(query, self.num_heads, self.head_dim)
+        key = self._split_heads(key, self.num_heads, self.head_dim)
+        value = self._split_heads(value, self.num_heads, self.head_dim)
+
+        if layer_past is not None:
+            past_key, past_value = layer_past
+            key = torch.cat((past_key, key), dim=-2)
+            value = torch.cat((past_value, value), dim=-2)
+
+        present = None
+        if use_cache is True:
+            present = (key, value)
+
+        # as in GPT2Attention._attn, the keys are rotated only when they match the queries
+        cos, sin = precompute_rotary_tables(self.head_dim, query.size(-2), query.device)
+        rotate_key = query.shape == key.shape
+        query = apply_rotary_emb_real(query, cos, sin)
+        if rotate_key:
+            key = apply_rotary_emb_real(key, cos, sin)
+
+        scale = 1.0
+        if self.scale_attn_weights:
+            scale /= float(value.size(-1)) ** 0.5
+        if self.scale_attn_by_inverse_layer_idx:
+            scale /= float(self.layer_idx + 1)
+
+        attn_output = F.scaled_dot_product_attention(
+            query,
+            key,
+            value,
+            attn_mask=attention_mask,
+            dropout_p=self.attn_dropout.p if self.training else 0.0,
+            scale=scale,
+        )
+
+        attn_output = self._merge_heads(attn_output, self.num_heads, self.head_dim)
+        attn_output = self.c_proj(attn_output)
+        attn_output = self.resid_dropout(attn_output)
+
+        return attn_output, present
+
+
 class GPT2MLP(nn.Module):
     def __init__(self, intermediate_size, config):
         super().__init__()
@@ -734,6 +863,7 @@ class GPT2MLP(nn.Module):
 GPT2_ATTENTION_CLASSES = {
     "eager": GPT2Attention,
     "flash_attention_2": GPT2FlashAttention2,
+    "sdpa": GPT2SdpaAttention,
 }
 
 
@@ -844,10 +974,18 @@ class GPT2PreTrainedModel(PreTrainedModel):
     _no_split_modules = ["GPT2Block"]
     _skip_keys_device_placement = "past_key_values"
     _supports_flash_attn_2 = True
+    _supports_sdpa = True
 
     def __init__(self, *inputs, **kwargs):
         super().__init__(*inputs, **kwargs)
 
+    @classmethod
+    def _check_and_enable_sdpa(cls, config, hard_check_only: bool = False):
+        # SDPA only when requested (`attn_implementation="sdpa"`), the eager attention stays the default
+        if not hard_check_only:
+            return config
+        return super()._check_and_enable_sdpa(config, hard_check_only=True)
+
     def _init_weights(self, module):
         """Initialize the weights."""
         if isinstance(module, (nn.Linear, Conv1D)):
@@ -1198,7 +1336,11 @@ class GPT2Model(GPT2PreTrainedModel):
 
         # Attention mask.
         if attention_mask is not None:
-            if attention_mask.dim() == 4:
+            if self._attn_implementation == "sdpa":
+                # A 4D boolean mask is taken as built by `sdpa_attention_mask` (once per solve by the caller).
+                if attention_mask.dtype != torch.bool or attention_mask.dim() != 4:
+                    attention_mask = sdpa_attention_mask(attention_mask)
+            elif attention_mask.dim() == 4:
                 attention_mask = attention_mask.to(dtype=self.dtype)
                 attention_mask = (1.0 - attention_mask) * torch.finfo(self.dtype).min
             else:
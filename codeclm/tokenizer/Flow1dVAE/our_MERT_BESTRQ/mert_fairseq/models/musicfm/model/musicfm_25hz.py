@@ -227,6 +227,54 @@ class MusicFM25Hz(nn.Module):
         }
         return logits, hidden_emb
 
+    @torch.no_grad()
+    def encode_layers(self, x, max_layer):
+        """2-layer conv + the w2v-conformer layers up to `max_layer`, the remaining layers are skipped
+
+        `max_layer` is either an int, then hidden states 0..max_layer are returned as in `encoder`,
+        or one int per row of the batch, then every row leaves the batch once it reached its own layer
+        and the hidden state of each row at its layer is returned (B, T, D)
+        """
+        conformer = self.conformer
+        num_layers = len(conformer.layers)
+        per_row = not isinstance(max_layer, int)
+        row_layers = list(max_layer) if per_row else [max_layer] * x.shape[0]
+        assert len(row_layers) == x.shape[0], "one layer per row is needed"
+        assert all(0 <= l <= num_layers for l in row_layers), "layer out of range"
+
+        x = self.conv(x)
+        x = conformer.dropout(x)
+        # relative / rotary position embeddings only depend on the length, they are shared by all rows
+        if conformer.embed_positions is not None:
+            relative_position_embeddings = conformer.embed_positions(x)
+        else:
+            relative_position_embeddings = None
+
+        hidden_emb = []
+        exit_emb = torch.empty_like(x) if per_row else None
+        rows = list(range(x.shape[0]))
+        for i in range(max(row_layers) + 1):
+            if i > 0:
+                x = conformer.layers[i - 1](
+                    x,
+                    attention_mask=None,
+                    relative_position_embeddings=relative_position_embeddings,
+                    output_attentions=False,
+                )[0]
+                if i == num_layers:
+                    x = conformer.layer_norm(x)
+            if not per_row:
+                hidden_emb.append(x)
+                continue
+            done = [j for j, r in enumerate(rows) if row_layers[r] == i]
+            if len(done) == 0:
+                continue
+            exit_emb[[rows[j] for j in done]] = x[done]
+            keep = [j for j, r in enumerate(rows) if row_layers[r] != i]
+            rows = [rows[j] for j in keep]
+            x = x[keep]
+        return exit_emb if per_row else tuple(hidden_emb)
+
     @torch.no_grad()
     def normalize(self, x):
         """normalize the input audio to have zero mean unit variance"""
@@ -264,11 +312,15 @@ class MusicFM25Hz(nn.Module):
         target_tokens = self.tokenize(x) # -> {'melspec_2048': Tensor{Size([3, 750]) cuda:0 i64}}
         return target_tokens
 
-    def get_predictions(self, x):
+    def get_predictions(self, x, max_layer=None):
         # preprocessing
         x = self.preprocessing(x, features=["melspec_2048"])
         x = self.normalize(x) # -> {'melspec_2048': Tensor{Size([3, 128, 3000]) cuda:0 f32}}
 
+        # early exit: no logits, only the hidden states up to max_layer
+        if max_layer is not None:
+            return None, self.encode_layers(x["melspec_2048"], max_layer)
+
         # encoding
         logits, hidden_emb = self.encoder(x["melspec_2048"])
 
@@ -73,12 +73,17 @@ class MusicFMModel(BaseFairseqModel):
         self,
         source: torch.Tensor, # B,L
         features_only: bool = False,
+        max_layer=None,
         **kwargs,
     ):
+        """max_layer (features_only): skip the encoder layers after it, as an int the layer_results
+        stop at max_layer, as one int per row "exit_results" holds each row at its own layer"""
         source = source[..., :int((source.shape[-1]//(SAMPLE_RATE//self.cfg.label_rate))*(SAMPLE_RATE//self.cfg.label_rate)) ]
         # logger.info("source shape: "+str(source.shape))
         if features_only:
-            _, hidden_states = self.model.get_predictions(source)
+            _, hidden_states = self.model.get_predictions(source, max_layer=max_layer)
+            if max_layer is not None and not isinstance(max_layer, int):
+                return {"exit_results": hidden_states}
             result = {
                 "layer_results": hidden_states
             }
@@ -0,0 +1,59 @@
+import functools
+import torch
+
+
+@functools.lru_cache(maxsize=8)
+def crossfade_window(ovlp_samples):
+    """
+    Linear fade-in and fade-out [1, ovlp_samples] of the overlap between two windows, cached:
+    the tensors are shared and must not be modified.
+    """
+    fade_in = torch.linspace(0, 1, ovlp_samples)[None, :]
+    return fade_in, 1 - fade_in
+
+
+class OverlapAdd(object):
+    """
+    Preallocated stitching of the decoded windows of a song. The output [C, target_len] is
+    allocated once, in pinned host memory with pin_memory (asynchronous device to host copies).
+    Every window is copied straight into its slice, and its first ovlp_samples are crossfaded in
+    place with the end of the previous window. Samples past target_len are dropped.
+    """
+    def __init__(self, target_len, ovlp_samples, pin_memory=False):
+        self.target_len = target_len
+        self.ovlp_samples = ovlp_samples
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.output = None
+        self.end = 0 # end of the last window, before truncation to target_len
+        self._pending = None # device of the last asynchronous copy
+
+    def _sync(self):
+        if(self._pending is not None):
+            torch.cuda.synchronize(self._pending)
+            self._pending = None
+
+    def add(self, window):
+        """Add the next window [C, n], on any device."""
+        if(self.output is None):
+            self.output = torch.empty(window.shape[0], self.target_len, dtype=torch.float32, pin_memory=self.pin_memory)
+            start, ovlp = 0, 0
+        else:
+            start, ovlp = self.end - self.ovlp_samples, self.ovlp_samples
+        self.end = start + window.shape[-1]
+        # the overlap is read back, the copy of the previous window has to be done
+        self._sync()
+        n = max(min(ovlp, self.target_len - start), 0)
+        if(n > 0):
+            fade_in, fade_out = crossfade_window(ovlp)
+            self.output[:, start:start+n].mul_(fade_out[:, :n]).add_(window[:, :n].float().cpu() * fade_in[:, :n])
+        n = max(min(self.end, self.target_len) - (start + ovlp), 0)
+        if(n > 0):
+            non_blocking = self.pin_memory and window.is_cuda
+            self.output[:, start+ovlp:start+ovlp+n].copy_(window[:, ovlp:ovlp+n], non_blocking=non_blocking)
+            if(non_blocking):
+                self._pending = window.device
+
+    def result(self):
+        """The stitched waveform [C, min(target_len, end of the last window)]."""
+        self._sync()
+        return self.output[:, :min(self.end, self.target_len)]
@@ -0,0 +1,100 @@
+import os
+import hashlib
+import threading
+import torch
+from tools.get_1dvae_large import get_model
+
+
+class SharedModels(object):
+    """
+    Process-wide registry of the frozen models used by several tokenizers (VAE, BEST-RQ): one
+    instance per key, built by the first acquire and freed when its last user releases it.
+    Shared models are in eval mode without gradients and must not be modified by their users.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, build):
+        with self._lock:
+            if(key not in self._entries):
+                model = build().eval()
+                for v in model.parameters():v.requires_grad = False
+                self._entries[key] = [model, 0]
+            self._entries[key][1] += 1
+            return self._entries[key][0]
+
+    def release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if(entry is None):
+                return
+            entry[1] -= 1
+            if(entry[1] > 0):
+                return
+            del self._entries[key]
+        del entry
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def refcount(self, key):
+        entry = self._entries.get(key)
+        return 0 if entry is None else entry[1]
+
+
+SHARED_MODELS = SharedModels()
+
+
+def weights_digest(state_dict):
+    """Content hash of a state dict, to tell apart models built from the same files but different weights."""
+    hasher = hashlib.sha1()
+    for k in sorted(state_dict):
+        v = state_dict[k].detach().cpu().contiguous()
+        hasher.update("{}{}{};".format(k, tuple(v.shape), v.dtype).encode())
+        hasher.update(v.flatten().view(torch.uint8).numpy().tobytes())
+    return hasher.hexdigest()
+
+
+_checkpoint_digests = {}
+
+
+def checkpoint_digest(path, name, state_dict):
+    """
+    weights_digest of the state_dict of name in the checkpoint at path, hashed once per process and
+    version of the file: tokenizers built again from the same checkpoint reuse it.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, name)
+    if(key not in _checkpoint_digests):
+        _checkpoint_digests[key] = weights_digest(state_dict)
+    return _checkpoint_digests[key]
+
+
+def _device_key(device):
+    # 'cuda' and 'cuda:0' are the same device for the registry
+    device = torch.device(device)
+    if(device.type == 'cuda' and device.index is None):
+        device = torch.device('cuda', torch.cuda.current_device())
+    return str(device)
+
+
+def vae_key(vae_config, vae_model, device):
+    return ('vae', os.path.abspath(vae_config), os.path.abspath(vae_model), _device_key(device))
+
+
+def acquire_vae(vae_config, vae_model, device):
+    """The shared VAE of vae_config / vae_model on device, to be released with release_vae."""
+    return SHARED_MODELS.acquire(vae_key(vae_config, vae_model, device),
+                                 lambda: get_model(vae_config, vae_model).to(device))
+
+
+def release_vae(vae_config, vae_model, device):
+    SHARED_MODELS.release(vae_key(vae_config, vae_model, device))
+
+
+def bestrq_key(model_dir, checkpoint_dir, digest, device):
+    """
+    Key of a BEST-RQ built from model_dir / checkpoint_dir, then loaded with the weights of digest (their
+    weights_digest, None without weights). The digest is computed once by the caller, not at every build.
+    """
+    return ('bestrq', os.path.abspath(model_dir), os.path.abspath(checkpoint_dir), digest, _device_key(device))
@@ -0,0 +1,129 @@
+import os
+import glob
+import json
+import numpy as np
+
+TOKEN_DTYPE = np.int16
+
+
+def read_index(index_path):
+    """Entries of a shard index and the bytes of its complete lines (a stopped writer can leave a partial last line)."""
+    entries, valid_bytes = [], 0
+    if(not os.path.exists(index_path)):
+        return entries, valid_bytes
+    with open(index_path, 'rb') as f:
+        for line in f:
+            if(not line.endswith(b'\n')):
+                break
+            entries.append(json.loads(line))
+            valid_bytes += len(line)
+    return entries, valid_bytes
+
+
+def shard_prefixes(root):
+    return sorted(path[:-len('.idx')] for path in glob.glob(os.path.join(root, '*.idx')))
+
+
+def completed_keys(root):
+    """Keys of the items stored in any shard of root."""
+    keys = set()
+    for prefix in shard_prefixes(root):
+        keys.update(entry['key'] for entry in read_index(prefix + '.idx')[0])
+    return keys
+
+
+class TokenShardWriter(object):
+    """
+    Append-only shard of a token store: the codes [R, T] of every item are packed as int16 in
+    <prefix>.bin, and <prefix>.idx holds one json line per item with its key, offset and shape (in
+    tokens). The index line of an item is only written once its codes are on disk, so the index is
+    also the completion manifest of the shard: reopening a shard drops whatever a stopped writer
+    left after its last complete item.
+    """
+    def __init__(self, prefix):
+        self.bin_path, self.index_path = prefix + '.bin', prefix + '.idx'
+        entries, valid_bytes = read_index(self.index_path)
+        self.keys = set(entry['key'] for entry in entries)
+        self.offset = max([entry['offset'] + int(np.prod(entry['shape'])) for entry in entries], default=0)
+        nbytes = self.offset * np.dtype(TOKEN_DTYPE).itemsize
+        if(os.path.exists(self.index_path)):
+            os.truncate(self.index_path, valid_bytes)
+        if(os.path.exists(self.bin_path)):
+            assert os.path.getsize(self.bin_path) >= nbytes, (self.bin_path, os.path.getsize(self.bin_path), nbytes)
+            os.truncate(self.bin_path, nbytes)
+        else:
+            assert nbytes == 0, (self.bin_path, nbytes)
+        self.bin_file = open(self.bin_path, 'ab')
+        self.index_file = open(self.index_path, 'a')
+
+    def write(self, key, codes):
+        codes = np.asarray(codes)
+        assert codes.ndim == 2 and codes.size > 0, codes.shape
+        info = np.iinfo(TOKEN_DTYPE)
+        assert codes.min() >= info.min and codes.max() <= info.max, (key, codes.min(), codes.max())
+        assert key not in self.keys, key
+        self.bin_file.write(np.ascontiguousarray(codes, dtype=TOKEN_DTYPE).tobytes())
+        self.bin_file.flush()
+        os.fsync(self.bin_file.fileno())
+        self.index_file.write(json.dumps({'key': key, 'offset': self.offset, 'shape': list(codes.shape)}) + '\n')
+        self.index_file.flush()
+        self.offset += codes.size
+        self.keys.add(key)
+
+    def close(self):
+        self.bin_file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TokenShardReader(object):
+    """Codes of the items of one shard, as read-only views [R, T] of the memory-mapped <prefix>.bin."""
+    def __init__(self, prefix):
+        entries, _ = read_index(prefix + '.idx')
+        self.entries = {entry['key']: (entry['offset'], tuple(entry['shape'])) for entry in entries}
+        # only the items indexed when the shard is opened are mapped, a writer may still be appending
+        num_tokens = max([offset + int(np.prod(shape)) for offset, shape in self.entries.values()], default=0)
+        if(num_tokens > 0):
+            self.tokens = np.memmap(prefix + '.bin', dtype=TOKEN_DTYPE, mode='r', shape=(num_tokens,))
+        else:
+            self.tokens = np.zeros(0, dtype=TOKEN_DTYPE)
+
+    def __getitem__(self, key):
+        offset, shape = self.entries[key]
+        return self.tokens[offset:offset + int(np.prod(shape))].reshape(shape)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
+
+
+class TokenStore(object):
+    """All the shards of a token store directory, by item key."""
+    def __init__(self, root):
+        self.shards = [TokenShardReader(prefix) for prefix in shard_prefixes(root)]
+        self.key2shard = {}
+        for shard in self.shards:
+            for key in shard.keys():
+                self.key2shard[key] = shard
+
+    def __getitem__(self, key):
+        return self.key2shard[key][key]
+
+    def __contains__(self, key):
+        return key in self.key2shard
+
+    def __len__(self):
+        return len(self.key2shard)
+
+    def keys(self):
+        return self.key2shard.keys()
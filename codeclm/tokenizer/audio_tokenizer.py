@@ -5,6 +5,7 @@ Also defines the main interface that a model must follow to be usable as an audi
 
 from abc import ABC, abstractmethod
 import logging
+import threading
 import typing as tp
 import torch
 from torch import nn
@@ -78,20 +79,23 @@ class AudioTokenizer(ABC, nn.Module):
             vae_config: str,
             vae_model: str,
             device: tp.Union[torch.device, str] = 'cpu', 
-            mode='extract'
+            mode='extract',
+            encoder_loading: str = 'lazy',
             ) -> 'AudioTokenizer':
         """Instantiate a AudioTokenizer model from a given pretrained model.
 
         Args:
             name (Path or str): name of the pretrained model. See after.
             device (torch.device or str): Device on which the model is loaded.
+            encoder_loading (str): Loading of the feature encoders of the separate tokenizer,
+                'eager', 'lazy' (on first encode) or 'decode_only' (never, encode is unavailable).
         """
 
         model: AudioTokenizer
         if name.split('_')[0] == 'Flow1dVAESeparate':
             model_type = name.split('_', 1)[1]
             logger.info("Getting pretrained compression model from semantic model %s", model_type)
-            model = Flow1dVAESeparate(model_type, vae_config, vae_model)
+            model = Flow1dVAESeparate(model_type, vae_config, vae_model, encoder_loading=encoder_loading)
         elif name.split('_')[0] == 'Flow1dVAE1rvq':
             model_type = name.split('_', 1)[1]
             logger.info("Getting pretrained compression model from semantic model %s", model_type)
@@ -100,7 +104,46 @@ class AudioTokenizer(ABC, nn.Module):
             raise NotImplementedError("{} is not implemented in models/audio_tokenizer.py".format(
                 name))
         return model.to(device).eval()
-    
+
+
+class ProgressiveCodes:
+    """Codes of a song that is still being generated, handed from the LM to a decoder running in
+    another thread. The producer `update`s the codes generated so far and `finish`es with the final
+    codes (or `fail`s), the decoder `wait`s until enough of them are available.
+    The codes are a list [codes_vocal, codes_bgm] of [1, 1, T] tensors, T growing with the updates.
+    """
+    def __init__(self):
+        self._codes: tp.Optional[tp.List[torch.Tensor]] = None
+        self._final = False
+        self._failed = False
+        self._cond = threading.Condition()
+
+    def update(self, codes: tp.List[torch.Tensor]):
+        with self._cond:
+            self._codes = codes
+            self._cond.notify_all()
+
+    def finish(self, codes: tp.List[torch.Tensor]):
+        with self._cond:
+            self._codes = codes
+            self._final = True
+            self._cond.notify_all()
+
+    def fail(self):
+        with self._cond:
+            self._failed = True
+            self._cond.notify_all()
+
+    def wait(self, length: int) -> tp.Tuple[tp.List[torch.Tensor], bool]:
+        """Block until at least `length` frames are generated or the song is final.
+        Returns the codes so far and whether they are final."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._failed or self._final or
+                                (self._codes is not None and self._codes[0].shape[-1] >= length))
+            if self._failed:
+                raise RuntimeError("the generation of the codes failed")
+            return self._codes, self._final
+
 
 class Flow1dVAE1rvq(AudioTokenizer):
     def __init__(
@@ -122,6 +165,11 @@ class Flow1dVAE1rvq(AudioTokenizer):
     def forward(self, x: torch.Tensor) :
         # We don't support training with this.
         raise NotImplementedError("Forward and training with DAC not supported.")
+
+    def release(self):
+        """Release the VAE and BEST-RQ shared with the other tokenizers of the process, see `SharedModels`.
+        The tokenizer is unusable afterwards."""
+        self.model.release()
     
     @torch.no_grad()
     def encode(self, x: torch.Tensor) -> tp.Tuple[torch.Tensor, tp.Optional[torch.Tensor]]:
@@ -183,12 +231,14 @@ class Flow1dVAESeparate(AudioTokenizer):
         model_type: str = "model_2.safetensors",
         vae_config: str = "",
         vae_model: str = "",
+        encoder_loading: str = 'lazy',
         ):
         super().__init__()
 
         from codeclm.tokenizer.Flow1dVAE.generate_septoken import Tango
         model_path = model_type
-        self.model = Tango(model_path=model_path, vae_config=vae_config, vae_model=vae_model, device='cuda')
+        self.model = Tango(model_path=model_path, vae_config=vae_config, vae_model=vae_model, device='cuda',
+                           encoder_loading=encoder_loading)
         print ("Successfully loaded checkpoint from:", model_path)
 
             
@@ -204,15 +254,69 @@ class Flow1dVAESeparate(AudioTokenizer):
             x_vocal = x_vocal.unsqueeze(1)
         if x_bgm.ndim == 2:
             x_bgm = x_bgm.unsqueeze(1)
-        codes_vocal, codes_bgm = self.model.sound2code(x_vocal, x_bgm)
+        if x_vocal.shape[0] == 1:
+            # a single prompt goes through the prompt cache, shared with the decoding of its song
+            codes_vocal, codes_bgm = self.model.sound2code_cached(x_vocal, x_bgm)
+        else:
+            codes_vocal, codes_bgm = self.model.sound2code(x_vocal, x_bgm)
         return codes_vocal, codes_bgm
     
+    def release_encoders(self):
+        """Free the feature encoders used by `encode`, they are loaded again on the next `encode`."""
+        self.model.release_encoders()
+
+    def release(self):
+        """Release the VAE and encoders shared with the other tokenizers of the process, see `SharedModels`.
+        The tokenizer is unusable afterwards."""
+        self.model.release()
+
     @torch.no_grad()    
-    def decode(self, codes: torch.Tensor, prompt_vocal = None, prompt_bgm = None, chunked=False):
-        wav = self.model.code2sound(codes, prompt_vocal=prompt_vocal, prompt_bgm=prompt_bgm, guidance_scale=1.5, 
-                                    num_steps=50, disable_progress=False, chunked=chunked) # [B,N,T] -> [B,T]
+    def decode(self, codes: torch.Tensor, prompt_vocal = None, prompt_bgm = None, chunked=False,
+               num_steps: int = 50, solver: str = 'euler', t_schedule: str = 'linear',
+               guidance_scale: tp.Union[float, tp.List[float]] = 1.5,
+               guidance_interval: tp.Tuple[float, float] = (0., 1.)):
+        wav = self.model.code2sound(codes, prompt_vocal=prompt_vocal, prompt_bgm=prompt_bgm, guidance_scale=guidance_scale,
+                                    num_steps=num_steps, disable_progress=False, chunked=chunked,
+                                    solver=solver, t_schedule=t_schedule,
+                                    guidance_interval=guidance_interval) # [B,N,T] -> [B,T]
         return wav[None]
 
+    @torch.no_grad()
+    def decode_batch(self, codes: tp.List[tp.List[torch.Tensor]], prompt_vocal = None, prompt_bgm = None, chunked=False,
+                     num_steps: int = 50, solver: str = 'euler', t_schedule: str = 'linear',
+                     guidance_scale: tp.Union[float, tp.List[float]] = 1.5,
+                     guidance_interval: tp.Tuple[float, float] = (0., 1.)) -> tp.List[torch.Tensor]:
+        """Decode several songs of any length together, `codes` holding the [vocal, bgm] codes of each song.
+        The prompts are shared by all songs or given as one per song."""
+        wavs = self.model.code2sound(list(codes), prompt_vocal=prompt_vocal, prompt_bgm=prompt_bgm, guidance_scale=guidance_scale,
+                                     num_steps=num_steps, disable_progress=False, chunked=chunked,
+                                     solver=solver, t_schedule=t_schedule, guidance_interval=guidance_interval)
+        return [wav[None] for wav in wavs]
+
+    @torch.no_grad()
+    def decode_stream(self, codes: torch.Tensor, prompt_vocal = None, prompt_bgm = None, chunked=False,
+                      num_steps: int = 50, solver: str = 'euler', t_schedule: str = 'linear',
+                      guidance_scale: tp.Union[float, tp.List[float]] = 1.5,
+                      guidance_interval: tp.Tuple[float, float] = (0., 1.)) -> tp.Iterator[torch.Tensor]:
+        """Same as `decode`, yielding the audio [1, 2, n] window by window as soon as it is final."""
+        for wav in self.model.code2sound_stream(codes, prompt_vocal=prompt_vocal, prompt_bgm=prompt_bgm, guidance_scale=guidance_scale,
+                                                num_steps=num_steps, disable_progress=False, chunked=chunked,
+                                                solver=solver, t_schedule=t_schedule,
+                                                guidance_interval=guidance_interval):
+            yield wav[None]
+
+    def decode_progressive(self, source: ProgressiveCodes, prompt_vocal = None, prompt_bgm = None, chunked=False,
+                           num_steps: int = 50, solver: str = 'euler', t_schedule: str = 'linear',
+                           guidance_scale: tp.Union[float, tp.List[float]] = 1.5,
+                           guidance_interval: tp.Tuple[float, float] = (0., 1.)) -> tp.Iterator[torch.Tensor]:
+        """Same as `decode_stream` for codes still being generated, see `ProgressiveCodes`: each window is
+        decoded as soon as its codes are generated."""
+        for wav in self.model.code2sound_progressive(source, prompt_vocal=prompt_vocal, prompt_bgm=prompt_bgm,
+                                                     guidance_scale=guidance_scale, num_steps=num_steps, disable_progress=False,
+                                                     chunked=chunked, solver=solver, t_schedule=t_schedule,
+                                                     guidance_interval=guidance_interval):
+            yield wav[None]
+
     
     @torch.no_grad()
     def decode_latent(self, codes: torch.Tensor):
@@ -0,0 +1,173 @@
+"""
+Vocal / accompaniment separation in memory, of whole songs or of the prompt audio with a cache of the stems.
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+import typing as tp
+
+import torch
+import torchaudio
+
+Stems = tp.Tuple[torch.Tensor, torch.Tensor, torch.Tensor]
+
+
+def fit_prompt_window(wav: torch.Tensor, length: int) -> torch.Tensor:
+    """Cut `wav` [C, T] to its first `length` samples, a shorter one is repeated once first."""
+    if wav.shape[-1] < length:
+        wav = torch.cat([wav, wav], -1)
+    return wav[..., :length]
+
+
+class StemCache:
+    """Cache of separated prompts keyed by the content hash of the audio file and the prompt window.
+    Entries are kept in memory, and on disk in `cache_dir` if given, so that they survive the process.
+    Both levels evict the least recently used entries to stay under their size budget.
+
+    Args:
+        cache_dir (str, optional): Directory of the on-disk cache, memory only if None.
+        max_memory_bytes (int): Budget of the in-memory entries.
+        max_disk_bytes (int): Budget of the files in `cache_dir`.
+    """
+    def __init__(self, cache_dir: tp.Optional[str] = None, max_memory_bytes: int = 512 * 1024 ** 2,
+                 max_disk_bytes: int = 4 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: tp.OrderedDict[str, Stems] = OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(audio_path: str, *params: tp.Any) -> str:
+        """Content hash of the file at `audio_path` and of the separation parameters."""
+        hasher = hashlib.sha1()
+        with open(audio_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                hasher.update(block)
+        hasher.update(repr(params).encode())
+        return hasher.hexdigest()
+
+    def _path(self, key: str) -> str:
+        assert self.cache_dir is not None
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def get(self, key: str) -> tp.Optional[Stems]:
+        stems = self._entries.get(key)
+        if stems is not None:
+            self._entries.move_to_end(key)
+        elif self.cache_dir is not None and os.path.exists(self._path(key)):
+            stems = tuple(torch.load(self._path(key), map_location='cpu'))
+            os.utime(self._path(key))
+            self._put_memory(key, stems)
+        if stems is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return stems
+
+    def put(self, key: str, stems: Stems):
+        stems = tuple(stem.detach().cpu() for stem in stems)
+        self._put_memory(key, stems)
+        if self.cache_dir is not None:
+            tmp_path = self._path(key) + '.tmp'
+            torch.save(list(stems), tmp_path)
+            os.replace(tmp_path, self._path(key))
+            self._evict_disk()
+
+    def _put_memory(self, key: str, stems: Stems):
+        nbytes = sum(stem.numel() * stem.element_size() for stem in stems)
+        if nbytes > self.max_memory_bytes:
+            return
+        if key in self._entries:
+            self.nbytes -= sum(stem.numel() * stem.element_size() for stem in self._entries.pop(key))
+        self._entries[key] = stems
+        self.nbytes += nbytes
+        while self.nbytes > self.max_memory_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= sum(stem.numel() * stem.element_size() for stem in evicted)
+
+    def _evict_disk(self):
+        files = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.pt')]
+        files = sorted(files, key=os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in files)
+        for path in files:
+            if total <= self.max_disk_bytes:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+
+@torch.no_grad()
+def separate_sources(demucs_model, wav: torch.Tensor, fs: int, device: torch.device) -> torch.Tensor:
+    """Separate all the sources of `wav` [C, T] sampled at `fs`, without going through files.
+
+    Args:
+        demucs_model: Demucs model, as built by `get_model_from_yaml`.
+        wav (torch.Tensor): Audio to separate, [C, T].
+        fs (int): Sample rate of `wav`.
+        device (torch.device): Device of the separation.
+    Returns:
+        torch.Tensor: Sources [S, C, T] in the order of `demucs_model.sources`, at the sample rate of
+            the model and on `device`.
+    """
+    from third_party.demucs.models.apply import apply_model
+
+    mix = torchaudio.functional.resample(wav, fs, demucs_model.samplerate) if fs != demucs_model.samplerate else wav
+    if mix.shape[0] < demucs_model.audio_channels:
+        mix = mix.repeat(demucs_model.audio_channels, 1)
+    # normalized as by the separation of demucs
+    ref = mix.mean(0)
+    mix = (mix - ref.mean()) / ref.std()
+    sources = apply_model(demucs_model, mix[None].to(device), device=device)[0]
+    return sources * ref.std().to(sources.device) + ref.mean().to(sources.device)
+
+
+@torch.no_grad()
+def separate_prompt(demucs_model, audio_path: str, device: torch.device, sample_rate: int = 48000,
+                    seconds: float = 10., fit: bool = True, cache: tp.Optional[StemCache] = None) -> Stems:
+    """Separate the vocals of the prompt window of an audio file, without going through files.
+
+    Only the first `seconds` of the audio are separated, as only they are kept as prompt. Stems come
+    back at `sample_rate`, cut (or repeated once, if shorter and `fit`) to the prompt window like the audio.
+
+    Args:
+        demucs_model: Demucs model, as built by `get_model_from_yaml`.
+        audio_path (str): Path of the prompt audio.
+        device (torch.device): Device of the separation.
+        sample_rate (int): Sample rate of the returned audio.
+        seconds (float): Length of the prompt window.
+        fit (bool): Whether audio shorter than the window is repeated, see `fit_prompt_window`.
+        cache (StemCache, optional): Cache of the separated prompts.
+    Returns:
+        tuple of torch.Tensor: Full audio, vocals and accompaniment (full audio minus vocals), [C, T].
+    """
+    key = None
+    if cache is not None:
+        key = StemCache.make_key(audio_path, sample_rate, seconds, fit, list(demucs_model.sources))
+        stems = cache.get(key)
+        if stems is not None:
+            return stems
+
+    length = int(sample_rate * seconds)
+    wav, fs = torchaudio.load(audio_path)
+    wav = wav[..., :int(fs * seconds)]
+    sources = separate_sources(demucs_model, wav, fs, device)
+    vocal = sources[demucs_model.sources.index('vocals')].cpu()
+
+    if fs != sample_rate:
+        wav = torchaudio.functional.resample(wav, fs, sample_rate)
+    if demucs_model.samplerate != sample_rate:
+        vocal = torchaudio.functional.resample(vocal, demucs_model.samplerate, sample_rate)
+    full_audio = fit_prompt_window(wav, length) if fit else wav[..., :length]
+    vocal_audio = fit_prompt_window(vocal, length) if fit else vocal[..., :length]
+    length = min(full_audio.shape[-1], vocal_audio.shape[-1])
+    full_audio, vocal_audio = full_audio[..., :length], vocal_audio[..., :length]
+    stems = (full_audio, vocal_audio, full_audio - vocal_audio)
+    if cache is not None:
+        cache.put(key, stems)
+    return stems
@@ -142,6 +142,35 @@ def collate(tensors: tp.List[torch.Tensor], dim: int = 0) -> tp.Tuple[torch.Tens
     padded_tensors = padded_tensors.transpose(1, dim + 1)
     return padded_tensors, lens
 
+def content_hash(*inputs: tp.Any) -> str:
+    """SHA-1 of texts, tensors (shape, dtype and values) and nested lists, tuples and dicts of them,
+    the key of the caches of encoded conditions and of prefilled prefixes.
+
+    Args:
+        *inputs: Values to hash, anything else than tensors and containers is hashed by its `repr`.
+    Returns:
+        str: Hexadecimal digest.
+    """
+    hasher = hashlib.sha1()
+
+    def _update(x):
+        if isinstance(x, torch.Tensor):
+            hasher.update(f"tensor{tuple(x.shape)},{x.dtype};".encode())
+            hasher.update(x.detach().cpu().contiguous().numpy().tobytes())
+        elif isinstance(x, (list, tuple)):
+            hasher.update(f"list{len(x)};".encode())
+            for item in x:
+                _update(item)
+        elif isinstance(x, dict):
+            hasher.update(f"dict{len(x)};".encode())
+            for key in sorted(x):
+                hasher.update(f"{key!r}=".encode())
+                _update(x[key])
+        else:
+            hasher.update(f"{x!r};".encode())
+    _update(inputs)
+    return hasher.hexdigest()
+
 def sample_top_k(probs: torch.Tensor, k: int) -> torch.Tensor:
     """Sample next token from top K values along the last dimension of the input probs tensor.
 
@@ -3,6 +3,9 @@ import os
 
 import time
 import json
+import queue
+import threading
+from contextlib import nullcontext
 import torch
 import torchaudio
 import numpy as np
@@ -11,16 +14,19 @@ from omegaconf import OmegaConf
 from codeclm.trainer.codec_song_pl import CodecLM_PL
 from codeclm.models import CodecLM
 from third_party.demucs.models.pretrained import get_model_from_yaml
+from codeclm.utils.separation import StemCache, separate_prompt
 
 auto_prompt_type = ['Pop', 'R&B', 'Dance', 'Jazz', 'Folk', 'Rock', 'Chinese Style', 'Chinese Tradition', 'Metal', 'Reggae', 'Chinese Opera', 'Auto']
 
 class Separator:
-    def __init__(self, dm_model_path='third_party/demucs/ckpt/htdemucs.pth', dm_config_path='third_party/demucs/ckpt/htdemucs.yaml', gpu_id=0) -> None:
+    def __init__(self, dm_model_path='third_party/demucs/ckpt/htdemucs.pth', dm_config_path='third_party/demucs/ckpt/htdemucs.yaml', gpu_id=0,
+                 stem_cache_dir=None) -> None:
         if torch.cuda.is_available() and gpu_id < torch.cuda.device_count():
             self.device = torch.device(f"cuda:{gpu_id}")
         else:
             self.device = torch.device("cpu")
         self.demucs_model = self.init_demucs_model(dm_model_path, dm_config_path)
+        self.stem_cache = StemCache(stem_cache_dir)
 
     def init_demucs_model(self, model_path, config_path):
         model = get_model_from_yaml(config_path, model_path)
@@ -38,26 +44,68 @@ class Separator:
             a = torch.cat([a, a], -1)
         return a[:, 0:48000*10]
     
-    def run(self, audio_path, output_dir='tmp', ext=".flac"):
-        os.makedirs(output_dir, exist_ok=True)
-        name, _ = os.path.splitext(os.path.split(audio_path)[-1])
-        output_paths = []
-
-        for stem in self.demucs_model.sources:
-            output_path = os.path.join(output_dir, f"{name}_{stem}{ext}")
-            if os.path.exists(output_path):
-                output_paths.append(output_path)
-        if len(output_paths) == 1:  # 4
-            vocal_path = output_paths[0]
-        else:
-            drums_path, bass_path, other_path, vocal_path = self.demucs_model.separate(audio_path, output_dir, device=self.device)
-            for path in [drums_path, bass_path, other_path]:
-                os.remove(path)
-        full_audio = self.load_audio(audio_path)
-        vocal_audio = self.load_audio(vocal_path)
-        bgm_audio = full_audio - vocal_audio
-        return full_audio, vocal_audio, bgm_audio
+    def run(self, audio_path):
+        return separate_prompt(self.demucs_model, audio_path, self.device, cache=self.stem_cache)
+
+
+
+class PipelineStage(threading.Thread):
+    """Worker thread of the batch pipeline: applies `fn` to the jobs (dicts) of the `inputs` queue and
+    puts them on the bounded `outputs` queue, so that consecutive items are processed by the different
+    stages at the same time. Each stage issues its GPU work on its own CUDA stream; a job carries the
+    event recorded at the end of the previous stage, which the next one waits for before using it.
+    `None` marks the end of the jobs. After an error, the error is kept in `self.error` and the `stop`
+    event shared by the stages is set: every stage then skips its remaining jobs, which are drained so
+    that the other stages do not block.
+    """
+    def __init__(self, name, fn, inputs: queue.Queue, outputs: queue.Queue = None, stop: threading.Event = None):
+        super().__init__(name=name, daemon=True)
+        self.fn = fn
+        self.inputs = inputs
+        self.outputs = outputs
+        self.stop = threading.Event() if stop is None else stop
+        self.error = None
+
+    def run(self):
+        stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        try:
+            with torch.no_grad(), (torch.cuda.stream(stream) if stream is not None else nullcontext()):
+                while True:
+                    job = self.inputs.get()
+                    if job is None:
+                        break
+                    if self.stop.is_set():
+                        # another stage failed, the job would be thrown away
+                        continue
+                    if job.get('event') is not None:
+                        torch.cuda.current_stream().wait_event(job['event'])
+                        _record_stream(job, torch.cuda.current_stream())
+                    start = time.time()
+                    job = self.fn(job)
+                    job[f'{self.name}_time'] = time.time() - start
+                    job['event'] = None
+                    if stream is not None:
+                        job['event'] = torch.cuda.Event()
+                        job['event'].record(stream)
+                    if self.outputs is not None:
+                        self.outputs.put(job)
+        except BaseException as e:
+            self.error = e
+            self.stop.set()
+            while self.inputs.get() is not None:
+                pass
+        finally:
+            if self.outputs is not None:
+                self.outputs.put(None)
+
 
+def _record_stream(job, stream):
+    """Tensors of a job are allocated on the stream of the previous stage and used on `stream`."""
+    for value in job.values():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        for x in values:
+            if isinstance(x, torch.Tensor) and x.is_cuda:
+                x.record_stream(stream)
 
 
 if __name__ == "__main__":
@@ -112,10 +160,12 @@ if __name__ == "__main__":
     with open(input_jsonl, "r") as fp:
         lines = fp.readlines()
 
-    new_items = []
-    for line in lines:
-        item = json.loads(line)
-        target_wav_name = f"{save_dir}/audios/{item['idx']}.flac"
+    # the prompt tokenizers are used by the first and last stages
+    tokenizer_lock = threading.Lock()
+
+    def prepare(job):
+        """Stage 1: prompt separation and tokenization."""
+        item = json.loads(job['line'])
         lyric = item["gt_lyric"]
         descriptions = item["descriptions"] if "descriptions" in item else None
         # get prompt audio
@@ -139,33 +189,59 @@ if __name__ == "__main__":
             vocal_wav = None
             bgm_wav = None
             melody_is_wav = True
-            
-        generate_inp = {
-            'lyrics': [lyric.replace("  ", " ")],
-            'descriptions': [descriptions],
-            'melody_wavs': pmt_wav,
-            'vocal_wavs': vocal_wav,
-            'bgm_wavs': bgm_wav,
-            'melody_is_wav': melody_is_wav,
-        }
-        start_time = time.time()
+        with (tokenizer_lock if melody_is_wav else nullcontext()), \
+                torch.autocast(device_type="cuda", dtype=torch.float16):
+            texts, audio_qt_embs = model.prepare_inputs([lyric.replace("  ", " ")], pmt_wav, melody_is_wav,
+                                                        vocal_wav, bgm_wav)
+        job.update(item=item, descriptions=[descriptions], texts=texts, audio_qt_embs=audio_qt_embs,
+                   melody_is_wav=melody_is_wav, pmt_wav=pmt_wav, vocal_wav=vocal_wav, bgm_wav=bgm_wav)
+        return job
+
+    def lm_decode(job):
+        """Stage 2: LM token generation."""
         with torch.autocast(device_type="cuda", dtype=torch.float16):
-            tokens = model.generate(**generate_inp, return_tokens=True)
-        mid_time = time.time()
-            
-        with torch.no_grad():
-            if melody_is_wav:   
-                wav_seperate = model.generate_audio(tokens, pmt_wav, vocal_wav, bgm_wav)
+            job['tokens'] = model.generate_tokens(job['texts'], job['descriptions'], job['audio_qt_embs'])
+        return job
+
+    def audio_decode(job):
+        """Stage 3: diffusion / VAE decoding and FLAC encoding."""
+        start_time = time.time()
+        item = job['item']
+        target_wav_name = f"{save_dir}/audios/{item['idx']}.flac"
+        with tokenizer_lock:
+            if job['melody_is_wav']:
+                wav_seperate = model.generate_audio(job['tokens'], job['pmt_wav'], job['vocal_wav'], job['bgm_wav'])
             else:
-                wav_seperate = model.generate_audio(tokens)
-        end_time = time.time()
+                wav_seperate = model.generate_audio(job['tokens'])
         torchaudio.save(target_wav_name, wav_seperate[0].cpu().float(), cfg.sample_rate)
-        print(f"process{item['idx']}, lm cost {mid_time - start_time}s, diffusion cost {end_time - mid_time}")
-
+        print(f"process{item['idx']}, prepare cost {job['prepare_time']:.3f}s, "
+              f"lm cost {job['lm_time']:.3f}s, diffusion cost {time.time() - start_time:.3f}s")
         item["idx"] = f"{item['idx']}"
         item["wav_path"] = target_wav_name
         new_items.append(item)
-    
+        return job
+
+    new_items = []
+    wall_start = time.time()
+    queues = [queue.Queue(maxsize=2) for _ in range(3)]
+    stop = threading.Event()
+    stages = [PipelineStage('prepare', prepare, queues[0], queues[1], stop),
+              PipelineStage('lm', lm_decode, queues[1], queues[2], stop),
+              PipelineStage('decode', audio_decode, queues[2], stop=stop)]
+    for stage in stages:
+        stage.start()
+    for line in lines:
+        if stop.is_set():
+            break
+        queues[0].put({'line': line})
+    queues[0].put(None)
+    for stage in stages:
+        stage.join()
+    for stage in stages:
+        if stage.error is not None:
+            raise stage.error
+    print(f"processed {len(new_items)} items in {time.time() - wall_start:.1f}s")
+
     src_jsonl_name = os.path.split(input_jsonl)[-1]
     with open(f"{save_dir}/jsonl/{src_jsonl_name}.jsonl", "w", encoding='utf-8') as fw:
         for item in new_items:
@@ -12,16 +12,19 @@ from codeclm.models import builders
 from codeclm.trainer.codec_song_pl import CodecLM_PL
 from codeclm.models import CodecLM
 from third_party.demucs.models.pretrained import get_model_from_yaml
+from codeclm.utils.separation import StemCache, separate_prompt
 
 auto_prompt_type = ['Pop', 'R&B', 'Dance', 'Jazz', 'Folk', 'Rock', 'Chinese Style', 'Chinese Tradition', 'Metal', 'Reggae', 'Chinese Opera', 'Auto']
 
 class Separator:
-    def __init__(self, dm_model_path='third_party/demucs/ckpt/htdemucs.pth', dm_config_path='third_party/demucs/ckpt/htdemucs.yaml', gpu_id=0) -> None:
+    def __init__(self, dm_model_path='third_party/demucs/ckpt/htdemucs.pth', dm_config_path='third_party/demucs/ckpt/htdemucs.yaml', gpu_id=0,
+                 stem_cache_dir=None) -> None:
         if torch.cuda.is_available() and gpu_id < torch.cuda.device_count():
             self.device = torch.device(f"cuda:{gpu_id}")
         else:
             self.device = torch.device("cpu")
         self.demucs_model = self.init_demucs_model(dm_model_path, dm_config_path)
+        self.stem_cache = StemCache(stem_cache_dir)
 
     def init_demucs_model(self, model_path, config_path):
         model = get_model_from_yaml(config_path, model_path)
@@ -39,25 +42,8 @@ class Separator:
             a = torch.cat([a, a], -1)
         return a[:, 0:48000*10]
     
-    def run(self, audio_path, output_dir='tmp', ext=".flac"):
-        os.makedirs(output_dir, exist_ok=True)
-        name, _ = os.path.splitext(os.path.split(audio_path)[-1])
-        output_paths = []
-
-        for stem in self.demucs_model.sources:
-            output_path = os.path.join(output_dir, f"{name}_{stem}{ext}")
-            if os.path.exists(output_path):
-                output_paths.append(output_path)
-        if len(output_paths) == 1:  # 4
-            vocal_path = output_paths[0]
-        else:
-            drums_path, bass_path, other_path, vocal_path = self.demucs_model.separate(audio_path, output_dir, device=self.device)
-            for path in [drums_path, bass_path, other_path]:
-                os.remove(path)
-        full_audio = self.load_audio(audio_path)
-        vocal_audio = self.load_audio(vocal_path)
-        bgm_audio = full_audio - vocal_audio
-        return full_audio, vocal_audio, bgm_audio
+    def run(self, audio_path):
+        return separate_prompt(self.demucs_model, audio_path, self.device, cache=self.stem_cache)
 
 
 
@@ -153,6 +139,10 @@ if __name__ == "__main__":
         item["wav_path"] = target_wav_name
         new_items.append(item)
 
+    # the VAE and BEST-RQ are shared by both tokenizers, free them before loading the LM
+    audio_tokenizer.release()
+    if seperate_tokenizer is not None:
+        seperate_tokenizer.release()
     del audio_tokenizer
     del seperate_tokenizer
     del separator
@@ -204,11 +194,15 @@ if __name__ == "__main__":
             tokens = model.generate(**generate_inp, return_tokens=True)
         item['tokens'] = tokens
     
+    # prefix cache snapshots are on the GPU
+    model.lm.prefix_cache.clear()
     del model
     torch.cuda.empty_cache()
 
 
-    seperate_tokenizer = builders.get_audio_tokenizer_model(cfg.audio_tokenizer_checkpoint_sep, cfg)
+    # BEST-RQ is only needed to tokenize the prompt wavs again during decoding
+    encoder_loading = 'lazy' if any('raw_pmt_wav' in item for item in new_items) else 'decode_only'
+    seperate_tokenizer = builders.get_audio_tokenizer_model(cfg.audio_tokenizer_checkpoint_sep, cfg, encoder_loading=encoder_loading)
     seperate_tokenizer = seperate_tokenizer.eval().cuda()
 
     model = CodecLM(name = "tmp",
@@ -12,6 +12,7 @@ from omegaconf import OmegaConf
 from codeclm.trainer.codec_song_pl import CodecLM_PL
 from codeclm.models import CodecLM
 from third_party.demucs.models.pretrained import get_model_from_yaml
+from codeclm.utils.separation import StemCache, separate_prompt
 
 # 可用的 Auto Prompt 类型
 auto_prompt_type = [
@@ -21,12 +22,14 @@ auto_prompt_type = [
 ]
 
 class Separator:
-    def __init__(self, dm_model_path='third_party/demucs/ckpt/htdemucs.pth', dm_config_path='third_party/demucs/ckpt/htdemucs.yaml', gpu_id=0) -> None:
+    def __init__(self, dm_model_path='third_party/demucs/ckpt/htdemucs.pth', dm_config_path='third_party/demucs/ckpt/htdemucs.yaml', gpu_id=0,
+                 stem_cache_dir=None) -> None:
         if torch.cuda.is_available() and gpu_id < torch.cuda.device_count():
             self.device = torch.device(f"cuda:{gpu_id}")
         else:
             self.device = torch.device("cpu")
         self.demucs_model = self.init_demucs_model(dm_model_path, dm_config_path)
+        self.stem_cache = StemCache(stem_cache_dir)
 
     def init_demucs_model(self, model_path, config_path):
         model = get_model_from_yaml(config_path, model_path)
@@ -44,26 +47,8 @@ class Separator:
             a = torch.cat([a, a], -1)
         return a[:, 0:48000*10]
     
-    def run(self, audio_path, output_dir='tmp', ext=".flac"):
-        os.makedirs(output_dir, exist_ok=True)
-        name, _ = os.path.splitext(os.path.basename(audio_path))
-        output_paths = []
-
-        for stem in self.demucs_model.sources:
-            output_path = os.path.join(output_dir, f"{name}_{stem}{ext}")
-            if os.path.exists(output_path):
-                output_paths.append(output_path)
-
-        if len(output_paths) == 1:
-            vocal_path = output_paths[0]
-        else:
-            drums_path, bass_path, other_path, vocal_path = self.demucs_model.separate(audio_path, output_dir, device=self.device)
-            for path in [drums_path, bass_path, other_path]:
-                os.remove(path)
-        full_audio = self.load_audio(audio_path)
-        vocal_audio = self.load_audio(vocal_path)
-        bgm_audio = full_audio - vocal_audio
-        return full_audio, vocal_audio, bgm_audio
+    def run(self, audio_path):
+        return separate_prompt(self.demucs_model, audio_path, self.device, cache=self.stem_cache)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -77,6 +62,23 @@ def main():
     parser.add_argument("--record_tokens", action="store_true")
     parser.add_argument("--record_window", type=int, default=50)
     parser.add_argument("--duration", type=float, default=None)
+    parser.add_argument("--cfg_mode", type=str, default="full", choices=["full", "cutoff", "first_codebook", "reuse"])
+    parser.add_argument("--cfg_cutoff_step", type=int, default=0)
+    parser.add_argument("--cfg_reuse_interval", type=int, default=1)
+    parser.add_argument("--compile_decode", action="store_true")
+    parser.add_argument("--prefix_cache", action="store_true")
+    parser.add_argument("--num_takes", type=int, default=1)
+    parser.add_argument("--stem_cache_dir", type=str, default=None,
+                        help="keep the separated prompts on disk, keyed by the content of the prompt audio")
+    parser.add_argument("--progressive", action="store_true",
+                        help="decode the audio window by window while the tokens are generated (single take)")
+    parser.add_argument("--speculative_steps", type=int, default=0)
+    parser.add_argument("--diffusion_steps", type=int, default=50)
+    parser.add_argument("--diffusion_solver", type=str, default="euler", choices=["euler", "heun", "midpoint", "rk4", "multistep"])
+    parser.add_argument("--diffusion_t_schedule", type=str, default="linear", choices=["linear", "cosine", "shift"])
+    parser.add_argument("--diffusion_guidance_scale", type=float, default=1.5)
+    parser.add_argument("--diffusion_guidance_interval", type=float, nargs=2, default=[0., 1.], metavar=("T_START", "T_END"),
+                        help="solver steps starting outside [T_START, T_END] (t=0 is the noise) run without guidance")
     args = parser.parse_args()
 
     print("✅ generate.py parameters:")
@@ -118,8 +120,17 @@ def main():
         top_k=args.top_k,
         top_p=args.top_p,
         record_tokens=args.record_tokens,
-        record_window=args.record_window
+        record_window=args.record_window,
+        cfg_mode=args.cfg_mode,
+        cfg_cutoff_step=args.cfg_cutoff_step,
+        cfg_reuse_interval=args.cfg_reuse_interval,
+        compile_decode=args.compile_decode,
+        prefix_cache=args.prefix_cache,
+        speculative_steps=args.speculative_steps,
     )
+    model.set_diffusion_params(num_steps=args.diffusion_steps, solver=args.diffusion_solver,
+                               t_schedule=args.diffusion_t_schedule, guidance_scale=args.diffusion_guidance_scale,
+                               guidance_interval=args.diffusion_guidance_interval)
 
     # Prepare output folders
     #os.makedirs(args.save_dir, exist_ok=True)
@@ -132,7 +143,7 @@ def main():
     os.makedirs(os.path.join(args.save_dir, "jsonl"), exist_ok=True)
 
     # Prepare separator
-    separator = Separator()
+    separator = Separator(stem_cache_dir=args.stem_cache_dir)
 
     # Process JSONL
     with open(args.input_jsonl, "r") as fp:
@@ -180,22 +191,37 @@ def main():
 
         # Generation
         start_time = time.time()
-        with torch.autocast(device_type="cuda", dtype=torch.float16):
-            tokens = model.generate(**generate_inp, return_tokens=True)
+        progressive_wav = None
+        if args.progressive and args.num_takes == 1:
+            texts, audio_qt_embs = model.prepare_inputs(generate_inp['lyrics'], pmt_wav, melody_is_wav, vocal_wav, bgm_wav)
+            with torch.autocast(device_type="cuda", dtype=torch.float16):
+                tokens, progressive_wav = model.generate_progressive(
+                    texts, generate_inp['descriptions'], audio_qt_embs,
+                    vocal_prompt=vocal_wav if melody_is_wav else None, bgm_prompt=bgm_wav if melody_is_wav else None)
+        else:
+            with torch.autocast(device_type="cuda", dtype=torch.float16):
+                tokens = model.generate(**generate_inp, return_tokens=True, num_takes=args.num_takes)
         mid_time = time.time()
-
-        with torch.no_grad():
-            if melody_is_wav:
-                wav_seperate = model.generate_audio(tokens, pmt_wav, vocal_wav, bgm_wav)
-            else:
-                wav_seperate = model.generate_audio(tokens)
+        takes = tokens if args.num_takes > 1 else [tokens]
+
+        wav_paths = []
+        for take_idx, take_tokens in enumerate(takes):
+            with torch.no_grad():
+                if progressive_wav is not None:
+                    wav_seperate = progressive_wav
+                elif melody_is_wav:
+                    wav_seperate = model.generate_audio(take_tokens, pmt_wav, vocal_wav, bgm_wav)
+                else:
+                    wav_seperate = model.generate_audio(take_tokens)
+            take_wav_name = target_wav_name if args.num_takes == 1 else \
+                os.path.join(args.save_dir, "audios", f"{item['idx']}_take{take_idx}.flac")
+            # Save audio
+            torchaudio.save(take_wav_name, wav_seperate[0].cpu().float(), cfg.sample_rate)
+            wav_paths.append(take_wav_name)
         end_time = time.time()
-
-        # Save audio
-        torchaudio.save(target_wav_name, wav_seperate[0].cpu().float(), cfg.sample_rate)
         print(f"process {item['idx']}, lm cost {mid_time - start_time:.3f}s, diffusion cost {end_time - mid_time:.3f}s")
 
-        item["wav_path"] = target_wav_name
+        item["wav_path"] = wav_paths[0] if args.num_takes == 1 else wav_paths
         new_items.append(item)
 
     # Save new JSONL
@@ -0,0 +1,62 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from codeclm.models.levo import CausalLM, LlamaConfig
+from codeclm.models.llama.modeling_llama import GraphKVCache, StaticKVCache
+
+NUM_LAYERS = 2
+MAX_LEN = 16
+
+
+def build_model() -> CausalLM:
+    torch.manual_seed(0)
+    config = LlamaConfig(hidden_size=32, intermediate_size=64, num_attention_heads=4, num_key_value_heads=4,
+                         num_hidden_layers=NUM_LAYERS, vocab_size=50, max_position_embeddings=64,
+                         use_cache=False, _flash_attn_2_enabled=False)
+    return CausalLM(config).double().eval()
+
+
+@torch.no_grad()
+def test_graph_cache_step_matches_static_cache():
+    model = build_model()
+    prompt = torch.randn(2, 5, 32, dtype=torch.float64)
+    steps = torch.randn(3, 2, 1, 32, dtype=torch.float64)
+
+    static_cache = StaticKVCache(NUM_LAYERS, MAX_LEN)
+    graph_cache = StaticKVCache(NUM_LAYERS, MAX_LEN)
+    for cache in (static_cache, graph_cache):
+        model(inputs_embeds=prompt, past_key_values=cache, use_cache=True)
+    # the fixed-shape steps take their mask and positions from the cache, as when replayed in a graph
+    graph_cache = GraphKVCache.from_static(graph_cache)
+
+    for step in steps:
+        expected = model(inputs_embeds=step, past_key_values=static_cache, use_cache=True).logits
+        logits = model(inputs_embeds=step, past_key_values=graph_cache, use_cache=True).logits
+        torch.testing.assert_close(logits, expected)
+    assert graph_cache.position.item() == static_cache.get_seq_length()
+
+
+def test_static_cache_rewind():
+    cache = StaticKVCache(NUM_LAYERS, MAX_LEN)
+    keys = torch.randn(1, 2, 5, 4)
+    for layer_idx in range(NUM_LAYERS):
+        cache.update(layer_idx, keys, -keys)
+    cache.advance(5)
+
+    # the last two positions are dropped, for every layer
+    cache.rewind(2)
+    assert cache.get_seq_length() == 3
+    assert all(layer.get_seq_length() == 3 for layer in cache.layers)
+
+    # and the next writes land right after the kept ones
+    new_keys = torch.randn(1, 2, 3, 4)
+    for layer_idx in range(NUM_LAYERS):
+        key_states, value_states = cache.update(layer_idx, new_keys, -new_keys)
+        torch.testing.assert_close(key_states, torch.cat([keys[:, :, :3], new_keys], 2))
+        torch.testing.assert_close(value_states, -key_states)
+    cache.advance(3)
+    assert cache.get_seq_length() == 6
+
+    with pytest.raises(RuntimeError):
+        cache.rewind(7)
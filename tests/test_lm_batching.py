@@ -0,0 +1,85 @@
+import warnings
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from torch import nn
+
+from codeclm.models.lm_batching import ContinuousBatchingGenerator, GenerationRequest
+from codeclm.models.lm_levo import LmModel
+from codeclm.modules.conditioners import ConditionerProvider, ConditionFuser, TextConditioner
+from codeclm.modules.pattern import DelayedPatternProvider
+
+CODE_DEPTH = 3
+MAX_GEN_LEN = 24
+
+
+class CharConditioner(TextConditioner):
+    """Characters of the text as tokens, padded to a fixed length, in place of the Qwen tokenizer."""
+    def __init__(self, output_dim: int, max_len: int = 12):
+        super().__init__(128, output_dim, input_token=True)
+        self.output_proj2 = nn.Embedding(128, output_dim)
+        self.max_len = max_len
+
+    def tokenize(self, x):
+        tokens = torch.zeros(len(x), self.max_len, dtype=torch.long)
+        for i, text in enumerate(x):
+            ids = [ord(c) % 128 for c in (text or "")[:self.max_len]]
+            tokens[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+        return tokens
+
+    def forward(self, tokens):
+        tokens = tokens.to(self.output_proj.weight.device)
+        return self.output_proj(tokens), self.output_proj2(tokens), torch.ones_like(tokens)
+
+
+def build_lm() -> LmModel:
+    torch.manual_seed(0)
+    lm = LmModel(
+        pattern_provider=DelayedPatternProvider(code_depth=CODE_DEPTH),
+        condition_provider=ConditionerProvider({'description': CharConditioner(32)}),
+        fuser=ConditionFuser({'prepend': ['description']}),
+        code_depth=CODE_DEPTH, code_size=40, dim=32, intermediate_size=64, num_heads=4,
+        num_layers=2, num_layers_sub=2, max_position_embeddings=256, max_position_embeddings_sub=256,
+        cfg_coef=1.5, use_flash_attn_2=False)
+    # double precision, so that padding the batch cannot flip a greedy choice
+    return lm.double().eval()
+
+
+def make_requests():
+    # prompt tokens >= 16384 are not masked from the first codebook
+    prompt = torch.full((1, CODE_DEPTH, 4), 16385, dtype=torch.long)
+    lyrics = ["[verse] la la", "[chorus] oh", "[intro]", "[outro] bye now"]
+    return [GenerationRequest(texts=[lyric], descriptions=None, audio_qt_embs=prompt, request_id=idx)
+            for idx, lyric in enumerate(lyrics)]
+
+
+def test_continuous_batching_matches_generate():
+    lm = build_lm()
+    requests = make_requests()
+    expected = {
+        request.request_id: lm.generate(texts=request.texts, descriptions=request.descriptions,
+                                        audio_qt_embs=request.audio_qt_embs, max_gen_len=MAX_GEN_LEN,
+                                        use_sampling=False)
+        for request in requests}
+
+    # fewer slots than songs, so that finished songs hand their rows over to pending ones
+    generator = ContinuousBatchingGenerator(lm, max_batch_size=2, max_gen_len=MAX_GEN_LEN, use_sampling=False)
+    results = dict(generator.run(requests))
+
+    assert sorted(results) == sorted(expected)
+    assert generator.stats['admitted'] == len(requests)
+    for request_id, codes in expected.items():
+        assert torch.equal(results[request_id], codes), request_id
+
+
+def test_unsupported_generation_params_warn():
+    lm = build_lm()
+    with pytest.warns(UserWarning, match="speculative_steps"):
+        ContinuousBatchingGenerator(lm, max_batch_size=2, max_gen_len=MAX_GEN_LEN, speculative_steps=4)
+    # defaults, as passed by CodecLM.generate_batch, are fine
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        ContinuousBatchingGenerator(lm, max_batch_size=2, max_gen_len=MAX_GEN_LEN, compile_decode=False,
+                                    prefix_cache=False, speculative_steps=0, cfg_cutoff_step=0)
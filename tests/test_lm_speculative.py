@@ -0,0 +1,17 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from tests.test_lm_batching import MAX_GEN_LEN, build_lm, make_requests
+
+
+@pytest.mark.parametrize("static_kv_cache", [True, False])
+def test_speculative_greedy_matches_step_by_step(static_kv_cache):
+    lm = build_lm()
+    for request in make_requests():
+        kwargs = dict(texts=request.texts, descriptions=request.descriptions, audio_qt_embs=request.audio_qt_embs,
+                      max_gen_len=MAX_GEN_LEN, use_sampling=False, static_kv_cache=static_kv_cache)
+        expected = lm.generate(speculative_steps=0, **kwargs)
+        codes = lm.generate(speculative_steps=4, **kwargs)
+        assert torch.equal(codes, expected), request.request_id
+        assert lm.last_speculative_stats['generated'] > 0
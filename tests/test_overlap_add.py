@@ -0,0 +1,49 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+
+# the Flow1dVAE modules import each other from their own directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "codeclm", "tokenizer", "Flow1dVAE"))
+
+from tools.overlap_add import OverlapAdd
+
+
+def concat_stitch(windows, ovlp_samples, target_len):
+    # the torch.cat crossfade that OverlapAdd replaced
+    output = None
+    for cur_output in windows:
+        if output is None:
+            output = cur_output
+        else:
+            ov_win = torch.from_numpy(np.linspace(0, 1, ovlp_samples)[None, :])
+            ov_win = torch.cat([ov_win, 1 - ov_win], -1)
+            output[:, -ovlp_samples:] = output[:, -ovlp_samples:] * ov_win[:, -ovlp_samples:] + cur_output[:, 0:ovlp_samples] * ov_win[:, 0:ovlp_samples]
+            output = torch.cat([output, cur_output[:, ovlp_samples:]], -1)
+    return output[:, 0:target_len]
+
+
+@pytest.mark.parametrize("lengths,target_len", [
+    ([40, 40, 40], 90),   # cut in the last window, past its overlap
+    ([40, 40, 40], 62),   # cut in the overlap of the second and third windows
+    ([40, 40, 25], 200),  # short last window, target longer than the song
+    ([40, 40, 25], 91),
+    ([40], 30),           # single window
+    ([40], 100),
+])
+def test_overlap_add_matches_concat(lengths, target_len):
+    torch.manual_seed(0)
+    ovlp_samples = 10
+    windows = [torch.randn(2, n) for n in lengths]
+    expected = concat_stitch([w.clone() for w in windows], ovlp_samples, target_len)
+
+    stitcher = OverlapAdd(target_len, ovlp_samples)
+    for window in windows:
+        stitcher.add(window)
+    output = stitcher.result()
+    assert output.shape == expected.shape
+    torch.testing.assert_close(output, expected)
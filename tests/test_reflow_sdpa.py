@@ -0,0 +1,54 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("diffusers")
+
+# the Flow1dVAE modules import each other from their own directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "codeclm", "tokenizer", "Flow1dVAE"))
+
+from models_gpt.models.gpt2_config import GPT2Config
+from models_gpt.models.gpt2_rope2_time_new_correct_mask_noncasual_reflow import GPT2Model, sdpa_attention_mask
+
+NUM_FRAMES = 10
+
+
+def build_models():
+    torch.manual_seed(0)
+    eager = GPT2Model(GPT2Config(n_positions=64, n_layer=2, n_head=4, n_embd=32, n_inner=64)).double().eval()
+    sdpa = GPT2Model(GPT2Config(n_positions=64, n_layer=2, n_head=4, n_embd=32, n_inner=64,
+                                attn_implementation="sdpa")).double().eval()
+    sdpa.load_state_dict(eager.state_dict())
+    return eager, sdpa
+
+
+def test_eager_attention_is_the_default():
+    eager, sdpa = build_models()
+    assert eager._attn_implementation == "eager"
+    assert sdpa._attn_implementation == "sdpa"
+
+
+@pytest.mark.parametrize("pairwise", [False, True])
+@torch.no_grad()
+def test_sdpa_matches_eager_on_valid_frames(pairwise):
+    eager, sdpa = build_models()
+    inputs = torch.randn(2, NUM_FRAMES, 32, dtype=torch.float64)
+    time_step = torch.rand(2, dtype=torch.float64)
+    valid = torch.ones(2, NUM_FRAMES, dtype=torch.bool)
+    valid[1, -3:] = False
+    if pairwise:
+        # [batch, 1, frames, frames] mask of the diffusion model
+        mask = valid[:, None, :, None] & valid[:, None, None, :]
+    else:
+        mask = valid
+
+    expected = eager(inputs_embeds=inputs, attention_mask=mask.double(), time_step=time_step).last_hidden_state
+    # boolean as given by EstimatorInputs, and 0/1 as converted by the model itself
+    for sdpa_mask in (sdpa_attention_mask(mask), mask.double()):
+        hidden = sdpa(inputs_embeds=inputs, attention_mask=sdpa_mask, time_step=time_step).last_hidden_state
+        assert not hidden.isnan().any()
+        torch.testing.assert_close(hidden[valid], expected[valid])
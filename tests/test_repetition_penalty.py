@@ -0,0 +1,42 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from codeclm.models.lm_levo import RepetitionPenaltyBuffer
+
+CODE_DEPTH = 3
+CARD = 41  # LmModel.code_size: EOS is CARD - 1, the special token CARD is never sampled from the logits
+EOS = CARD - 1
+WINDOW = 5
+
+
+def penalize_with_pool(logits, sampled_token_pool):
+    # the unique / bincount loop that RepetitionPenaltyBuffer replaced, for a single row
+    if len(sampled_token_pool) > 0:
+        sampled_token_pool = torch.stack(sampled_token_pool, -1)  # [K, T]
+        for q in range(CODE_DEPTH):
+            q_count = torch.bincount(torch.unique(sampled_token_pool[q]))
+            tmp = min(q_count.shape[-1], CARD - 1)
+            logits[:, q, :tmp] /= (1.1 ** q_count[:tmp])
+
+
+def test_penalty_matches_unique_bincount():
+    torch.manual_seed(0)
+    buffer = RepetitionPenaltyBuffer(1, CODE_DEPTH, WINDOW, EOS, 'cpu')
+    pool = []
+    # more steps than the window, so that the ring buffer wraps around
+    for step in range(3 * WINDOW + 2):
+        logits = torch.randn(1, CODE_DEPTH, CARD)
+        expected = logits.clone()
+        penalize_with_pool(expected, pool[-WINDOW:])
+        buffer.penalize_(logits)
+        torch.testing.assert_close(logits, expected, rtol=0, atol=0)
+
+        # few distinct tokens, so that the window holds repeats, with EOS and the special token now and then
+        tokens = torch.randint(0, 8, (CODE_DEPTH,))
+        if step % 4 == 1:
+            tokens[0] = EOS
+        if step % 4 == 2:
+            tokens[1] = CARD
+        pool.append(tokens)
+        buffer.push(tokens.view(1, CODE_DEPTH, 1))
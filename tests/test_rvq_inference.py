@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("einops")
+
+# the Flow1dVAE modules import each other from their own directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "codeclm", "tokenizer", "Flow1dVAE"))
+
+from libs.rvq.descript_quantize3 import ResidualVectorQuantize
+
+
+def build_rvq():
+    torch.manual_seed(0)
+    return ResidualVectorQuantize(input_dim=16, n_codebooks=2, codebook_size=64, codebook_dim=8).double()
+
+
+@torch.no_grad()
+def test_decode_latents_eval_matches_train():
+    quantizer = build_rvq().quantizers[0]
+    latents = torch.randn(2, 8, 7, dtype=torch.float64)
+
+    quantizer.train()
+    expected_z, expected_indices = quantizer.decode_latents(latents)
+    quantizer.eval()
+    z, indices = quantizer.decode_latents(latents)
+    assert torch.equal(indices, expected_indices)
+    torch.testing.assert_close(z, expected_z)
+
+    # chunks smaller than the B*T rows, the last one partial
+    encodings = latents.transpose(1, 2).reshape(-1, 8)
+    assert torch.equal(quantizer.nearest_codes(encodings, chunk_size=5), expected_indices.reshape(-1))
+
+
+def test_from_codes_lookup_matches_out_proj():
+    rvq = build_rvq().eval()
+    codes = torch.randint(0, 64, (2, 2, 7))
+
+    expected_z, expected_z_p, _ = rvq.from_codes(codes)
+    assert expected_z.requires_grad
+    with torch.no_grad():
+        z, z_p, _ = rvq.from_codes(codes)
+        torch.testing.assert_close(z, expected_z.detach())
+        torch.testing.assert_close(z_p, expected_z_p.detach())
+
+        # the code tables follow in place updates of the codebook
+        rvq.quantizers[0].codebook.weight.mul_(2)
+        z, _, _ = rvq.from_codes(codes)
+    torch.testing.assert_close(z, rvq.from_codes(codes)[0].detach())
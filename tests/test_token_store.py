@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+# the Flow1dVAE modules import each other from their own directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "codeclm", "tokenizer", "Flow1dVAE"))
+
+from tools.token_store import TokenShardWriter, TokenStore, completed_keys
+
+
+def make_codes(seed, num_rows=3):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 16384, size=(num_rows, int(rng.integers(5, 50))))
+
+
+def test_resume_after_a_stopped_writer(tmp_path):
+    prefix = str(tmp_path / "shard_00000-of-00002")
+    items = {str(idx): make_codes(idx) for idx in range(6)}
+    with TokenShardWriter(prefix) as writer:
+        for key in ["0", "1", "2"]:
+            writer.write(key, items[key])
+    # a writer stopped in the middle of an item: codes written without their index line, or a partial index line
+    with open(prefix + ".bin", "ab") as f:
+        f.write(b"\x01\x02\x03\x04\x05")
+    with open(prefix + ".idx", "a") as f:
+        f.write('{"key": "3", "offs')
+    assert completed_keys(str(tmp_path)) == {"0", "1", "2"}
+
+    with TokenShardWriter(prefix) as writer:
+        for key in ["3", "4"]:
+            writer.write(key, items[key])
+    # a second shard, as written by another worker
+    with TokenShardWriter(str(tmp_path / "shard_00001-of-00002")) as writer:
+        writer.write("5", items["5"])
+
+    store = TokenStore(str(tmp_path))
+    assert sorted(store.keys()) == sorted(items)
+    for key, codes in items.items():
+        np.testing.assert_array_equal(store[key], codes)
+    assert completed_keys(str(tmp_path)) == set(items)